@@ -0,0 +1,38 @@
+from repositories import RateLimitRepo
+from typing import Dict, Optional, Tuple
+import logging
+
+
+def parse_rule(rule: str) -> Tuple[int, float]:
+    """Parse a limit/seconds rule such as 20/60; a limit of 0 disables the scope"""
+    limit, _, seconds = rule.partition("/")
+    return int(limit), float(seconds or 60)
+
+
+class RateLimiter:
+    """Per-key sliding-window limits grouped by scope, with allowed/limited counters per scope
+
+    Hits are recorded in store, which may be shared between replicas. When the shared
+    store fails, the local fallback store keeps the limits per process instead.
+    """
+
+    def __init__(self, rules: Dict[str, Tuple[int, float]], store: RateLimitRepo, fallback: Optional[RateLimitRepo] = None):
+        self.rules = rules
+        self.store = store
+        self.fallback = fallback
+        self.stats: Dict[str, Dict[str, int]] = {scope: {"allowed": 0, "limited": 0} for scope in rules}
+
+    async def hit(self, scope: str, key) -> Tuple[bool, float]:
+        """Count one hit by key in scope; returns (allowed, retry after seconds)"""
+        limit, window_seconds = self.rules[scope]
+        if limit <= 0:
+            return True, 0.0
+        try:
+            allowed, retry_after = await self.store.hit(f"{scope}:{key}", limit, window_seconds)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            logging.error(f"Rate limit store error, limiting locally: {str(e)}")
+            allowed, retry_after = await self.fallback.hit(f"{scope}:{key}", limit, window_seconds)
+        self.stats[scope]["allowed" if allowed else "limited"] += 1
+        return allowed, retry_after
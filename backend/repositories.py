@@ -0,0 +1,1248 @@
+from abc import ABC, abstractmethod
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from typing import List, Optional, Dict, Iterable, Tuple, Callable, AsyncIterator
+from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+import time
+import uuid
+
+# Plan of subscriptions stored before plans existed
+DEFAULT_PLAN_ID = "default"
+
+# Counters materialized per day by AnalyticsRepo.rebuild_daily
+DAILY_METRICS = ("revenue", "payments", "new_subscribers", "churned_subscribers")
+CHURNED_STATUSES = ("expired", "canceled")
+
+# Mongo error codes for change streams on a standalone server and for expired resume tokens
+CHANGE_STREAM_UNSUPPORTED_CODES = (40573,)
+CHANGE_STREAM_HISTORY_LOST_CODES = (280, 286)
+
+
+class ChangeStreamUnsupported(Exception):
+    """The storage backend can't stream changes (e.g. standalone mongod)"""
+
+
+class ChangeStreamHistoryLost(Exception):
+    """The resume token is no longer in the oplog; changes may have been missed"""
+
+
+def _projection(fields: Optional[List[str]]) -> Optional[Dict]:
+    """Mongo projection returning only fields (and never _id)"""
+    if fields is None:
+        return None
+    return {"_id": 0, **{field: 1 for field in fields}}
+
+
+def _select(doc: Dict, fields: Optional[List[str]]) -> Dict:
+    """In-memory equivalent of _projection"""
+    if fields is None:
+        return _copy(doc)
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def _plan_filter(plan_ids: Iterable[str]) -> Dict:
+    """Mongo condition on plan_id; documents without one belong to the default plan"""
+    plan_ids = list(plan_ids)
+    if DEFAULT_PLAN_ID in plan_ids:
+        plan_ids.append(None)
+    return {"$in": plan_ids}
+
+
+def _plan_of(doc: Dict) -> str:
+    """In-memory equivalent of the default in _plan_filter"""
+    return doc.get("plan_id") or DEFAULT_PLAN_ID
+
+
+def _copy(doc: Optional[Dict]) -> Optional[Dict]:
+    """Copy a stored document so callers can't mutate the in-memory store"""
+    if doc is None:
+        return None
+    return {
+        key: list(value) if isinstance(value, list) else dict(value) if isinstance(value, dict) else value
+        for key, value in doc.items()
+    }
+
+
+class ChangeTracker:
+    """Per-process write counters for each collection, used as HTTP cache validators"""
+
+    def __init__(self):
+        # Versions restart with the process, so tags include a boot id to never collide
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.started_at = datetime.utcnow()
+        self.versions: Dict[str, int] = {}
+        self.modified_at: Dict[str, datetime] = {}
+        self.listeners: List[Callable[[str, bool], None]] = []
+
+    def subscribe(self, listener: Callable[[str, bool], None]):
+        """Call listener with (collection, remote) on every change; remote ones come from the change watcher"""
+        self.listeners.append(listener)
+
+    def bump(self, collection: str, remote: bool = False):
+        self.versions[collection] = self.versions.get(collection, 0) + 1
+        self.modified_at[collection] = datetime.utcnow()
+        for listener in self.listeners:
+            listener(collection, remote)
+
+    def etag(self, *collections: str) -> str:
+        versions = "-".join(str(self.versions.get(collection, 0)) for collection in collections)
+        return f'"{self.boot_id}-{versions}"'
+
+    def last_modified(self, *collections: str) -> datetime:
+        return max([self.started_at] + [self.modified_at[c] for c in collections if c in self.modified_at])
+
+
+class TrackedRepo:
+    """Repository whose writes bump the collection version in the shared ChangeTracker"""
+
+    collection_name: str = ""
+    changes: Optional[ChangeTracker] = None
+
+    def _changed(self):
+        if self.changes is not None:
+            self.changes.bump(self.collection_name)
+
+
+# Repository interfaces
+class UserRepo(TrackedRepo, ABC):
+    """Access to the users collection"""
+
+    collection_name = "users"
+
+    @abstractmethod
+    async def get_by_id(self, user_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_by_telegram_id(self, telegram_user_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_by_ids(self, user_ids: List[str], fields: Optional[List[str]] = None) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_by_username(self, telegram_username: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_by_telegram_ids_or_usernames(self, telegram_user_ids: List[int], usernames: List[str]) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert(self, user: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_missing(self, users: List[Dict]):
+        """Insert users whose telegram_user_id is not stored yet"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_email(self, user_id: str, email: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_emails(self, emails: List[Tuple[str, str]]):
+        """Set emails for many (user_id, email) pairs"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count(self) -> int:
+        raise NotImplementedError
+
+
+class SubscriptionRepo(TrackedRepo, ABC):
+    """Access to the subscriptions collection"""
+
+    collection_name = "subscriptions"
+
+    @abstractmethod
+    async def get_active(self, telegram_user_id: int, plan_ids: Optional[List[str]] = None) -> Optional[Dict]:
+        """An active subscription of the user, optionally limited to some plans"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_by_stripe_id(self, stripe_subscription_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_by_stripe_ids(self, stripe_subscription_ids: List[str], fields: Optional[List[str]] = None) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_active(self, fields: Optional[List[str]] = None) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def recent_active(self, limit: int) -> List[Dict]:
+        """Newest active subscriptions first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_expired(self, now: datetime) -> List[Dict]:
+        """Active subscriptions whose period ended before now"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_due_for_reminder(self, start: datetime, end: datetime, marker: str, limit: int) -> List[Dict]:
+        """Active subscriptions ending in (start, end] that have not received marker"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_reminder_markers(self, subscription_ids: List[str], markers: List[str]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def oldest_stripe_created_at(self) -> Optional[datetime]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_by_status(self, status: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def active_members_by_plan(self) -> Dict[str, set]:
+        """Telegram user ids holding an active subscription, per plan id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def active_totals_by_plan(self) -> Dict[str, Tuple[int, float]]:
+        """(count, summed amount) of active subscriptions per plan id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert(self, subscription: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, subscription_id: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_by_stripe_id(self, stripe_subscription_id: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def bulk_update_by_stripe_id(self, updates: List[Tuple[str, Dict]]) -> int:
+        """Apply (stripe_subscription_id, fields) updates, returning the modified count"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_missing_by_stripe_id(self, subscriptions: List[Dict]) -> int:
+        """Insert subscriptions whose stripe_subscription_id is not stored yet"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def grant_active(self, grants: List[Tuple[Dict, datetime]], now: datetime) -> Tuple[int, int]:
+        """Create or extend active subscriptions, returning (created, extended)
+
+        Each grant is a new subscription document and the period end it should
+        reach; an existing active subscription of the same plan is never shortened.
+        """
+        raise NotImplementedError
+
+
+class TransactionRepo(TrackedRepo, ABC):
+    """Access to the payment_transactions collection"""
+
+    collection_name = "payment_transactions"
+
+    @abstractmethod
+    async def get_by_session_id(self, stripe_session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert(self, transaction: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_by_session_id(self, stripe_session_id: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def recent_completed(self, limit: int, fields: Optional[List[str]] = None) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def total_completed_revenue(self) -> float:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_abandoned(self, before: datetime) -> int:
+        """Delete checkouts still "initiated" since before, returning how many"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def archive_completed(self, before: datetime, limit: int) -> Tuple[int, float]:
+        """Move up to limit of the oldest completed transactions older than before to the archive
+
+        Returns (moved, their summed amount). Safe to repeat after a failure:
+        documents already copied to the archive are replaced, not duplicated.
+        """
+        raise NotImplementedError
+
+
+class AnalyticsRepo(ABC):
+    """Daily revenue and subscriber buckets (analytics_daily collection), keyed by YYYY-MM-DD day"""
+
+    @abstractmethod
+    async def rebuild_daily(self, since: Optional[datetime] = None):
+        """Recompute the DAILY_METRICS of every day from since (all days when None)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_snapshot(self, day: str, fields: Dict):
+        """Store point-in-time values (MRR, active subscribers) on a day"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def daily(self, start_day: str, end_day: str) -> List[Dict]:
+        """Buckets from start_day to end_day inclusive, oldest first"""
+        raise NotImplementedError
+
+
+class PlanRepo(TrackedRepo, ABC):
+    """Access to the plans collection"""
+
+    collection_name = "plans"
+
+    @abstractmethod
+    async def list(self) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upsert(self, plan: Dict):
+        raise NotImplementedError
+
+
+class StatusCheckRepo(ABC):
+    """Access to the status_checks collection"""
+
+    @abstractmethod
+    async def insert(self, status_check: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def list(self, limit: int, before: Optional[Tuple[datetime, str]] = None) -> List[Dict]:
+        """Newest first, starting after the (timestamp, id) keyset cursor"""
+        raise NotImplementedError
+
+
+class SyncStateRepo(ABC):
+    """Small key/value store for job watermarks (sync_state collection)"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, fields: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def increment(self, key: str, amounts: Dict):
+        """Add amounts to numeric fields, starting from zero"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def push(self, key: str, field: str, values: List):
+        """Append values to a list field, starting from an empty list"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def take(self, key: str) -> Optional[Dict]:
+        """Remove and return a document, so only one process consumes it"""
+        raise NotImplementedError
+
+
+class RateLimitRepo(ABC):
+    """Hit counters for sliding-window rate limits (rate_limits collection)"""
+
+    @abstractmethod
+    async def hit(self, key: str, limit: int, window_seconds: float) -> Tuple[bool, float]:
+        """Record a hit on key; returns (allowed, seconds until the next hit would be allowed)"""
+        raise NotImplementedError
+
+
+class Repositories:
+    """All repositories of one storage backend"""
+
+    users: UserRepo
+    subscriptions: SubscriptionRepo
+    transactions: TransactionRepo
+    plans: PlanRepo
+    analytics: AnalyticsRepo
+    status_checks: StatusCheckRepo
+    sync_state: SyncStateRepo
+    rate_limits: RateLimitRepo
+    changes: ChangeTracker
+
+    # Whether other processes can write to the same storage
+    shared = False
+
+    def _track_changes(self):
+        self.changes = ChangeTracker()
+        for repo in self._tracked_repos():
+            repo.changes = self.changes
+
+    def _tracked_repos(self) -> List[TrackedRepo]:
+        return [self.users, self.subscriptions, self.transactions, self.plans]
+
+    def tracked_collections(self) -> List[str]:
+        return [repo.collection_name for repo in self._tracked_repos()]
+
+    async def ensure_indexes(self):
+        pass
+
+    def watch_changes(self, collections: List[str], resume_token: Optional[Dict] = None) -> AsyncIterator[Tuple[str, Dict]]:
+        """Yield (collection, resume token) for every write to collections, by any process"""
+        raise ChangeStreamUnsupported("Storage backend has no change streams")
+
+    async def change_signatures(self, collections: List[str]) -> Dict[str, Tuple]:
+        """Cheap per-collection fingerprints, compared between polls when change streams are unavailable"""
+        return {}
+
+    def close(self):
+        pass
+
+
+# Motor (MongoDB) implementation
+class MotorUserRepo(UserRepo):
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get_by_id(self, user_id):
+        return await self.collection.find_one({"id": user_id})
+
+    async def get_by_telegram_id(self, telegram_user_id):
+        return await self.collection.find_one({"telegram_user_id": telegram_user_id})
+
+    async def find_by_ids(self, user_ids, fields=None):
+        return await self.collection.find({"id": {"$in": user_ids}}, _projection(fields)).to_list(length=None)
+
+    async def get_by_username(self, telegram_username):
+        return await self.collection.find_one({"telegram_username": telegram_username})
+
+    async def find_by_telegram_ids_or_usernames(self, telegram_user_ids, usernames):
+        return await self.collection.find(
+            {"$or": [
+                {"telegram_user_id": {"$in": telegram_user_ids}},
+                {"telegram_username": {"$in": usernames}}
+            ]},
+            {"_id": 0, "id": 1, "telegram_user_id": 1, "telegram_username": 1}
+        ).to_list(length=None)
+
+    async def insert(self, user):
+        await self.collection.insert_one(user)
+        self._changed()
+
+    async def insert_missing(self, users):
+        if users:
+            await self.collection.bulk_write([
+                UpdateOne({"telegram_user_id": user["telegram_user_id"]}, {"$setOnInsert": user}, upsert=True)
+                for user in users
+            ], ordered=False)
+            self._changed()
+
+    async def set_email(self, user_id, email):
+        await self.collection.update_one(
+            {"id": user_id}, {"$set": {"email": email, "updated_at": datetime.utcnow()}}
+        )
+        self._changed()
+
+    async def set_emails(self, emails):
+        if emails:
+            now = datetime.utcnow()
+            await self.collection.bulk_write([
+                UpdateOne({"id": user_id}, {"$set": {"email": email, "updated_at": now}})
+                for user_id, email in emails
+            ], ordered=False)
+            self._changed()
+
+    async def count(self):
+        return await self.collection.count_documents({})
+
+
+class MotorSubscriptionRepo(SubscriptionRepo):
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get_active(self, telegram_user_id, plan_ids=None):
+        query = {"telegram_user_id": telegram_user_id, "status": "active"}
+        if plan_ids is not None:
+            query["plan_id"] = _plan_filter(plan_ids)
+        return await self.collection.find_one(query)
+
+    async def get_by_stripe_id(self, stripe_subscription_id):
+        return await self.collection.find_one({"stripe_subscription_id": stripe_subscription_id})
+
+    async def find_by_stripe_ids(self, stripe_subscription_ids, fields=None):
+        return await self.collection.find(
+            {"stripe_subscription_id": {"$in": stripe_subscription_ids}}, _projection(fields)
+        ).to_list(length=None)
+
+    async def find_active(self, fields=None):
+        return await self.collection.find({"status": "active"}, _projection(fields)).to_list(length=None)
+
+    async def recent_active(self, limit):
+        return await self.collection.find(
+            {"status": "active"},
+            {"telegram_user_id": 1, "current_period_end": 1, "created_at": 1}
+        ).sort("created_at", DESCENDING).limit(limit).to_list(length=limit)
+
+    async def find_expired(self, now):
+        return await self.collection.find({
+            "status": "active",
+            "current_period_end": {"$lt": now}
+        }).to_list(length=None)
+
+    async def find_due_for_reminder(self, start, end, marker, limit):
+        return await self.collection.find(
+            {
+                "status": "active",
+                "current_period_end": {"$gt": start, "$lte": end},
+                "reminders_sent": {"$ne": marker}
+            },
+            {"_id": 0, "id": 1, "telegram_user_id": 1, "current_period_end": 1, "stripe_subscription_id": 1}
+        ).limit(limit).to_list(length=limit)
+
+    async def add_reminder_markers(self, subscription_ids, markers):
+        await self.collection.update_many(
+            {"id": {"$in": subscription_ids}},
+            {"$addToSet": {"reminders_sent": {"$each": markers}}}
+        )
+
+    async def oldest_stripe_created_at(self):
+        oldest = await self.collection.find_one(
+            {"stripe_subscription_id": {"$ne": None}},
+            {"_id": 0, "created_at": 1},
+            sort=[("created_at", ASCENDING)]
+        )
+        return oldest["created_at"] if oldest else None
+
+    async def count_by_status(self, status):
+        return await self.collection.count_documents({"status": status})
+
+    async def active_members_by_plan(self):
+        members: Dict[str, set] = {}
+        async for doc in self.collection.find(
+            {"status": "active"}, {"_id": 0, "telegram_user_id": 1, "plan_id": 1}
+        ):
+            members.setdefault(_plan_of(doc), set()).add(doc["telegram_user_id"])
+        return members
+
+    async def active_totals_by_plan(self):
+        totals = await self.collection.aggregate([
+            {"$match": {"status": "active"}},
+            {"$group": {"_id": "$plan_id", "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}}
+        ]).to_list(length=None)
+        result: Dict[str, Tuple[int, float]] = {}
+        for total in totals:
+            plan_id = total["_id"] or DEFAULT_PLAN_ID
+            count, amount = result.get(plan_id, (0, 0.0))
+            result[plan_id] = (count + total["count"], amount + total["amount"])
+        return result
+
+    async def insert(self, subscription):
+        await self.collection.insert_one(subscription)
+        self._changed()
+
+    async def update(self, subscription_id, fields):
+        await self.collection.update_one({"id": subscription_id}, {"$set": fields})
+        self._changed()
+
+    async def update_by_stripe_id(self, stripe_subscription_id, fields):
+        await self.collection.update_one({"stripe_subscription_id": stripe_subscription_id}, {"$set": fields})
+        self._changed()
+
+    async def bulk_update_by_stripe_id(self, updates):
+        if not updates:
+            return 0
+        result = await self.collection.bulk_write([
+            UpdateOne({"stripe_subscription_id": stripe_id}, {"$set": fields}) for stripe_id, fields in updates
+        ], ordered=False)
+        self._changed()
+        return result.modified_count
+
+    async def insert_missing_by_stripe_id(self, subscriptions):
+        if not subscriptions:
+            return 0
+        result = await self.collection.bulk_write([
+            UpdateOne(
+                {"stripe_subscription_id": subscription["stripe_subscription_id"]},
+                {"$setOnInsert": subscription},
+                upsert=True
+            )
+            for subscription in subscriptions
+        ], ordered=False)
+        self._changed()
+        return result.upserted_count
+
+    async def grant_active(self, grants, now):
+        if not grants:
+            return 0, 0
+        ops = []
+        for subscription, end_date in grants:
+            on_insert = {
+                key: value for key, value in subscription.items()
+                if key not in ("status", "current_period_end", "updated_at", "reminders_sent")
+            }
+            ops.append(UpdateOne(
+                {
+                    "telegram_user_id": subscription["telegram_user_id"],
+                    "status": "active",
+                    "plan_id": _plan_filter([_plan_of(subscription)])
+                },
+                {
+                    "$setOnInsert": on_insert,
+                    "$max": {"current_period_end": end_date},
+                    "$set": {"updated_at": now, "reminders_sent": []}
+                },
+                upsert=True
+            ))
+        result = await self.collection.bulk_write(ops, ordered=False)
+        self._changed()
+        return result.upserted_count, result.matched_count
+
+
+class MotorTransactionRepo(TransactionRepo):
+    def __init__(self, collection, archive):
+        self.collection = collection
+        self.archive = archive
+
+    async def get_by_session_id(self, stripe_session_id):
+        return await self.collection.find_one({"stripe_session_id": stripe_session_id}, {"_id": 0})
+
+    async def insert(self, transaction):
+        await self.collection.insert_one(transaction)
+        self._changed()
+
+    async def update_by_session_id(self, stripe_session_id, fields):
+        await self.collection.update_one({"stripe_session_id": stripe_session_id}, {"$set": fields})
+        self._changed()
+
+    async def recent_completed(self, limit, fields=None):
+        return await self.collection.find(
+            {"status": "completed"}, _projection(fields)
+        ).sort("created_at", DESCENDING).limit(limit).to_list(length=limit)
+
+    async def total_completed_revenue(self):
+        total_revenue = await self.collection.aggregate([
+            {"$match": {"status": "completed"}},
+            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+        ]).to_list(length=1)
+        return total_revenue[0]["total"] if total_revenue else 0
+
+    async def delete_abandoned(self, before):
+        result = await self.collection.delete_many({"status": "initiated", "updated_at": {"$lt": before}})
+        if result.deleted_count:
+            self._changed()
+        return result.deleted_count
+
+    async def archive_completed(self, before, limit):
+        docs = await self.collection.find(
+            {"status": "completed", "updated_at": {"$lt": before}}
+        ).sort("updated_at", ASCENDING).limit(limit).to_list(length=limit)
+        if not docs:
+            return 0, 0.0
+        await self.archive.bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in docs], ordered=False
+        )
+        await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        self._changed()
+        return len(docs), sum(doc["amount"] for doc in docs)
+
+
+class MotorAnalyticsRepo(AnalyticsRepo):
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.analytics_daily
+
+    async def rebuild_daily(self, since=None):
+        since_day = since.strftime("%Y-%m-%d") if since else ""
+        in_range = {"$gte": since} if since else {"$ne": None}
+        # Days are recomputed whole, so counters of the range start from zero
+        await self.collection.update_many(
+            {"_id": {"$gte": since_day}}, {"$set": {metric: 0 for metric in DAILY_METRICS}}
+        )
+        sources = [
+            (self.db.payment_transactions, {"status": "completed", "updated_at": in_range}, "$updated_at",
+             {"revenue": {"$sum": "$amount"}, "payments": {"$sum": 1}}),
+            (self.db.subscriptions, {"created_at": in_range}, "$created_at",
+             {"new_subscribers": {"$sum": 1}}),
+            # Dated by churned_at, which later writes don't move; rows churned before it existed fall back to updated_at
+            (self.db.subscriptions, {
+                "status": {"$in": list(CHURNED_STATUSES)},
+                "$or": [{"churned_at": in_range}, {"churned_at": None, "updated_at": in_range}]
+            }, {"$ifNull": ["$churned_at", "$updated_at"]},
+             {"churned_subscribers": {"$sum": 1}})
+        ]
+        for collection, match, date_field, metrics in sources:
+            await collection.aggregate([
+                {"$match": match},
+                {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": date_field}}, **metrics}},
+                {"$merge": {"into": "analytics_daily", "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}}
+            ]).to_list(length=None)
+
+    async def set_snapshot(self, day, fields):
+        await self.collection.update_one({"_id": day}, {"$set": fields}, upsert=True)
+
+    async def daily(self, start_day, end_day):
+        return await self.collection.find(
+            {"_id": {"$gte": start_day, "$lte": end_day}}
+        ).sort("_id", ASCENDING).to_list(length=None)
+
+
+class MotorPlanRepo(PlanRepo):
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def list(self):
+        return await self.collection.find({}, {"_id": 0}).to_list(length=None)
+
+    async def upsert(self, plan):
+        await self.collection.replace_one({"id": plan["id"]}, plan, upsert=True)
+        self._changed()
+
+
+class MotorStatusCheckRepo(StatusCheckRepo):
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def insert(self, status_check):
+        await self.collection.insert_one(status_check)
+
+    async def list(self, limit, before=None):
+        query = {}
+        if before:
+            timestamp, status_id = before
+            query = {"$or": [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "id": {"$lt": status_id}}
+            ]}
+        return await self.collection.find(
+            query, {"_id": 0, "id": 1, "client_name": 1, "timestamp": 1}
+        ).sort([("timestamp", DESCENDING), ("id", DESCENDING)]).limit(limit).to_list(length=limit)
+
+
+class MotorSyncStateRepo(SyncStateRepo):
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, key):
+        return await self.collection.find_one({"_id": key})
+
+    async def set(self, key, fields):
+        await self.collection.update_one({"_id": key}, {"$set": fields}, upsert=True)
+
+    async def increment(self, key, amounts):
+        await self.collection.update_one({"_id": key}, {"$inc": amounts}, upsert=True)
+
+    async def push(self, key, field, values):
+        await self.collection.update_one({"_id": key}, {"$push": {field: {"$each": values}}}, upsert=True)
+
+    async def take(self, key):
+        return await self.collection.find_one_and_delete({"_id": key})
+
+
+class MotorRateLimitRepo(RateLimitRepo):
+    """Sliding window approximated from the counts of the current and previous fixed windows
+
+    Every attempt is counted, rejected ones included, so one atomic update decides the hit.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def hit(self, key, limit, window_seconds):
+        now = time.time()
+        window = int(now // window_seconds)
+        elapsed = now / window_seconds - window
+        current = await self.collection.find_one_and_update(
+            {"_id": f"{key}:{window}"},
+            {
+                "$inc": {"count": 1},
+                "$setOnInsert": {"expires_at": datetime.utcfromtimestamp((window + 2) * window_seconds)}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        previous = await self.collection.find_one({"_id": f"{key}:{window - 1}"}, {"count": 1})
+        weighted = current["count"] + (previous["count"] if previous else 0) * (1 - elapsed)
+        if weighted <= limit:
+            return True, 0.0
+        return False, (1 - elapsed) * window_seconds
+
+
+class MotorRepositories(Repositories):
+    """Repositories backed by MongoDB through Motor"""
+
+    shared = True
+
+    def __init__(self, mongo_url: str, db_name: str, status_check_ttl_seconds: int = 7 * 86400):
+        self.status_check_ttl_seconds = status_check_ttl_seconds
+        self.client = AsyncIOMotorClient(mongo_url)
+        self.db = self.client[db_name]
+        self.users = MotorUserRepo(self.db.users)
+        self.subscriptions = MotorSubscriptionRepo(self.db.subscriptions)
+        self.transactions = MotorTransactionRepo(self.db.payment_transactions, self.db.payment_transactions_archive)
+        self.plans = MotorPlanRepo(self.db.plans)
+        self.analytics = MotorAnalyticsRepo(self.db)
+        self.status_checks = MotorStatusCheckRepo(self.db.status_checks)
+        self.sync_state = MotorSyncStateRepo(self.db.sync_state)
+        self.rate_limits = MotorRateLimitRepo(self.db.rate_limits)
+        self._track_changes()
+
+    async def ensure_indexes(self):
+        """Create the indexes used by lookups on the hot paths"""
+        await self.db.users.create_index([("telegram_user_id", ASCENDING)])
+        await self.db.users.create_index([("telegram_username", ASCENDING)])
+        await self.db.users.create_index([("id", ASCENDING)])
+        await self.db.subscriptions.create_index([("telegram_user_id", ASCENDING), ("status", ASCENDING)])
+        await self.db.subscriptions.create_index([("status", ASCENDING), ("current_period_end", ASCENDING)])
+        await self.db.subscriptions.create_index([("stripe_subscription_id", ASCENDING)])
+        await self.db.payment_transactions.create_index([("stripe_session_id", ASCENDING)])
+        await self.db.plans.create_index([("id", ASCENDING)], unique=True)
+        # Incremental analytics rebuilds scan by date
+        await self.db.payment_transactions.create_index([("status", ASCENDING), ("updated_at", ASCENDING)])
+        await self.db.subscriptions.create_index([("created_at", ASCENDING)])
+        await self.db.subscriptions.create_index([("status", ASCENDING), ("updated_at", ASCENDING)])
+        await self.db.subscriptions.create_index([("status", ASCENDING), ("churned_at", ASCENDING)])
+        # Status checks expire instead of growing without bound
+        await self.db.status_checks.create_index(
+            [("timestamp", ASCENDING)], expireAfterSeconds=self.status_check_ttl_seconds
+        )
+        await self.db.status_checks.create_index([("timestamp", DESCENDING), ("id", DESCENDING)])
+        await self.db.rate_limits.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+        # Latest write per collection, for change polling without change streams
+        for collection in self.tracked_collections():
+            await self.db[collection].create_index([("updated_at", DESCENDING)])
+
+    async def watch_changes(self, collections, resume_token=None):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(collections)}}}]
+        try:
+            async with self.db.watch(pipeline, resume_after=resume_token) as stream:
+                async for change in stream:
+                    yield change["ns"]["coll"], stream.resume_token
+        except OperationFailure as e:
+            if e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                raise ChangeStreamUnsupported(str(e))
+            if e.code in CHANGE_STREAM_HISTORY_LOST_CODES:
+                raise ChangeStreamHistoryLost(str(e))
+            raise
+
+    async def change_signatures(self, collections):
+        signatures = {}
+        for collection in collections:
+            latest = await self.db[collection].find_one(
+                {}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", DESCENDING)]
+            )
+            count = await self.db[collection].estimated_document_count()
+            signatures[collection] = (count, latest.get("updated_at") if latest else None)
+        return signatures
+
+    def close(self):
+        self.client.close()
+
+
+# In-memory implementation, indexed on the same keys as the Mongo indexes
+class InMemoryUserRepo(UserRepo):
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+        self.by_telegram_id: Dict[int, str] = {}
+        self.by_username: Dict[str, str] = {}
+
+    def _store(self, user):
+        user = _copy(user)
+        self.docs[user["id"]] = user
+        self.by_telegram_id[user["telegram_user_id"]] = user["id"]
+        if user.get("telegram_username"):
+            self.by_username[user["telegram_username"]] = user["id"]
+        self._changed()
+
+    async def get_by_id(self, user_id):
+        return _copy(self.docs.get(user_id))
+
+    async def get_by_telegram_id(self, telegram_user_id):
+        return _copy(self.docs.get(self.by_telegram_id.get(telegram_user_id)))
+
+    async def find_by_ids(self, user_ids, fields=None):
+        return [_select(self.docs[user_id], fields) for user_id in user_ids if user_id in self.docs]
+
+    async def get_by_username(self, telegram_username):
+        return _copy(self.docs.get(self.by_username.get(telegram_username)))
+
+    async def find_by_telegram_ids_or_usernames(self, telegram_user_ids, usernames):
+        ids = {self.by_telegram_id[key] for key in telegram_user_ids if key in self.by_telegram_id}
+        ids.update(self.by_username[key] for key in usernames if key in self.by_username)
+        return [_copy(self.docs[user_id]) for user_id in ids]
+
+    async def insert(self, user):
+        self._store(user)
+
+    async def insert_missing(self, users):
+        for user in users:
+            if user["telegram_user_id"] not in self.by_telegram_id:
+                self._store(user)
+
+    async def set_email(self, user_id, email):
+        if user_id in self.docs:
+            self.docs[user_id].update(email=email, updated_at=datetime.utcnow())
+            self._changed()
+
+    async def set_emails(self, emails):
+        now = datetime.utcnow()
+        for user_id, email in emails:
+            if user_id in self.docs:
+                self.docs[user_id].update(email=email, updated_at=now)
+        if emails:
+            self._changed()
+
+    async def count(self):
+        return len(self.docs)
+
+
+class InMemorySubscriptionRepo(SubscriptionRepo):
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+        self.by_stripe_id: Dict[str, str] = {}
+        self.by_telegram_id: Dict[int, set] = {}
+        self.by_status: Dict[str, set] = {}
+
+    def _index(self, doc):
+        self._changed()
+        if doc.get("stripe_subscription_id"):
+            self.by_stripe_id[doc["stripe_subscription_id"]] = doc["id"]
+        self.by_telegram_id.setdefault(doc["telegram_user_id"], set()).add(doc["id"])
+        self.by_status.setdefault(doc["status"], set()).add(doc["id"])
+
+    def _set(self, doc, fields):
+        if "status" in fields and fields["status"] != doc["status"]:
+            self.by_status[doc["status"]].discard(doc["id"])
+            self.by_status.setdefault(fields["status"], set()).add(doc["id"])
+        doc.update(_copy(fields))
+        self._changed()
+
+    def _with_status(self, status) -> Iterable[Dict]:
+        return (self.docs[sub_id] for sub_id in self.by_status.get(status, ()))
+
+    async def get_active(self, telegram_user_id, plan_ids=None):
+        for sub_id in self.by_telegram_id.get(telegram_user_id, ()):
+            doc = self.docs[sub_id]
+            if doc["status"] == "active" and (plan_ids is None or _plan_of(doc) in plan_ids):
+                return _copy(doc)
+        return None
+
+    async def get_by_stripe_id(self, stripe_subscription_id):
+        return _copy(self.docs.get(self.by_stripe_id.get(stripe_subscription_id)))
+
+    async def find_by_stripe_ids(self, stripe_subscription_ids, fields=None):
+        return [
+            _select(self.docs[self.by_stripe_id[stripe_id]], fields)
+            for stripe_id in stripe_subscription_ids if stripe_id in self.by_stripe_id
+        ]
+
+    async def find_active(self, fields=None):
+        return [_select(doc, fields) for doc in self._with_status("active")]
+
+    async def recent_active(self, limit):
+        docs = sorted(self._with_status("active"), key=lambda doc: doc["created_at"], reverse=True)
+        return [_copy(doc) for doc in docs[:limit]]
+
+    async def find_expired(self, now):
+        return [_copy(doc) for doc in self._with_status("active") if doc["current_period_end"] < now]
+
+    async def find_due_for_reminder(self, start, end, marker, limit):
+        due = []
+        for doc in self._with_status("active"):
+            if start < doc["current_period_end"] <= end and marker not in doc.get("reminders_sent", ()):
+                due.append(_copy(doc))
+                if len(due) >= limit:
+                    break
+        return due
+
+    async def add_reminder_markers(self, subscription_ids, markers):
+        for sub_id in subscription_ids:
+            sent = self.docs[sub_id].setdefault("reminders_sent", [])
+            sent.extend(marker for marker in markers if marker not in sent)
+
+    async def oldest_stripe_created_at(self):
+        created = [doc["created_at"] for doc in self.docs.values() if doc.get("stripe_subscription_id")]
+        return min(created) if created else None
+
+    async def count_by_status(self, status):
+        return len(self.by_status.get(status, ()))
+
+    async def active_members_by_plan(self):
+        members: Dict[str, set] = {}
+        for doc in self._with_status("active"):
+            members.setdefault(_plan_of(doc), set()).add(doc["telegram_user_id"])
+        return members
+
+    async def active_totals_by_plan(self):
+        totals: Dict[str, Tuple[int, float]] = {}
+        for doc in self._with_status("active"):
+            count, amount = totals.get(_plan_of(doc), (0, 0.0))
+            totals[_plan_of(doc)] = (count + 1, amount + doc["amount"])
+        return totals
+
+    async def insert(self, subscription):
+        subscription = _copy(subscription)
+        self.docs[subscription["id"]] = subscription
+        self._index(subscription)
+
+    async def update(self, subscription_id, fields):
+        if subscription_id in self.docs:
+            self._set(self.docs[subscription_id], fields)
+
+    async def update_by_stripe_id(self, stripe_subscription_id, fields):
+        await self.update(self.by_stripe_id.get(stripe_subscription_id), fields)
+
+    async def bulk_update_by_stripe_id(self, updates):
+        modified = 0
+        for stripe_id, fields in updates:
+            doc = self.docs.get(self.by_stripe_id.get(stripe_id))
+            if doc is not None and any(doc.get(key) != value for key, value in fields.items()):
+                self._set(doc, fields)
+                modified += 1
+        return modified
+
+    async def insert_missing_by_stripe_id(self, subscriptions):
+        inserted = 0
+        for subscription in subscriptions:
+            if subscription["stripe_subscription_id"] not in self.by_stripe_id:
+                await self.insert(subscription)
+                inserted += 1
+        return inserted
+
+    async def grant_active(self, grants, now):
+        created = extended = 0
+        for subscription, end_date in grants:
+            existing = await self.get_active(subscription["telegram_user_id"], [_plan_of(subscription)])
+            if existing is None:
+                await self.insert(dict(
+                    subscription, status="active", current_period_end=end_date,
+                    updated_at=now, reminders_sent=[]
+                ))
+                created += 1
+            else:
+                doc = self.docs[existing["id"]]
+                self._set(doc, {
+                    "current_period_end": max(doc["current_period_end"], end_date),
+                    "updated_at": now,
+                    "reminders_sent": []
+                })
+                extended += 1
+        return created, extended
+
+
+class InMemoryTransactionRepo(TransactionRepo):
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+        self.by_session_id: Dict[str, str] = {}
+        self.archive: Dict[str, Dict] = {}
+
+    async def get_by_session_id(self, stripe_session_id):
+        return _copy(self.docs.get(self.by_session_id.get(stripe_session_id)))
+
+    async def insert(self, transaction):
+        transaction = _copy(transaction)
+        self.docs[transaction["id"]] = transaction
+        if transaction.get("stripe_session_id"):
+            self.by_session_id[transaction["stripe_session_id"]] = transaction["id"]
+        self._changed()
+
+    async def update_by_session_id(self, stripe_session_id, fields):
+        doc = self.docs.get(self.by_session_id.get(stripe_session_id))
+        if doc is not None:
+            doc.update(_copy(fields))
+            self._changed()
+
+    async def recent_completed(self, limit, fields=None):
+        completed = [doc for doc in self.docs.values() if doc["status"] == "completed"]
+        completed.sort(key=lambda doc: doc["created_at"], reverse=True)
+        return [_select(doc, fields) for doc in completed[:limit]]
+
+    async def total_completed_revenue(self):
+        return sum(doc["amount"] for doc in self.docs.values() if doc["status"] == "completed")
+
+    async def delete_abandoned(self, before):
+        abandoned = [
+            doc for doc in self.docs.values() if doc["status"] == "initiated" and doc["updated_at"] < before
+        ]
+        for doc in abandoned:
+            self._remove(doc)
+        if abandoned:
+            self._changed()
+        return len(abandoned)
+
+    async def archive_completed(self, before, limit):
+        old = sorted(
+            (doc for doc in self.docs.values() if doc["status"] == "completed" and doc["updated_at"] < before),
+            key=lambda doc: doc["updated_at"]
+        )[:limit]
+        for doc in old:
+            self.archive[doc["id"]] = doc
+            self._remove(doc)
+        if old:
+            self._changed()
+        return len(old), sum(doc["amount"] for doc in old)
+
+    def _remove(self, doc):
+        del self.docs[doc["id"]]
+        if self.by_session_id.get(doc.get("stripe_session_id")) == doc["id"]:
+            del self.by_session_id[doc["stripe_session_id"]]
+
+
+class InMemoryAnalyticsRepo(AnalyticsRepo):
+    def __init__(self, subscriptions: InMemorySubscriptionRepo, transactions: InMemoryTransactionRepo):
+        self.subscriptions = subscriptions
+        self.transactions = transactions
+        self.docs: Dict[str, Dict] = {}
+
+    async def rebuild_daily(self, since=None):
+        since_day = since.strftime("%Y-%m-%d") if since else ""
+        for day, doc in self.docs.items():
+            if day >= since_day:
+                doc.update({metric: 0 for metric in DAILY_METRICS})
+
+        def add(moment, **metrics):
+            if moment is None or (since and moment < since):
+                return
+            doc = self.docs.setdefault(moment.strftime("%Y-%m-%d"), {"_id": moment.strftime("%Y-%m-%d")})
+            for metric, value in metrics.items():
+                doc[metric] = doc.get(metric, 0) + value
+
+        for doc in self.transactions.docs.values():
+            if doc["status"] == "completed":
+                add(doc.get("updated_at"), revenue=doc["amount"], payments=1)
+        for doc in self.subscriptions.docs.values():
+            add(doc.get("created_at"), new_subscribers=1)
+            if doc["status"] in CHURNED_STATUSES:
+                add(doc.get("churned_at") or doc.get("updated_at"), churned_subscribers=1)
+
+    async def set_snapshot(self, day, fields):
+        self.docs.setdefault(day, {"_id": day}).update(_copy(fields))
+
+    async def daily(self, start_day, end_day):
+        return [_copy(self.docs[day]) for day in sorted(self.docs) if start_day <= day <= end_day]
+
+
+class InMemoryPlanRepo(PlanRepo):
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+
+    async def list(self):
+        return [_copy(doc) for doc in self.docs.values()]
+
+    async def upsert(self, plan):
+        self.docs[plan["id"]] = _copy(plan)
+        self._changed()
+
+
+class InMemoryStatusCheckRepo(StatusCheckRepo):
+    def __init__(self, ttl_seconds: int, max_items: int = 10000):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.docs: deque = deque(maxlen=max_items)
+
+    async def insert(self, status_check):
+        self.docs.append(_copy(status_check))
+        expire_before = datetime.utcnow() - self.ttl
+        while self.docs and self.docs[0]["timestamp"] < expire_before:
+            self.docs.popleft()
+
+    async def list(self, limit, before=None):
+        result = []
+        for doc in reversed(self.docs):
+            if before and (doc["timestamp"], doc["id"]) >= before:
+                continue
+            result.append(_copy(doc))
+            if len(result) >= limit:
+                break
+        return result
+
+
+class InMemorySyncStateRepo(SyncStateRepo):
+    def __init__(self):
+        self.docs: Dict[str, Dict] = {}
+
+    async def get(self, key):
+        return _copy(self.docs.get(key))
+
+    async def set(self, key, fields):
+        self.docs.setdefault(key, {"_id": key}).update(_copy(fields))
+
+    async def increment(self, key, amounts):
+        doc = self.docs.setdefault(key, {"_id": key})
+        for field, amount in amounts.items():
+            doc[field] = doc.get(field, 0) + amount
+
+    async def push(self, key, field, values):
+        self.docs.setdefault(key, {"_id": key}).setdefault(field, []).extend(values)
+
+    async def take(self, key):
+        return self.docs.pop(key, None)
+
+
+class InMemoryRateLimitRepo(RateLimitRepo):
+    """Exact sliding log of allowed hits per key; idle keys are evicted least recently used first"""
+
+    def __init__(self):
+        self.logs: "OrderedDict[str, Tuple[float, deque]]" = OrderedDict()
+
+    def _evict_idle(self, now: float):
+        while self.logs:
+            window_seconds, log = next(iter(self.logs.values()))
+            if log and log[-1] > now - window_seconds:
+                break
+            self.logs.popitem(last=False)
+
+    async def hit(self, key, limit, window_seconds):
+        now = time.monotonic()
+        entry = self.logs.get(key)
+        if entry is None:
+            entry = self.logs[key] = (window_seconds, deque())
+        else:
+            self.logs.move_to_end(key)
+        log = entry[1]
+        while log and log[0] <= now - window_seconds:
+            log.popleft()
+        if len(log) >= limit:
+            return False, log[len(log) - limit] + window_seconds - now
+        log.append(now)
+        self._evict_idle(now)
+        return True, 0.0
+
+
+class InMemoryRepositories(Repositories):
+    """Process-local repositories for tests, benchmarks and running without MongoDB"""
+
+    def __init__(self, status_check_ttl_seconds: int = 7 * 86400):
+        self.users = InMemoryUserRepo()
+        self.subscriptions = InMemorySubscriptionRepo()
+        self.transactions = InMemoryTransactionRepo()
+        self.plans = InMemoryPlanRepo()
+        self.analytics = InMemoryAnalyticsRepo(self.subscriptions, self.transactions)
+        self.status_checks = InMemoryStatusCheckRepo(status_check_ttl_seconds)
+        self.sync_state = InMemorySyncStateRepo()
+        self.rate_limits = InMemoryRateLimitRepo()
+        self._track_changes()
+
+
+def create_repositories(
+    backend: str,
+    mongo_url: Optional[str] = None,
+    db_name: Optional[str] = None,
+    status_check_ttl_seconds: int = 7 * 86400
+) -> Repositories:
+    """Build the repositories for the configured STORAGE_BACKEND"""
+    if backend == "memory":
+        return InMemoryRepositories(status_check_ttl_seconds)
+    if backend == "mongo":
+        if not mongo_url or not db_name:
+            raise ValueError("MONGO_URL and DB_NAME are required for the mongo storage backend")
+        return MotorRepositories(mongo_url, db_name, status_check_ttl_seconds)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -1,31 +1,63 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Header, Query, Depends
+from fastapi import Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.middleware.gzip import GZipMiddleware
+from repositories import create_repositories, ChangeStreamUnsupported, ChangeStreamHistoryLost, DEFAULT_PLAN_ID
+from repositories import InMemoryRateLimitRepo, CHURNED_STATUSES
+from telegram_client import ResilientBot, CircuitBreaker, CircuitOpenError, PerUserUpdateProcessor
+from rate_limit import RateLimiter, parse_rule
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Tuple
 import uuid
-from datetime import datetime, timedelta
+import csv
+import codecs
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from email.utils import format_datetime, parsedate_to_datetime
 import asyncio
+import functools
+import hmac
 import threading
+import time
 import stripe
-from telegram import Bot
+from telegram import Bot, ChatMember, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import ChatJoinRequestHandler, ChatMemberHandler, TypeHandler, ApplicationHandlerStop
 from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.triggers.cron import CronTrigger
 import json
+import itertools
+import orjson
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # brotli is optional; fall back to gzip only
+    BrotliMiddleware = None
+
+IMPORT_STARTED = time.perf_counter()
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Storage: "mongo" (default) or "memory" for running without MongoDB
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+# Status checks from uptime probes are kept for this long (TTL index)
+STATUS_CHECK_TTL_SECONDS = int(os.environ.get('STATUS_CHECK_TTL_SECONDS', str(7 * 86400)))
+repos = create_repositories(
+    STORAGE_BACKEND,
+    os.environ.get('MONGO_URL'),
+    os.environ.get('DB_NAME'),
+    status_check_ttl_seconds=STATUS_CHECK_TTL_SECONDS
+)
 
 # Configure Stripe
 stripe.api_key = os.environ['STRIPE_SECRET_KEY']
@@ -40,18 +72,181 @@ CURRENCY = os.environ['CURRENCY']
 ADMIN_USER_IDS = [int(user_id) for user_id in os.environ['ADMIN_USER_IDS'].split(',')]
 DOMAIN = os.environ['DOMAIN']
 
-# Create the main app without a prefix
-app = FastAPI()
+# Bulk import settings
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '500'))
+
+# Stripe reconciliation settings
+RECONCILE_INTERVAL_MINUTES = int(os.environ.get('RECONCILE_INTERVAL_MINUTES', '30'))
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '8'))
+RECONCILE_OVERLAP_SECONDS = int(os.environ.get('RECONCILE_OVERLAP_SECONDS', '3600'))
+# Stripe keeps events for 30 days; older watermarks fall back to a full run
+STRIPE_EVENT_RETENTION_SECONDS = 30 * 86400
+
+# Renewal reminder settings
+REMINDER_WINDOWS_DAYS = sorted(
+    {int(days) for days in os.environ.get('REMINDER_WINDOWS_DAYS', '3,1').split(',') if days.strip()},
+    reverse=True
+)
+REMINDER_INTERVAL_MINUTES = int(os.environ.get('REMINDER_INTERVAL_MINUTES', '15'))
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '500'))
+
+# Retention: abandoned checkouts are dropped once their Stripe session has expired (24h),
+# completed transactions move to payment_transactions_archive after TRANSACTION_ARCHIVE_DAYS (0 keeps them)
+TRANSACTION_ABANDONED_HOURS = int(os.environ.get('TRANSACTION_ABANDONED_HOURS', '25'))
+TRANSACTION_ARCHIVE_DAYS = int(os.environ.get('TRANSACTION_ARCHIVE_DAYS', '365'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '1000'))
+RETENTION_INTERVAL_MINUTES = int(os.environ.get('RETENTION_INTERVAL_MINUTES', '60'))
+
+# Analytics: incremental refresh interval and the UTC hour of the nightly full rebuild
+ANALYTICS_REFRESH_MINUTES = int(os.environ.get('ANALYTICS_REFRESH_MINUTES', '15'))
+ANALYTICS_REBUILD_HOUR = int(os.environ.get('ANALYTICS_REBUILD_HOUR', '3'))
+
+# Outbound notification throttling (Telegram allows ~30 messages/second per bot)
+NOTIFICATION_RATE_PER_SECOND = float(os.environ.get('NOTIFICATION_RATE_PER_SECOND', '25'))
+
+# Live dashboard events (server-sent events)
+DASHBOARD_QUEUE_SIZE = int(os.environ.get('DASHBOARD_QUEUE_SIZE', '100'))
+DASHBOARD_HEARTBEAT_SECONDS = float(os.environ.get('DASHBOARD_HEARTBEAT_SECONDS', '15'))
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get('COMPRESSION_MINIMUM_SIZE', '1024'))
+
+# Background startup: retries for the Telegram connection
+TELEGRAM_INIT_ATTEMPTS = int(os.environ.get('TELEGRAM_INIT_ATTEMPTS', '5'))
+
+# Expiry sweep: subscriptions removed from their groups in parallel
+EXPIRY_CONCURRENCY = int(os.environ.get('EXPIRY_CONCURRENCY', '10'))
+
+# Cross-process cache invalidation: polling interval without change streams, resume token save interval
+CHANGE_POLL_SECONDS = float(os.environ.get('CHANGE_POLL_SECONDS', '5'))
+CHANGE_CHECKPOINT_SECONDS = float(os.environ.get('CHANGE_CHECKPOINT_SECONDS', '5'))
+
+# Telegram client: connection pool, timeouts (per method as "method=seconds,..."), retries and circuit breaker
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '32'))
+TELEGRAM_TIMEOUT_SECONDS = float(os.environ.get('TELEGRAM_TIMEOUT_SECONDS', '5'))
+TELEGRAM_METHOD_TIMEOUTS = {
+    method: float(seconds)
+    for method, seconds in (
+        item.split('=') for item in os.environ.get(
+            'TELEGRAM_METHOD_TIMEOUTS', 'send_message=10,create_chat_invite_link=5,ban_chat_member=5,unban_chat_member=5'
+        ).split(',') if item
+    )
+}
+TELEGRAM_MAX_ATTEMPTS = int(os.environ.get('TELEGRAM_MAX_ATTEMPTS', '3'))
+TELEGRAM_BREAKER_FAILURES = int(os.environ.get('TELEGRAM_BREAKER_FAILURES', '5'))
+TELEGRAM_BREAKER_RESET_SECONDS = float(os.environ.get('TELEGRAM_BREAKER_RESET_SECONDS', '30'))
+
+# Payment status checks: Stripe lookups for sessions without a recorded outcome are cached this long,
+# the bot waits this long for the webhook on payment return, and long-polling requests at most this long
+PAYMENT_STATUS_CACHE_SECONDS = float(os.environ.get('PAYMENT_STATUS_CACHE_SECONDS', '10'))
+PAYMENT_RETURN_WAIT_SECONDS = float(os.environ.get('PAYMENT_RETURN_WAIT_SECONDS', '5'))
+PAYMENT_LONG_POLL_SECONDS = float(os.environ.get('PAYMENT_LONG_POLL_SECONDS', '25'))
+
+# Shutdown: how long running jobs, webhooks and queued notifications get to finish before connections close
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', '20'))
+# Callers of POST /api/admin/drain other than loopback (the pod's own pre-stop hook) must send this in X-Drain-Token
+DRAIN_TOKEN = os.environ.get('DRAIN_TOKEN', '')
+
+# Update handling: users served concurrently (1 handles updates one at a time), queued updates per user
+TELEGRAM_CONCURRENT_UPDATES = int(os.environ.get('TELEGRAM_CONCURRENT_UPDATES', '16'))
+TELEGRAM_PENDING_UPDATES_PER_USER = int(os.environ.get('TELEGRAM_PENDING_UPDATES_PER_USER', '20'))
+
+# Group membership: lifetime of personal invite links, delay before reloading members after remote changes
+INVITE_LINK_TTL_HOURS = int(os.environ.get('INVITE_LINK_TTL_HOURS', '24'))
+ACTIVE_MEMBERS_RELOAD_SECONDS = float(os.environ.get('ACTIVE_MEMBERS_RELOAD_SECONDS', '2'))
+
+# Rate limits as "limit/seconds" (0 disables): bot updates and checkout attempts per Telegram user,
+# public API requests per client IP; RATE_LIMIT_SHARED keeps the counters in Mongo for all replicas
+RATE_LIMIT_RULES = {
+    "bot": parse_rule(os.environ.get('RATE_LIMIT_BOT', '20/60')),
+    "checkout": parse_rule(os.environ.get('RATE_LIMIT_CHECKOUT', '5/600')),
+    "api": parse_rule(os.environ.get('RATE_LIMIT_API', '60/60'))
+}
+RATE_LIMIT_SHARED = os.environ.get('RATE_LIMIT_SHARED', 'false').lower() == 'true'
+# Only enable behind an ingress that appends to X-Forwarded-For; the last hop is then the client IP
+TRUST_FORWARDED_FOR = os.environ.get('TRUST_FORWARDED_FOR', 'false').lower() == 'true'
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Bot instance
-bot = Bot(token=BOT_TOKEN)
+# Admin dashboard routes, mounted under /api/admin; large payloads are rendered with orjson
+admin_router = APIRouter(prefix="/admin", default_response_class=ORJSONResponse)
+
+# Bot instance, shared with the Application; `bot` adds retries and the circuit breaker
+telegram_bot = Bot(
+    token=BOT_TOKEN,
+    request=HTTPXRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        connect_timeout=TELEGRAM_TIMEOUT_SECONDS,
+        read_timeout=TELEGRAM_TIMEOUT_SECONDS,
+        write_timeout=TELEGRAM_TIMEOUT_SECONDS,
+        pool_timeout=TELEGRAM_TIMEOUT_SECONDS
+    )
+)
+bot = ResilientBot(
+    telegram_bot,
+    CircuitBreaker(TELEGRAM_BREAKER_FAILURES, TELEGRAM_BREAKER_RESET_SECONDS),
+    method_timeouts=TELEGRAM_METHOD_TIMEOUTS,
+    default_timeout=TELEGRAM_TIMEOUT_SECONDS,
+    max_attempts=TELEGRAM_MAX_ATTEMPTS,
+    # Non-critical messages wait in the notification queue while Telegram is failing
+    defer=lambda chat_id, text: enqueue_notification(chat_id, text)
+)
 
 # Scheduler for subscription checks
 scheduler = AsyncIOScheduler()
 
+# Drops excess bot updates and API requests before they reach storage or Stripe
+local_rate_limits = InMemoryRateLimitRepo()
+rate_limiter = RateLimiter(
+    RATE_LIMIT_RULES,
+    repos.rate_limits if RATE_LIMIT_SHARED else local_rate_limits,
+    fallback=local_rate_limits
+)
+
+# Prevents overlapping reconciliation runs
+reconcile_lock = asyncio.Lock()
+
+# Queue of outbound Telegram messages (chat_id, text) sent by notification_worker
+notification_queue: asyncio.Queue = asyncio.Queue()
+
+# Cached Stripe product and price used for checkout sessions
+stripe_catalog: Dict[str, object] = {}
+
+# Last rendered admin payload per route as (etag, body), reused while the data is unchanged
+admin_response_cache: Dict[str, Tuple[str, bytes]] = {}
+
+# One queue of encoded SSE messages per connected dashboard
+dashboard_clients: set = set()
+dashboard_event_ids = itertools.count(1)
+
+# Telegram user ids with an active subscription per group id, checked on every join
+active_members: Dict[int, set] = {}
+active_members_loaded = False
+active_members_reload: Optional[asyncio.Task] = None
+
+# Personal single-use invite links per (Telegram user, group) as (link, expires_at)
+invite_links: Dict[Tuple[int, int], Tuple[str, datetime]] = {}
+
+# Checkout sessions looked up in Stripe as (fields, expires_at monotonic)
+payment_status_cache: Dict[str, Tuple[Dict, float]] = {}
+
+# Set and replaced on every payment_transactions change, waking long-polling payment checks
+payment_changed = asyncio.Event()
+
+# Startup state and timing of each service, reported by the health endpoints
+startup_report: Dict[str, Dict] = {}
+
+# Set on shutdown: webhooks are refused (Stripe retries them) and sweeps stop taking new work
+shutting_down = False
+
+# Set when draining starts, closing dashboard event streams; drain_task runs the drain once
+drain_started = asyncio.Event()
+drain_task: Optional[asyncio.Task] = None
+
+# Running webhook handlers and scheduled jobs by task, awaited on shutdown
+in_flight_work: Dict[asyncio.Task, str] = {}
+
 # Define Models
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -80,12 +275,14 @@ class Subscription(BaseModel):
     stripe_product_id: Optional[str] = None
     stripe_price_id: Optional[str] = None
     status: str = "pending"  # pending, active, canceled, expired
+    plan_id: str = DEFAULT_PLAN_ID
     amount: float
     currency: str
     current_period_start: Optional[datetime] = None
     current_period_end: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    churned_at: Optional[datetime] = None  # when it became expired or canceled; dates churn in analytics
 
 class PaymentTransaction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -104,8 +301,182 @@ class ManualSubscriptionAdd(BaseModel):
     telegram_username: str
     email: str
     duration_days: int = 30
+    plan_id: str = DEFAULT_PLAN_ID
+
+class Plan(BaseModel):
+    id: str
+    name: str
+    stripe_price_id: Optional[str] = None
+    group_id: int
+    invite_link: Optional[str] = None
+    amount: float
+    currency: str
+    days: int = Field(default=30, ge=1)
+    active: bool = True  # inactive plans keep their subscribers but are not offered
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class SubscriberOut(BaseModel):
+    id: str
+    telegram_user_id: int
+    telegram_username: Optional[str] = None
+    email: Optional[str] = None
+    current_period_end: Optional[datetime] = None
+    created_at: datetime
+    plan_id: str = DEFAULT_PLAN_ID
+    amount: float
+    currency: str
+
+class SubscribersResponse(BaseModel):
+    subscribers: List[SubscriberOut]
+
+class TransactionOut(BaseModel):
+    id: str
+    telegram_user_id: int
+    amount: float
+    currency: str
+    status: str
+    created_at: datetime
+
+class AdminStatsResponse(BaseModel):
+    total_users: int
+    active_subscriptions: int
+    expired_subscriptions: int
+    canceled_subscriptions: int
+    total_revenue: float
+    recent_transactions: List[TransactionOut]
+
+class AnalyticsBucket(BaseModel):
+    start: str
+    revenue: float = 0
+    payments: int = 0
+    new_subscribers: int = 0
+    churned_subscribers: int = 0
+    mrr: Optional[float] = None  # last snapshot within the bucket
+    active_subscribers: Optional[int] = None
+
+class AnalyticsResponse(BaseModel):
+    period: str
+    mrr: Optional[float] = None
+    active_subscribers: Optional[int] = None
+    refreshed_at: Optional[datetime] = None
+    buckets: List[AnalyticsBucket]
+
+# Fields read from Mongo for the admin responses
+SUBSCRIBER_FIELDS = ["id", "user_id", "telegram_user_id", "current_period_end", "created_at", "plan_id", "amount", "currency"]
+TRANSACTION_FIELDS = list(TransactionOut.model_fields)
+# Reconciliation compares periods and, for members it removes, needs the subscriber row
+RECONCILE_FIELDS = SUBSCRIBER_FIELDS + ["stripe_subscription_id", "status", "current_period_start"]
+
+# Stripe statuses that end access, like the cancellation webhook; past_due keeps it while Stripe retries the card
+LAPSED_STATUSES = ("canceled", "unpaid", "incomplete_expired")
+
+class SubscriberImportRow(BaseModel):
+    telegram_user_id: Optional[int] = None
+    telegram_username: Optional[str] = None
+    email: Optional[str] = None
+    duration_days: int = Field(default=30, ge=1)
+    current_period_end: Optional[datetime] = None
+    plan_id: str = DEFAULT_PLAN_ID
+
+    @model_validator(mode="after")
+    def check_identity(self):
+        if self.telegram_username:
+            self.telegram_username = self.telegram_username.lstrip("@").strip() or None
+        if self.email is not None:
+            self.email = self.email.strip() or None
+        if self.telegram_user_id is None and not self.telegram_username:
+            raise ValueError("telegram_user_id or telegram_username is required")
+        return self
+
+    @model_validator(mode="after")
+    def check_period_end(self):
+        if self.current_period_end is not None:
+            if self.current_period_end.tzinfo is not None:
+                self.current_period_end = self.current_period_end.astimezone(timezone.utc).replace(tzinfo=None)
+            # An already ended period would be granted and kicked by the next expiry sweep
+            if self.current_period_end <= datetime.utcnow():
+                raise ValueError("current_period_end must be in the future")
+        return self
+
+class PlanRegistry:
+    """Subscription plans indexed by id, Stripe price id and group id"""
+
+    def __init__(self):
+        self.by_id: Dict[str, Dict] = {}
+        self.by_price_id: Dict[str, Dict] = {}
+        self.by_group_id: Dict[int, List[Dict]] = {}
+
+    def load(self, plans: List[Dict]):
+        by_group_id: Dict[int, List[Dict]] = {}
+        for plan in plans:
+            by_group_id.setdefault(plan["group_id"], []).append(plan)
+        self.by_id = {plan["id"]: plan for plan in plans}
+        self.by_price_id = {plan["stripe_price_id"]: plan for plan in plans if plan.get("stripe_price_id")}
+        self.by_group_id = by_group_id
+
+    def get(self, plan_id: Optional[str]) -> Dict:
+        """Plan by id; unknown ids resolve to the default plan"""
+        return self.by_id.get(plan_id or DEFAULT_PLAN_ID) or self.by_id[DEFAULT_PLAN_ID]
+
+    def for_subscription(self, subscription: Dict) -> Dict:
+        return self.get(subscription.get("plan_id"))
+
+    def for_price(self, price_id: Optional[str]) -> Dict:
+        """Plan sold at a Stripe price; the default plan owns the catalog price"""
+        return self.by_price_id.get(price_id) or self.by_id[DEFAULT_PLAN_ID]
+
+    def plan_ids_for_group(self, group_id: int) -> List[str]:
+        return [plan["id"] for plan in self.by_group_id.get(group_id, ())]
+
+    def offered(self) -> List[Dict]:
+        return [plan for plan in self.by_id.values() if plan.get("active", True)]
+
+# Plans loaded from the plans collection plus the default plan from the environment
+plan_registry = PlanRegistry()
+
+def default_plan() -> Dict:
+    """The single plan configured through GROUP_ID, SUBSCRIPTION_PRICE etc."""
+    return {
+        "id": DEFAULT_PLAN_ID,
+        "name": "Monthly Subscription",
+        "stripe_price_id": None,
+        "group_id": GROUP_ID,
+        "invite_link": GROUP_INVITE_LINK,
+        "amount": SUBSCRIPTION_PRICE,
+        "currency": CURRENCY,
+        "days": SUBSCRIPTION_DAYS,
+        "active": True
+    }
+
+plan_registry.load([default_plan()])
+
+async def reload_plans():
+    """Rebuild the plan registry from the plans collection"""
+    plans = await repos.plans.list()
+    if not any(plan["id"] == DEFAULT_PLAN_ID for plan in plans):
+        plans.append(default_plan())
+    plan_registry.load(plans)
 
 # Telegram Bot Handlers
+async def rate_limit_update(update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop handling messages and button presses from users over their rate limit"""
+    user = update.effective_user
+    if user is None or user.id in ADMIN_USER_IDS or not (update.message or update.callback_query):
+        return
+    
+    allowed, _ = await rate_limiter.hit("bot", user.id)
+    query = update.callback_query
+    if allowed and query and query.data and query.data.startswith("subscribe"):
+        # Every checkout attempt creates a Stripe session
+        allowed, _ = await rate_limiter.hit("checkout", user.id)
+    if allowed:
+        return
+    
+    if query:
+        # Unanswered callbacks leave the button spinning
+        await query.answer("⏳ Забагато запитів. Спробуйте пізніше.")
+    raise ApplicationHandlerStop
+
 async def start_command(update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
@@ -128,7 +499,7 @@ async def start_command(update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     # Check if user already exists
-    existing_user = await db.users.find_one({"telegram_user_id": telegram_user_id})
+    existing_user = await repos.users.get_by_telegram_id(telegram_user_id)
     if not existing_user:
         # Create new user
         new_user = User(
@@ -138,23 +509,33 @@ async def start_command(update, context: ContextTypes.DEFAULT_TYPE):
             last_name=user.last_name,
             is_admin=telegram_user_id in ADMIN_USER_IDS
         )
-        await db.users.insert_one(new_user.dict())
+        await repos.users.insert(new_user.dict())
+        publish_dashboard_event("user.created", {"stats": {"total_users": 1}})
     
     # Check subscription status
-    subscription = await db.subscriptions.find_one(
-        {"telegram_user_id": telegram_user_id, "status": "active"}
-    )
+    subscription = await repos.subscriptions.get_active(telegram_user_id)
     
     if subscription:
+        invite_link = await get_invite_link(telegram_user_id, plan_registry.for_subscription(subscription))
         await update.message.reply_text(
             f"✅ Привіт! У вас є активна підписка до {subscription['current_period_end'].strftime('%d.%m.%Y')}\n\n"
-            f"Ви можете приєднатися до групи: {GROUP_INVITE_LINK}"
+            f"Ви можете приєднатися до групи: {invite_link}"
         )
     else:
+        offered = plan_registry.offered()
+        if len(offered) == 1:
+            plan = offered[0]
+            prices = (
+                f"💰 Вартість місячної підписки: {plan['amount']} {plan['currency']}\n"
+                f"📅 Тривалість: {plan['days']} днів\n\n"
+            )
+        else:
+            prices = "".join(
+                f"💰 {plan['name']}: {plan['amount']} {plan['currency']} / {plan['days']} днів\n" for plan in offered
+            ) + "\n"
         await update.message.reply_text(
             f"👋 Привіт! Вас вітає бот підписки.\n\n"
-            f"💰 Вартість місячної підписки: {SUBSCRIPTION_PRICE} {CURRENCY}\n"
-            f"📅 Тривалість: {SUBSCRIPTION_DAYS} днів\n\n"
+            f"{prices}"
             f"Для оформлення підписки натисніть кнопку нижче 👇",
             reply_markup=get_subscription_keyboard()
         )
@@ -165,26 +546,26 @@ async def handle_payment_return(update, session_id, success=True):
     telegram_user_id = user.id
     
     if success:
-        # Check if payment was processed
+        # Check if payment was processed; the webhook usually lands within seconds
         try:
-            session = stripe.checkout.Session.retrieve(session_id)
+            status = await get_payment_status(session_id, wait=PAYMENT_RETURN_WAIT_SECONDS)
             
-            if session.payment_status == "paid":
+            if status["payment_status"] == "paid":
                 # Check if subscription exists in database
-                subscription = await db.subscriptions.find_one(
-                    {"telegram_user_id": telegram_user_id, "status": "active"}
-                )
+                subscription = await repos.subscriptions.get_active(telegram_user_id)
                 
                 if subscription:
+                    invite_link = await get_invite_link(telegram_user_id, plan_registry.for_subscription(subscription))
                     await update.message.reply_text(
                         f"✅ Платіж успішний! Ваша підписка активна до {subscription['current_period_end'].strftime('%d.%m.%Y')}\n\n"
-                        f"Приєднуйтесь до групи: {GROUP_INVITE_LINK}"
+                        f"Приєднуйтесь до групи: {invite_link}"
                     )
                 else:
                     # Payment successful but subscription not activated yet
+                    plan = plan_registry.get(status["plan_id"])
                     await update.message.reply_text(
                         f"✅ Платіж успішний! Ваша підписка активується протягом декількох хвилин.\n\n"
-                        f"Після активації ви зможете приєднатися до групи: {GROUP_INVITE_LINK}\n\n"
+                        f"Після активації ви зможете приєднатися до групи: {plan.get('invite_link') or GROUP_INVITE_LINK}\n\n"
                         f"Для перевірки статусу натисніть: /start"
                     )
             else:
@@ -205,14 +586,71 @@ async def handle_payment_return(update, session_id, success=True):
             "Для спроби ще раз натисніть: /start"
         )
 
+async def chat_join_request(update, context: ContextTypes.DEFAULT_TYPE):
+    """Approve join requests from subscribers, decline everyone else"""
+    join_request = update.chat_join_request
+    group_id = join_request.chat.id
+    if group_id not in plan_registry.by_group_id:
+        return
+    
+    telegram_user_id = join_request.from_user.id
+    try:
+        if telegram_user_id in ADMIN_USER_IDS or await has_active_subscription(telegram_user_id, group_id):
+            await join_request.approve()
+            return
+        
+        await join_request.decline()
+        await bot.send_message(
+            chat_id=join_request.user_chat_id,
+            text="❌ Для доступу до групи потрібна активна підписка.\n\n"
+                 "Для оформлення підписки натисніть: /start"
+        )
+        logging.info(f"Declined join request from user {telegram_user_id} without subscription")
+    except Exception as e:
+        logging.error(f"Error handling join request from {telegram_user_id}: {str(e)}")
+
+async def chat_member_update(update, context: ContextTypes.DEFAULT_TYPE):
+    """Remove users who joined the group without an active subscription"""
+    change = update.chat_member
+    group_id = change.chat.id
+    if group_id not in plan_registry.by_group_id:
+        return
+    
+    joined = (
+        change.old_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED)
+        and change.new_chat_member.status == ChatMember.MEMBER
+    )
+    if not joined:
+        return
+    
+    member = change.new_chat_member.user
+    # Personal links are single-use, so the next one has to be new
+    invite_links.pop((member.id, group_id), None)
+    if member.is_bot or member.id in ADMIN_USER_IDS or await has_active_subscription(member.id, group_id):
+        return
+    
+    try:
+        await remove_from_group(member.id, group_id)
+        logging.info(f"Removed user {member.id} who joined group {group_id} without subscription")
+    except Exception as e:
+        logging.error(f"Error removing user {member.id}: {str(e)}")
+
 def get_subscription_keyboard():
     """Get subscription keyboard"""
     from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     
-    keyboard = [
-        [InlineKeyboardButton("💳 Оформити підписку", callback_data="subscribe")],
-        [InlineKeyboardButton("ℹ️ Статус підписки", callback_data="status")]
-    ]
+    offered = plan_registry.offered()
+    if len(offered) == 1:
+        keyboard = [[InlineKeyboardButton("💳 Оформити підписку", callback_data="subscribe")]]
+    else:
+        keyboard = [
+            [InlineKeyboardButton(
+                f"💳 {plan['name']} — {plan['amount']} {plan['currency']}",
+                callback_data=f"subscribe:{plan['id']}"
+            )]
+            for plan in offered
+        ]
+    keyboard.append([InlineKeyboardButton("ℹ️ Статус підписки", callback_data="status")])
     return InlineKeyboardMarkup(keyboard)
 
 async def button_callback(update, context: ContextTypes.DEFAULT_TYPE):
@@ -223,10 +661,11 @@ async def button_callback(update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     telegram_user_id = user.id
     
-    if query.data == "subscribe":
-        # Create checkout session
+    if query.data == "subscribe" or query.data.startswith("subscribe:"):
+        # Create checkout session for the chosen plan
         try:
-            checkout_url = await create_stripe_checkout_session(telegram_user_id)
+            plan_id = query.data.partition(":")[2] or DEFAULT_PLAN_ID
+            checkout_url = await create_stripe_checkout_session(telegram_user_id, plan_id)
             await query.edit_message_text(
                 f"💳 Для оплати підписки перейдіть за посиланням:\n\n{checkout_url}\n\n"
                 f"Після оплати ви автоматично отримаєте доступ до групи."
@@ -238,15 +677,14 @@ async def button_callback(update, context: ContextTypes.DEFAULT_TYPE):
             )
     
     elif query.data == "status":
-        subscription = await db.subscriptions.find_one(
-            {"telegram_user_id": telegram_user_id, "status": "active"}
-        )
+        subscription = await repos.subscriptions.get_active(telegram_user_id)
         
         if subscription:
+            invite_link = await get_invite_link(telegram_user_id, plan_registry.for_subscription(subscription))
             await query.edit_message_text(
                 f"✅ Ваша підписка активна\n"
                 f"📅 Діє до: {subscription['current_period_end'].strftime('%d.%m.%Y %H:%M')}\n\n"
-                f"Посилання на групу: {GROUP_INVITE_LINK}"
+                f"Посилання на групу: {invite_link}"
             )
         else:
             await query.edit_message_text(
@@ -264,15 +702,12 @@ async def admin_command(update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Get subscription statistics
-    total_active = await db.subscriptions.count_documents({"status": "active"})
-    total_expired = await db.subscriptions.count_documents({"status": "expired"})
-    total_canceled = await db.subscriptions.count_documents({"status": "canceled"})
+    total_active = await repos.subscriptions.count_by_status("active")
+    total_expired = await repos.subscriptions.count_by_status("expired")
+    total_canceled = await repos.subscriptions.count_by_status("canceled")
     
     # Get recent subscriptions
-    recent_subs = await db.subscriptions.find(
-        {"status": "active"},
-        {"telegram_user_id": 1, "current_period_end": 1, "created_at": 1}
-    ).sort("created_at", -1).limit(10).to_list(length=10)
+    recent_subs = await repos.subscriptions.recent_active(10)
     
     message = f"📊 Статистика підписок:\n\n"
     message += f"✅ Активних: {total_active}\n"
@@ -283,7 +718,7 @@ async def admin_command(update, context: ContextTypes.DEFAULT_TYPE):
         message += "📝 Останні активні підписки:\n"
         for sub in recent_subs:
             try:
-                user_info = await bot.get_chat(sub['telegram_user_id'])
+                user_info = await bot.get_chat(chat_id=sub['telegram_user_id'])
                 username = user_info.username or f"ID{sub['telegram_user_id']}"
                 message += f"@{username} - до {sub['current_period_end'].strftime('%d.%m.%Y')}\n"
             except:
@@ -291,50 +726,35 @@ async def admin_command(update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message)
 
-async def create_stripe_checkout_session(telegram_user_id: int) -> str:
+async def create_stripe_checkout_session(telegram_user_id: int, plan_id: str = DEFAULT_PLAN_ID) -> str:
     """Create Stripe checkout session for subscription"""
     try:
+        plan = plan_registry.get(plan_id)
+        
         # Get or create customer
-        user = await db.users.find_one({"telegram_user_id": telegram_user_id})
+        user = await repos.users.get_by_telegram_id(telegram_user_id)
         if not user:
             raise Exception("User not found")
         
-        # Create customer in Stripe
-        customer = stripe.Customer.create(
+        # Create customer in Stripe; the client is synchronous, so keep it off the event loop
+        customer = await asyncio.to_thread(
+            stripe.Customer.create,
             metadata={
                 "telegram_user_id": str(telegram_user_id),
                 "telegram_username": user.get("telegram_username", ""),
             }
         )
         
-        # Create or get product
-        products = stripe.Product.list(limit=1)
-        if products.data:
-            product = products.data[0]
-        else:
-            product = stripe.Product.create(
-                name="Monthly Subscription",
-                description="Monthly subscription access"
-            )
-        
-        # Create or get price
-        prices = stripe.Price.list(product=product.id, limit=1)
-        if prices.data:
-            price = prices.data[0]
-        else:
-            price = stripe.Price.create(
-                unit_amount=int(SUBSCRIPTION_PRICE * 100),  # Convert to cents
-                currency=CURRENCY.lower(),
-                recurring={"interval": "month"},
-                product=product.id,
-            )
+        # Plans carry their Stripe price; the default catalog price is loaded once at startup
+        price_id = plan.get("stripe_price_id") or (await get_stripe_price()).id
         
         # Create checkout session
-        session = stripe.checkout.Session.create(
+        session = await asyncio.to_thread(
+            stripe.checkout.Session.create,
             customer=customer.id,
             payment_method_types=["card"],
             line_items=[{
-                "price": price.id,
+                "price": price_id,
                 "quantity": 1,
             }],
             mode="subscription",
@@ -342,7 +762,8 @@ async def create_stripe_checkout_session(telegram_user_id: int) -> str:
             cancel_url=f"https://t.me/{BOT_TOKEN.split(':')[0]}?start=payment_canceled",
             metadata={
                 "telegram_user_id": str(telegram_user_id),
-                "user_id": user["id"]
+                "user_id": user["id"],
+                "plan_id": plan["id"]
             }
         )
         
@@ -351,12 +772,12 @@ async def create_stripe_checkout_session(telegram_user_id: int) -> str:
             user_id=user["id"],
             telegram_user_id=telegram_user_id,
             stripe_session_id=session.id,
-            amount=SUBSCRIPTION_PRICE,
-            currency=CURRENCY,
+            amount=plan["amount"],
+            currency=plan["currency"],
             status="initiated",
-            metadata={"checkout_session_id": session.id}
+            metadata={"checkout_session_id": session.id, "plan_id": plan["id"]}
         )
-        await db.payment_transactions.insert_one(transaction.dict())
+        await repos.transactions.insert(transaction.dict())
         
         return session.url
         
@@ -364,174 +785,906 @@ async def create_stripe_checkout_session(telegram_user_id: int) -> str:
         logging.error(f"Error creating checkout session: {str(e)}")
         raise
 
-async def check_expired_subscriptions():
-    """Check for expired subscriptions and remove users from group"""
-    try:
-        # Find expired subscriptions
-        expired_subs = await db.subscriptions.find({
-            "status": "active",
-            "current_period_end": {"$lt": datetime.utcnow()}
-        }).to_list(length=None)
+async def load_stripe_catalog():
+    """Find or create the subscription product and price and cache them"""
+    def load():
+        # Create or get product
+        products = stripe.Product.list(limit=1)
+        if products.data:
+            product = products.data[0]
+        else:
+            product = stripe.Product.create(
+                name="Monthly Subscription",
+                description="Monthly subscription access"
+            )
         
-        for sub in expired_subs:
-            try:
-                # Remove user from group
-                await bot.ban_chat_member(
-                    chat_id=GROUP_ID,
-                    user_id=sub["telegram_user_id"]
-                )
-                
-                # Immediately unban to allow future joins
-                await bot.unban_chat_member(
-                    chat_id=GROUP_ID,
-                    user_id=sub["telegram_user_id"]
-                )
-                
-                # Update subscription status
-                await db.subscriptions.update_one(
-                    {"id": sub["id"]},
-                    {"$set": {"status": "expired", "updated_at": datetime.utcnow()}}
-                )
-                
-                # Send notification to user
-                await bot.send_message(
-                    chat_id=sub["telegram_user_id"],
-                    text=f"⏰ Ваша підписка закінчилася.\n\n"
-                         f"Для продовження доступу до групи оформіть нову підписку: /start"
-                )
-                
-                logging.info(f"Removed expired user {sub['telegram_user_id']} from group")
-                
-            except Exception as e:
-                logging.error(f"Error removing user {sub['telegram_user_id']}: {str(e)}")
-                
-    except Exception as e:
-        logging.error(f"Error checking expired subscriptions: {str(e)}")
+        # Create or get price
+        prices = stripe.Price.list(product=product.id, limit=1)
+        if prices.data:
+            price = prices.data[0]
+        else:
+            price = stripe.Price.create(
+                unit_amount=int(SUBSCRIPTION_PRICE * 100),  # Convert to cents
+                currency=CURRENCY.lower(),
+                recurring={"interval": "month"},
+                product=product.id,
+            )
+        return product, price
 
-# API Routes
-@api_router.get("/")
-async def root():
-    return {"message": "Telegram Bot with Stripe Subscriptions"}
+    # Stripe client is synchronous; keep it off the event loop
+    product, price = await asyncio.to_thread(load)
+    stripe_catalog["product"] = product
+    stripe_catalog["price"] = price
+    return price
 
-@api_router.post("/status", response_model=StatusCheck)
-async def create_status_check(input: StatusCheckCreate):
-    status_dict = input.dict()
-    status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
-    return status_obj
+async def get_stripe_price():
+    """Cached subscription price, loading the catalog if startup has not yet"""
+    price = stripe_catalog.get("price")
+    if price is None:
+        price = await load_stripe_catalog()
+    return price
 
-@api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+def churn_fields(old_status: Optional[str], new_status: str, now: datetime) -> Dict:
+    """Set churned_at when a subscription churns and clear it when it is active again; later writes keep it"""
+    if new_status in CHURNED_STATUSES and old_status not in CHURNED_STATUSES:
+        return {"churned_at": now}
+    if new_status == "active" and old_status in CHURNED_STATUSES:
+        return {"churned_at": None}
+    return {}
 
-@api_router.post("/stripe-webhook")
-async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
-    """Handle Stripe webhooks"""
-    payload = await request.body()
+async def remove_from_group(telegram_user_id: int, group_id: int):
+    """Kick a user from a group without banning them from joining again"""
+    await bot.ban_chat_member(chat_id=group_id, user_id=telegram_user_id)
     
+    # Immediately unban to allow future joins
+    await bot.unban_chat_member(chat_id=group_id, user_id=telegram_user_id)
+
+async def expire_subscription(sub: Dict, semaphore: asyncio.Semaphore):
+    """Remove the user from their plan's group and mark the subscription expired"""
+    async with semaphore:
+        if shutting_down:
+            # Still expired in storage, so the next sweep picks it up
+            return
+        try:
+            plan = plan_registry.for_subscription(sub)
+            await remove_from_group(sub["telegram_user_id"], plan["group_id"])
+            
+            # Update subscription status
+            now = datetime.utcnow()
+            await repos.subscriptions.update(
+                sub["id"],
+                {"status": "expired", "updated_at": now, **churn_fields(sub["status"], "expired", now)}
+            )
+            await publish_subscription_event(
+                "subscription.expired", dict(sub, status="expired"), sub["status"]
+            )
+            
+            # Send notification to user
+            await bot.send_message(
+                chat_id=sub["telegram_user_id"],
+                text=f"⏰ Ваша підписка закінчилася.\n\n"
+                     f"Для продовження доступу до групи оформіть нову підписку: /start"
+            )
+            
+            logging.info(f"Removed expired user {sub['telegram_user_id']} from group {plan['group_id']}")
+            
+        except Exception as e:
+            logging.error(f"Error removing user {sub['telegram_user_id']}: {str(e)}")
+
+async def check_expired_subscriptions():
+    """Check for expired subscriptions and remove users from their groups"""
     try:
-        event = stripe.Webhook.construct_event(
-            payload, stripe_signature, os.environ['STRIPE_WEBHOOK_SECRET']
-        )
-        
-        logging.info(f"Received Stripe webhook: {event['type']}")
+        # Find expired subscriptions
+        expired_subs = await repos.subscriptions.find_expired(datetime.utcnow())
         
-    except ValueError as e:
-        logging.error(f"Invalid payload: {e}")
-        raise HTTPException(status_code=400, detail="Invalid payload")
-    except stripe.error.SignatureVerificationError as e:
-        logging.error(f"Invalid signature: {e}")
-        raise HTTPException(status_code=400, detail="Invalid signature")
-    
-    # Handle the event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        await handle_checkout_session_completed(session)
-    
-    elif event['type'] == 'customer.subscription.updated':
-        subscription = event['data']['object']
-        await handle_subscription_updated(subscription)
-    
-    elif event['type'] == 'customer.subscription.deleted':
-        subscription = event['data']['object']
-        await handle_subscription_deleted(subscription)
-    
-    elif event['type'] == 'invoice.payment_succeeded':
-        invoice = event['data']['object']
-        await handle_invoice_payment_succeeded(invoice)
-    
-    elif event['type'] == 'invoice.payment_failed':
-        invoice = event['data']['object']
-        await handle_invoice_payment_failed(invoice)
-    
-    return {"status": "success"}
+        semaphore = asyncio.Semaphore(EXPIRY_CONCURRENCY)
+        await asyncio.gather(*(expire_subscription(sub, semaphore) for sub in expired_subs))
+                
+    except Exception as e:
+        logging.error(f"Error checking expired subscriptions: {str(e)}")
 
-@api_router.get("/check-payment/{session_id}")
-async def check_payment_status(session_id: str):
-    """Check payment status for a session"""
+async def refresh_analytics(full: bool = False):
+    """Materialize daily revenue and subscriber buckets and snapshot today's MRR"""
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
+        now = datetime.utcnow()
+        state = await repos.sync_state.get("analytics") or {}
+        since = None
+        if not full and state.get("refreshed_at"):
+            # Recompute from the start of the day before the last run so late writes are counted
+            since = (state["refreshed_at"] - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        elif state.get("refreshed_at") and TRANSACTION_ARCHIVE_DAYS:
+            # Archived transactions are gone from payment_transactions; their days keep the materialized values
+            since = archive_cutoff(now)
+        await repos.analytics.rebuild_daily(since)
         
-        # Check if subscription exists in database
-        subscription = None
-        if session.subscription:
-            subscription = await db.subscriptions.find_one(
-                {"stripe_subscription_id": session.subscription}
-            )
+        # Amounts are per plan period; MRR normalizes them to 30 days
+        totals = await repos.subscriptions.active_totals_by_plan()
+        mrr = sum(amount * 30 / plan_registry.get(plan_id)["days"] for plan_id, (_, amount) in totals.items())
+        await repos.analytics.set_snapshot(now.strftime("%Y-%m-%d"), {
+            "mrr": round(mrr, 2),
+            "active_subscribers": sum(count for count, _ in totals.values())
+        })
         
-        return {
-            "payment_status": session.payment_status,
-            "subscription_status": subscription["status"] if subscription else None,
-            "session_id": session_id
-        }
+        await repos.sync_state.set("analytics", {"refreshed_at": now, "full": full})
+        logging.info(f"Analytics refreshed {'fully' if full else f'since {since}'}")
         
     except Exception as e:
-        logging.error(f"Error checking payment status: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logging.error(f"Error refreshing analytics: {str(e)}")
 
-async def handle_checkout_session_completed(session):
-    """Handle successful checkout session"""
+def archive_cutoff(now: datetime) -> datetime:
+    """Start of the oldest day that is still kept in payment_transactions"""
+    return (now - timedelta(days=TRANSACTION_ARCHIVE_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+async def apply_transaction_retention() -> Dict:
+    """Drop abandoned checkouts and move old completed transactions to the archive in batches"""
     try:
-        telegram_user_id = int(session['metadata']['telegram_user_id'])
-        user_id = session['metadata']['user_id']
-        
-        # Get subscription details
-        subscription = stripe.Subscription.retrieve(session['subscription'])
-        
-        # Update payment transaction
-        await db.payment_transactions.update_one(
-            {"stripe_session_id": session['id']},
-            {"$set": {
-                "status": "completed",
-                "stripe_subscription_id": subscription.id,
-                "updated_at": datetime.utcnow()
-            }}
-        )
+        now = datetime.utcnow()
+        report = {
+            "abandoned": await repos.transactions.delete_abandoned(now - timedelta(hours=TRANSACTION_ABANDONED_HOURS)),
+            "archived": 0
+        }
         
-        # Create or update subscription record
-        sub_data = Subscription(
-            user_id=user_id,
-            telegram_user_id=telegram_user_id,
-            stripe_subscription_id=subscription.id,
-            stripe_customer_id=subscription.customer,
-            stripe_product_id=subscription['items']['data'][0]['price']['product'],
-            stripe_price_id=subscription['items']['data'][0]['price']['id'],
-            status="active",
-            amount=SUBSCRIPTION_PRICE,
-            currency=CURRENCY,
-            current_period_start=datetime.fromtimestamp(subscription.current_period_start),
-            current_period_end=datetime.fromtimestamp(subscription.current_period_end),
-            updated_at=datetime.utcnow()
-        )
+        # Only days already materialized in analytics may leave payment_transactions
+        if TRANSACTION_ARCHIVE_DAYS and await repos.sync_state.get("analytics"):
+            cutoff = archive_cutoff(now)
+            while True:
+                moved, revenue = await repos.transactions.archive_completed(cutoff, RETENTION_BATCH_SIZE)
+                if moved:
+                    # Keeps total revenue in the admin stats complete
+                    await repos.sync_state.increment("transaction_archive", {"count": moved, "revenue": revenue})
+                    repos.changes.bump("payment_transactions")
+                    report["archived"] += moved
+                if moved < RETENTION_BATCH_SIZE or shutting_down:
+                    break
         
-        await db.subscriptions.insert_one(sub_data.dict())
+        logging.info(f"Transaction retention finished: {report}")
+        return report
         
-        # Send invite link to user
-        await bot.send_message(
+    except Exception as e:
+        logging.error(f"Error applying transaction retention: {str(e)}")
+
+def bucket_start(day: datetime, period: str) -> str:
+    """Key of the day/week (Monday)/month bucket containing day"""
+    if period == "week":
+        day = day - timedelta(days=day.weekday())
+    elif period == "month":
+        day = day.replace(day=1)
+    return day.strftime("%Y-%m-%d")
+
+async def send_renewal_reminders():
+    """Remind users whose subscription ends within one of the reminder windows"""
+    try:
+        now = datetime.utcnow()
+        sent = 0
+        for index, days in enumerate(REMINDER_WINDOWS_DAYS):
+            # Each window only covers the range down to the next smaller window
+            lower_days = REMINDER_WINDOWS_DAYS[index + 1] if index + 1 < len(REMINDER_WINDOWS_DAYS) else 0
+            marker = f"{days}d"
+            # Sending this reminder also covers every larger window
+            covered = [f"{window}d" for window in REMINDER_WINDOWS_DAYS if window >= days]
+
+            while True:
+                # Marked subscriptions drop out of the query, so each batch is the next one
+                batch = await repos.subscriptions.find_due_for_reminder(
+                    now + timedelta(days=lower_days),
+                    now + timedelta(days=days),
+                    marker,
+                    REMINDER_BATCH_SIZE
+                )
+                if not batch or shutting_down:
+                    break
+
+                # Mark first so an overlapping tick or restart never sends twice
+                await repos.subscriptions.add_reminder_markers([sub["id"] for sub in batch], covered)
+
+                for sub in batch:
+                    end_date = sub["current_period_end"].strftime('%d.%m.%Y')
+                    if sub.get("stripe_subscription_id"):
+                        text = (
+                            f"⏳ Ваша підписка буде автоматично продовжена {end_date}.\n\n"
+                            f"Переконайтеся, що ваш спосіб оплати актуальний, щоб не втратити доступ до групи."
+                        )
+                    else:
+                        text = (
+                            f"⏳ Ваша підписка закінчується {end_date}.\n\n"
+                            f"Щоб зберегти доступ до групи, оформіть нову підписку: /start"
+                        )
+                    await enqueue_notification(sub["telegram_user_id"], text)
+                sent += len(batch)
+
+        if sent:
+            logging.info(f"Queued {sent} renewal reminders")
+
+    except Exception as e:
+        logging.error(f"Error sending renewal reminders: {str(e)}")
+
+async def reconcile_subscription_page(stripe_subs) -> Dict:
+    """Compare one page of Stripe subscriptions with Mongo and repair drift"""
+    counts = {"checked": len(stripe_subs), "repaired": 0, "created": 0, "unmatched": 0}
+    if not stripe_subs:
+        return counts
+
+    local_subs = await repos.subscriptions.find_by_stripe_ids([sub.id for sub in stripe_subs], RECONCILE_FIELDS)
+    local_by_id = {sub["stripe_subscription_id"]: sub for sub in local_subs}
+
+    now = datetime.utcnow()
+    updates = []
+    missing = []
+    lapsed = []
+    for stripe_sub in stripe_subs:
+        period_start = datetime.fromtimestamp(stripe_sub.current_period_start)
+        period_end = datetime.fromtimestamp(stripe_sub.current_period_end)
+        local = local_by_id.get(stripe_sub.id)
+
+        if local is None:
+            missing.append((stripe_sub, period_start, period_end))
+            continue
+
+        status = stripe_sub.status
+        # Keep "expired" set by the sweep unless Stripe says the user paid again
+        if local["status"] == "expired" and status != "active":
+            status = "expired"
+
+        if (local["status"], local.get("current_period_start"), local.get("current_period_end")) != (
+            status, period_start, period_end
+        ):
+            update = {
+                "status": status,
+                "current_period_start": period_start,
+                "current_period_end": period_end,
+                "updated_at": now,
+                **churn_fields(local["status"], status, now)
+            }
+            if local.get("current_period_end") != period_end:
+                update["reminders_sent"] = []
+            updates.append((stripe_sub.id, update))
+            if status in LAPSED_STATUSES and local["status"] not in LAPSED_STATUSES + ("expired",):
+                lapsed.append((local, status))
+
+    if missing:
+        # A lost checkout.session.completed leaves no local row; recover it from customer metadata
+        telegram_ids = {}
+        for stripe_sub, _, _ in missing:
+            metadata = getattr(stripe_sub.customer, "metadata", None) or {}
+            if "telegram_user_id" in metadata:
+                telegram_ids[stripe_sub.id] = int(metadata["telegram_user_id"])
+        users = await repos.users.find_by_telegram_ids_or_usernames(list(telegram_ids.values()), [])
+        users_by_telegram_id = {user["telegram_user_id"]: user for user in users}
+
+        recovered = []
+        for stripe_sub, period_start, period_end in missing:
+            user = users_by_telegram_id.get(telegram_ids.get(stripe_sub.id))
+            if user is None:
+                counts["unmatched"] += 1
+                continue
+            price = stripe_sub["items"]["data"][0]["price"]
+            plan = plan_registry.for_price(price["id"])
+            sub_data = Subscription(
+                user_id=user["id"],
+                telegram_user_id=user["telegram_user_id"],
+                stripe_subscription_id=stripe_sub.id,
+                stripe_customer_id=stripe_sub.customer.id,
+                stripe_product_id=price["product"],
+                stripe_price_id=price["id"],
+                status=stripe_sub.status,
+                plan_id=plan["id"],
+                amount=(price["unit_amount"] or 0) / 100 or plan["amount"],
+                currency=price["currency"].upper(),
+                current_period_start=period_start,
+                current_period_end=period_end
+            ).dict()
+            recovered.append(sub_data)
+        counts["created"] = await repos.subscriptions.insert_missing_by_stripe_id(recovered)
+
+    counts["repaired"] = await repos.subscriptions.bulk_update_by_stripe_id(updates)
+
+    # Repairs that take access away go through the same path as a cancellation webhook
+    for local, status in lapsed:
+        try:
+            await publish_subscription_event(f"subscription.{status}", dict(local, status=status), local["status"])
+            await remove_from_group(local["telegram_user_id"], plan_registry.for_subscription(local)["group_id"])
+        except Exception as e:
+            logging.error(f"Error removing user {local['telegram_user_id']} after reconciliation: {str(e)}")
+    return counts
+
+async def reconcile_subscription_window(created: Dict, semaphore: asyncio.Semaphore) -> Dict:
+    """Page through Stripe subscriptions created in one time window"""
+    totals = {"checked": 0, "repaired": 0, "created": 0, "unmatched": 0}
+    params = {"status": "all", "limit": 100, "created": created, "expand": ["data.customer"]}
+
+    async with semaphore:
+        pending = None
+        while True:
+            # Stripe client is synchronous; keep it off the event loop
+            page = await asyncio.to_thread(stripe.Subscription.list, **params)
+            if pending:
+                for key, value in (await pending).items():
+                    totals[key] += value
+            pending = asyncio.ensure_future(reconcile_subscription_page(page.data))
+            if not page.has_more or not page.data:
+                break
+            params["starting_after"] = page.data[-1].id
+        for key, value in (await pending).items():
+            totals[key] += value
+
+    return totals
+
+async def reconcile_changed_subscriptions(since: int) -> Dict:
+    """Re-check every subscription with a customer.subscription.* event since the timestamp"""
+    totals = {"checked": 0, "repaired": 0, "created": 0, "unmatched": 0}
+    params = {"type": "customer.subscription.*", "created": {"gte": since}, "limit": 100}
+    changed = {}
+    while True:
+        page = await asyncio.to_thread(stripe.Event.list, **params)
+        for event in page.data:
+            changed.setdefault(event["data"]["object"]["id"], None)
+        if not page.has_more or not page.data:
+            break
+        params["starting_after"] = page.data[-1].id
+
+    # Events carry the subscription as it was when they fired; compare the current state
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def retrieve(stripe_subscription_id):
+        async with semaphore:
+            return await asyncio.to_thread(stripe.Subscription.retrieve, stripe_subscription_id, expand=["customer"])
+
+    stripe_subscription_ids = list(changed)
+    for start in range(0, len(stripe_subscription_ids), 100):
+        stripe_subs = await asyncio.gather(*(retrieve(sub_id) for sub_id in stripe_subscription_ids[start:start + 100]))
+        for key, value in (await reconcile_subscription_page(stripe_subs)).items():
+            totals[key] += value
+
+    return totals
+
+async def reconcile_subscriptions(full: bool = False) -> Optional[Dict]:
+    """Repair drift between Stripe and the subscriptions collection"""
+    if reconcile_lock.locked():
+        logging.info("Subscription reconciliation already running, skipping")
+        return None
+
+    async with reconcile_lock:
+        try:
+            started = datetime.utcnow()
+            now_ts = int(started.timestamp())
+            state = await repos.sync_state.get("stripe_subscriptions")
+            since = 0
+            if state and not full:
+                since = max(0, state["watermark"] - RECONCILE_OVERLAP_SECONDS)
+
+            if since and now_ts - since < STRIPE_EVENT_RETENTION_SECONDS:
+                # Incremental runs follow subscription events, so old subscriptions changed in Stripe are repaired too
+                results = [await reconcile_changed_subscriptions(since)]
+            else:
+                # Full run over every subscription; also used once events since the watermark have expired in Stripe
+                since = 0
+                oldest = await repos.subscriptions.oldest_stripe_created_at()
+                if oldest:
+                    since = max(0, int(oldest.timestamp()) - 86400)
+
+                # Cursor pagination is sequential, so split the range into windows paged in parallel
+                step = max(1, (now_ts - since) // RECONCILE_CONCURRENCY + 1)
+                windows = [
+                    {"gte": lower, "lt": lower + step}
+                    for lower in range(since, now_ts + 1, step)
+                ]
+
+                semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+                results = await asyncio.gather(
+                    *(reconcile_subscription_window(created, semaphore) for created in windows)
+                )
+
+            report = {"checked": 0, "repaired": 0, "created": 0, "unmatched": 0}
+            for result in results:
+                for key, value in result.items():
+                    report[key] += value
+
+            await repos.sync_state.set(
+                "stripe_subscriptions",
+                {"watermark": now_ts, "last_run": started, "last_report": report}
+            )
+            report["duration_seconds"] = round((datetime.utcnow() - started).total_seconds(), 3)
+            if report["repaired"] or report["created"]:
+                await reload_active_members()
+                publish_dashboard_event("resync")
+            logging.info(f"Subscription reconciliation finished: {report}")
+            return report
+
+        except Exception as e:
+            logging.error(f"Error reconciling subscriptions: {str(e)}")
+            raise
+
+# Dashboard counters affected by each subscription status
+STATUS_COUNTERS = {
+    "active": "active_subscriptions",
+    "expired": "expired_subscriptions",
+    "canceled": "canceled_subscriptions"
+}
+
+def status_delta(old_status: Optional[str], new_status: Optional[str]) -> Dict[str, int]:
+    """Change of the dashboard counters when a subscription moves between statuses"""
+    delta = {}
+    if old_status in STATUS_COUNTERS:
+        delta[STATUS_COUNTERS[old_status]] = -1
+    if new_status in STATUS_COUNTERS:
+        delta[STATUS_COUNTERS[new_status]] = delta.get(STATUS_COUNTERS[new_status], 0) + 1
+    return {key: value for key, value in delta.items() if value}
+
+async def subscriber_row(subscription: Dict) -> Dict:
+    """Subscription in the shape of the dashboard subscriber list (SubscriberOut)"""
+    user = await repos.users.get_by_id(subscription["user_id"]) or {}
+    return {
+        "id": subscription["id"],
+        "telegram_user_id": subscription["telegram_user_id"],
+        "telegram_username": user.get("telegram_username"),
+        "email": user.get("email"),
+        "current_period_end": subscription.get("current_period_end"),
+        "created_at": subscription["created_at"],
+        "plan_id": subscription.get("plan_id", DEFAULT_PLAN_ID),
+        "amount": subscription["amount"],
+        "currency": subscription["currency"]
+    }
+
+def publish_dashboard_event(event_type: str, payload: Optional[Dict] = None):
+    """Push an event to every connected dashboard
+
+    Payload keys the dashboard applies: upsert (subscriber row), remove
+    (subscription id), stats (counter deltas), revenue and transaction.
+    """
+    if not dashboard_clients:
+        return
+    
+    message = (
+        f"id: {next(dashboard_event_ids)}\n"
+        f"event: {event_type}\n"
+        f"data: {orjson.dumps(payload or {}).decode()}\n\n"
+    )
+    for queue in list(dashboard_clients):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A dashboard that can't keep up gets one resync instead of a backlog
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait("event: resync\ndata: {}\n\n")
+
+async def publish_subscription_event(event_type: str, subscription: Dict, old_status: Optional[str], **extra):
+    """Apply a subscription change to the member set and publish its row or removal to dashboards"""
+    await update_active_member(subscription)
+    if not dashboard_clients:
+        return
+    
+    payload = {"stats": status_delta(old_status, subscription["status"]), **extra}
+    if subscription["status"] == "active":
+        payload["upsert"] = await subscriber_row(subscription)
+    else:
+        payload["remove"] = subscription["id"]
+    publish_dashboard_event(event_type, payload)
+
+async def enqueue_notification(chat_id: int, text: str):
+    """Queue a Telegram message for throttled delivery by notification_worker"""
+    await notification_queue.put((chat_id, text))
+
+async def notification_worker():
+    """Deliver queued notifications without exceeding the Telegram rate limit"""
+    interval = 1.0 / NOTIFICATION_RATE_PER_SECOND
+    while True:
+        chat_id, text = await notification_queue.get()
+        try:
+            await bot.call("send_message", chat_id=chat_id, text=text)
+        except asyncio.CancelledError:
+            # Stopped mid-send on shutdown; the message is saved with the rest of the queue
+            notification_queue.put_nowait((chat_id, text))
+            raise
+        except CircuitOpenError:
+            # Keep the message until Telegram recovers
+            await notification_queue.put((chat_id, text))
+            await asyncio.sleep(bot.breaker.retry_in())
+        except Exception as e:
+            logging.error(f"Error sending notification to {chat_id}: {str(e)}")
+        finally:
+            notification_queue.task_done()
+        await asyncio.sleep(interval)
+
+async def save_pending_notifications():
+    """Store undelivered notifications so the next process sends them"""
+    pending = []
+    while not notification_queue.empty():
+        pending.append(list(notification_queue.get_nowait()))
+        notification_queue.task_done()
+    if pending:
+        await repos.sync_state.push("notification_queue", "messages", pending)
+        logging.info(f"Saved {len(pending)} undelivered notifications")
+
+async def restore_pending_notifications():
+    """Queue notifications saved by a previous process"""
+    state = await repos.sync_state.take("notification_queue") or {}
+    for chat_id, text in state.get("messages", []):
+        await enqueue_notification(chat_id, text)
+
+@asynccontextmanager
+async def tracked_work(name: str):
+    """Register the current task as work that shutdown waits for"""
+    task = asyncio.current_task()
+    in_flight_work[task] = name
+    try:
+        yield
+    finally:
+        in_flight_work.pop(task, None)
+
+def drained_job(job):
+    """Scheduled job wrapper: skipped once shutdown has started, otherwise awaited by it"""
+    @functools.wraps(job)
+    async def run(**kwargs):
+        if shutting_down:
+            return
+        async with tracked_work(job.__name__):
+            return await job(**kwargs)
+    return run
+
+async def has_active_subscription(telegram_user_id: int, group_id: int) -> bool:
+    """O(1) check against the group's member set, falling back to storage until it's loaded"""
+    if active_members_loaded:
+        return telegram_user_id in active_members.get(group_id, ())
+    plan_ids = plan_registry.plan_ids_for_group(group_id)
+    return await repos.subscriptions.get_active(telegram_user_id, plan_ids) is not None
+
+async def update_active_member(subscription: Dict):
+    """Keep the member sets in step with one subscription's status"""
+    telegram_user_id = subscription["telegram_user_id"]
+    group_id = plan_registry.for_subscription(subscription)["group_id"]
+    members = active_members.setdefault(group_id, set())
+    if subscription["status"] == "active":
+        members.add(telegram_user_id)
+    elif telegram_user_id in members:
+        # The user may still hold another active subscription for the same group
+        plan_ids = plan_registry.plan_ids_for_group(group_id)
+        if not await repos.subscriptions.get_active(telegram_user_id, plan_ids):
+            members.discard(telegram_user_id)
+
+async def reload_active_members(delay: float = 0):
+    """Rebuild the member sets from storage"""
+    global active_members, active_members_loaded
+    
+    await asyncio.sleep(delay)
+    try:
+        members_by_group: Dict[int, set] = {}
+        for plan_id, members in (await repos.subscriptions.active_members_by_plan()).items():
+            members_by_group.setdefault(plan_registry.get(plan_id)["group_id"], set()).update(members)
+        active_members = members_by_group
+        active_members_loaded = True
+    except Exception as e:
+        logging.error(f"Error loading active members: {str(e)}")
+
+async def reload_plans_and_members():
+    """Plans decide which group each subscription grants, so members follow a plan reload"""
+    try:
+        await reload_plans()
+    except Exception as e:
+        logging.error(f"Error loading plans: {str(e)}")
+    await reload_active_members()
+
+def on_storage_change(collection: str, remote: bool):
+    """Wake payment checks on transaction writes; follow other processes: reload plans, and (debounced) the member sets"""
+    global active_members_reload
+    
+    if collection == "payment_transactions":
+        wake_payment_waiters()
+    if not remote:
+        return
+    if collection == "plans":
+        asyncio.create_task(reload_plans_and_members())
+    elif collection == "subscriptions" and (active_members_reload is None or active_members_reload.done()):
+        active_members_reload = asyncio.create_task(reload_active_members(ACTIVE_MEMBERS_RELOAD_SECONDS))
+
+async def get_invite_link(telegram_user_id: int, plan: Optional[Dict] = None) -> str:
+    """Personal single-use invite link to the plan's group, falling back to its shared link"""
+    plan = plan or plan_registry.get(DEFAULT_PLAN_ID)
+    group_id = plan["group_id"]
+    now = datetime.utcnow()
+    cached = invite_links.get((telegram_user_id, group_id))
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    expires_at = now + timedelta(hours=INVITE_LINK_TTL_HOURS)
+    try:
+        link = await bot.create_chat_invite_link(
+            chat_id=group_id,
+            name=f"user {telegram_user_id}",
+            expire_date=expires_at.replace(tzinfo=timezone.utc),
+            member_limit=1
+        )
+    except Exception as e:
+        logging.error(f"Error creating invite link for {telegram_user_id}: {str(e)}")
+        return plan.get("invite_link") or GROUP_INVITE_LINK
+    
+    invite_links[(telegram_user_id, group_id)] = (link.invite_link, expires_at)
+    return link.invite_link
+
+def wake_payment_waiters():
+    """Let long-polling payment checks re-read their transaction"""
+    global payment_changed
+    
+    payment_changed.set()
+    payment_changed = asyncio.Event()
+
+async def local_payment_status(session_id: str) -> Optional[Dict]:
+    """Outcome recorded by the webhook, or None while the session is still open"""
+    transaction = await repos.transactions.get_by_session_id(session_id)
+    if not transaction or transaction["status"] != "completed":
+        return None
+    
+    subscription = None
+    if transaction.get("stripe_subscription_id"):
+        subscription = await repos.subscriptions.get_by_stripe_id(transaction["stripe_subscription_id"])
+    return {
+        "payment_status": "paid",
+        "subscription_status": subscription["status"] if subscription else None,
+        "session_id": session_id,
+        "plan_id": (transaction.get("metadata") or {}).get("plan_id"),
+        "source": "local"
+    }
+
+async def stripe_payment_status(session_id: str) -> Dict:
+    """Status of a session the webhook hasn't completed yet, from Stripe with a short-lived cache"""
+    now = time.monotonic()
+    cached = payment_status_cache.get(session_id)
+    if cached and cached[1] > now:
+        fields = cached[0]
+    else:
+        session = await asyncio.to_thread(stripe.checkout.Session.retrieve, session_id)
+        fields = {
+            "payment_status": session.payment_status,
+            "subscription": session.subscription,
+            "plan_id": session.metadata["plan_id"] if "plan_id" in session.metadata else None
+        }
+        for expired in [key for key, (_, expires_at) in payment_status_cache.items() if expires_at <= now]:
+            del payment_status_cache[expired]
+        payment_status_cache[session_id] = (fields, now + PAYMENT_STATUS_CACHE_SECONDS)
+    
+    # Check if subscription exists in database
+    subscription = None
+    if fields["subscription"]:
+        subscription = await repos.subscriptions.get_by_stripe_id(fields["subscription"])
+    return {
+        "payment_status": fields["payment_status"],
+        "subscription_status": subscription["status"] if subscription else None,
+        "session_id": session_id,
+        "plan_id": fields["plan_id"],
+        "source": "stripe"
+    }
+
+async def get_payment_status(session_id: str, wait: float = 0) -> Dict:
+    """Payment status from local state, waiting up to wait seconds for the webhook before asking Stripe"""
+    deadline = time.monotonic() + wait
+    while True:
+        # Taken before the read so a completion in between still wakes this check
+        changed = payment_changed
+        status = await local_payment_status(session_id)
+        remaining = deadline - time.monotonic()
+        if status or remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+    
+    return status or await stripe_payment_status(session_id)
+
+def client_ip(request: Request) -> str:
+    """Client address, taken from X-Forwarded-For behind the ingress"""
+    forwarded = request.headers.get("x-forwarded-for") if TRUST_FORWARDED_FOR else None
+    if forwarded:
+        # Earlier hops come from the client and can be spoofed; the ingress appends the address it saw
+        return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+def limit_requests(scope: str):
+    """Route dependency rejecting clients over the scope's rate limit with 429"""
+    async def dependency(request: Request):
+        allowed, retry_after = await rate_limiter.hit(scope, client_ip(request))
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+            )
+    return Depends(dependency)
+
+# API Routes
+@api_router.get("/")
+async def root():
+    return {"message": "Telegram Bot with Stripe Subscriptions"}
+
+@api_router.get("/health")
+async def health():
+    """Cheap probe for uptime monitors; no database access"""
+    return {
+        "status": "ok",
+        "services": {name: state.get("status") for name, state in startup_report.items() if "status" in state},
+        "telegram_circuit": bot.breaker.state,
+        "rate_limits": rate_limiter.stats
+    }
+
+@api_router.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    """Storage is initialized; Stripe and Telegram are reported but may still be connecting"""
+    ready = startup_report.get("storage", {}).get("status") == "ready" and not shutting_down
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "draining" if shutting_down else "starting",
+            "services": startup_report
+        }
+    )
+
+@api_router.post("/status", response_model=StatusCheck, dependencies=[limit_requests("api")])
+async def create_status_check(input: StatusCheckCreate):
+    status_dict = input.dict()
+    status_obj = StatusCheck(**status_dict)
+    await repos.status_checks.insert(status_obj.dict())
+    return status_obj
+
+@api_router.get("/status", response_model=List[StatusCheck], dependencies=[limit_requests("api")])
+async def get_status_checks(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Newest status checks first; pass X-Next-Cursor back as cursor for the next page"""
+    before = None
+    if cursor:
+        try:
+            timestamp, status_id = cursor.split(",", 1)
+            before = (datetime.fromisoformat(timestamp), status_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    status_checks = await repos.status_checks.list(limit, before)
+    
+    # Rows are already in StatusCheck shape; skip per-row model validation
+    headers = {}
+    if len(status_checks) == limit:
+        last = status_checks[-1]
+        headers["X-Next-Cursor"] = f"{last['timestamp'].isoformat()},{last['id']}"
+    for status_check in status_checks:
+        status_check["timestamp"] = status_check["timestamp"].isoformat()
+    return JSONResponse(content=status_checks, headers=headers)
+
+@api_router.post("/stripe-webhook")
+async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
+    """Handle Stripe webhooks"""
+    if shutting_down:
+        # Stripe retries non-2xx deliveries, so another replica or the next process handles it
+        raise HTTPException(status_code=503, detail="Shutting down")
+    
+    payload = await request.body()
+    
+    try:
+        event = stripe.Webhook.construct_event(
+            payload, stripe_signature, os.environ['STRIPE_WEBHOOK_SECRET']
+        )
+        
+        logging.info(f"Received Stripe webhook: {event['type']}")
+        
+    except ValueError as e:
+        logging.error(f"Invalid payload: {e}")
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    except stripe.error.SignatureVerificationError as e:
+        logging.error(f"Invalid signature: {e}")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
+    # Handle the event; shutdown waits for it to finish
+    async with tracked_work(f"stripe_webhook {event['type']}"):
+        if event['type'] == 'checkout.session.completed':
+            session = event['data']['object']
+            await handle_checkout_session_completed(session)
+        
+        elif event['type'] == 'customer.subscription.updated':
+            subscription = event['data']['object']
+            await handle_subscription_updated(subscription)
+        
+        elif event['type'] == 'customer.subscription.deleted':
+            subscription = event['data']['object']
+            await handle_subscription_deleted(subscription)
+        
+        elif event['type'] == 'invoice.payment_succeeded':
+            invoice = event['data']['object']
+            await handle_invoice_payment_succeeded(invoice)
+        
+        elif event['type'] == 'invoice.payment_failed':
+            invoice = event['data']['object']
+            await handle_invoice_payment_failed(invoice)
+        
+    
+    return {"status": "success"}
+
+@api_router.get("/check-payment/{session_id}", dependencies=[limit_requests("api")])
+async def check_payment_status(session_id: str, wait: float = Query(0, ge=0, le=PAYMENT_LONG_POLL_SECONDS)):
+    """Check payment status for a session; with wait, long-poll until the webhook completes it"""
+    try:
+        status = await get_payment_status(session_id, wait=wait)
+        
+        return {
+            "payment_status": status["payment_status"],
+            "subscription_status": status["subscription_status"],
+            "session_id": session_id
+        }
+        
+    except Exception as e:
+        logging.error(f"Error checking payment status: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def handle_checkout_session_completed(session):
+    """Handle successful checkout session"""
+    try:
+        telegram_user_id = int(session['metadata']['telegram_user_id'])
+        user_id = session['metadata']['user_id']
+        
+        # Get subscription details
+        subscription = await asyncio.to_thread(stripe.Subscription.retrieve, session['subscription'])
+        price_id = subscription['items']['data'][0]['price']['id']
+        plan = (
+            plan_registry.get(session['metadata']['plan_id'])
+            if 'plan_id' in session['metadata'] else plan_registry.for_price(price_id)
+        )
+        
+        # Create or update subscription record
+        sub_data = Subscription(
+            user_id=user_id,
+            telegram_user_id=telegram_user_id,
+            stripe_subscription_id=subscription.id,
+            stripe_customer_id=subscription.customer,
+            stripe_product_id=subscription['items']['data'][0]['price']['product'],
+            stripe_price_id=price_id,
+            status="active",
+            plan_id=plan["id"],
+            amount=plan["amount"],
+            currency=plan["currency"],
+            current_period_start=datetime.fromtimestamp(subscription.current_period_start),
+            current_period_end=datetime.fromtimestamp(subscription.current_period_end),
+            updated_at=datetime.utcnow()
+        )
+        
+        # Keyed on the Stripe id: a retried delivery, or a row reconciliation already recovered, is updated, not duplicated
+        stored = sub_data.dict()
+        old_status = None
+        if not await repos.subscriptions.insert_missing_by_stripe_id([stored]):
+            existing = await repos.subscriptions.get_by_stripe_id(subscription.id)
+            fields = {key: value for key, value in stored.items() if key not in ("id", "created_at")}
+            await repos.subscriptions.update_by_stripe_id(subscription.id, fields)
+            stored = dict(existing, **fields)
+            old_status = existing["status"]
+        
+        # Update payment transaction; payment checks waiting on it find the subscription already stored
+        await repos.transactions.update_by_session_id(
+            session['id'],
+            {
+                "status": "completed",
+                "stripe_subscription_id": subscription.id,
+                "updated_at": datetime.utcnow()
+            }
+        )
+        
+        transaction = await repos.transactions.get_by_session_id(session['id'])
+        await publish_subscription_event(
+            "subscription.created",
+            stored,
+            old_status,
+            revenue=transaction["amount"] if transaction else 0,
+            transaction={field: transaction.get(field) for field in TRANSACTION_FIELDS} if transaction else None
+        )
+        
+        # Send invite link to user
+        invite_link = await get_invite_link(telegram_user_id, plan)
+        await bot.send_message(
             chat_id=telegram_user_id,
             text=f"✅ Платіж успішний! Ваша підписка активна до {sub_data.current_period_end.strftime('%d.%m.%Y')}\n\n"
-                 f"Приєднуйтесь до групи: {GROUP_INVITE_LINK}"
+                 f"Приєднуйтесь до групи: {invite_link}"
         )
         
         logging.info(f"Subscription activated for user {telegram_user_id}")
@@ -542,16 +1695,40 @@ async def handle_checkout_session_completed(session):
 async def handle_subscription_updated(subscription):
     """Handle subscription updates"""
     try:
+        sub_record = await repos.subscriptions.get_by_stripe_id(subscription.id)
+        
         # Update subscription in database
-        await db.subscriptions.update_one(
-            {"stripe_subscription_id": subscription.id},
-            {"$set": {
-                "status": subscription.status,
-                "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
-                "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
-                "updated_at": datetime.utcnow()
-            }}
-        )
+        now = datetime.utcnow()
+        fields = {
+            "status": subscription.status,
+            "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
+            "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
+            "updated_at": now,
+            **churn_fields(sub_record["status"] if sub_record else None, subscription.status, now)
+        }
+        
+        # A price change moves the subscriber to another plan, possibly another group
+        price_id = subscription['items']['data'][0]['price']['id']
+        plan = plan_registry.for_price(price_id)
+        old_plan = plan_registry.for_subscription(sub_record) if sub_record else plan
+        stored_price_id = sub_record.get("stripe_price_id") if sub_record else None
+        if price_id == stored_price_id or (stored_price_id is None and price_id not in plan_registry.by_price_id):
+            # Routine updates (renewals, payment method changes) keep the stored plan
+            plan = old_plan
+        if plan["id"] != old_plan["id"]:
+            fields.update(plan_id=plan["id"], stripe_price_id=price_id, amount=plan["amount"], currency=plan["currency"])
+        
+        await repos.subscriptions.update_by_stripe_id(subscription.id, fields)
+        
+        if sub_record:
+            if old_plan["group_id"] != plan["group_id"]:
+                # The old plan no longer grants its group
+                await update_active_member(dict(sub_record, status="moved"))
+                if not await has_active_subscription(sub_record["telegram_user_id"], old_plan["group_id"]):
+                    await remove_from_group(sub_record["telegram_user_id"], old_plan["group_id"])
+            await publish_subscription_event(
+                "subscription.updated", dict(sub_record, **fields), sub_record["status"]
+            )
         
         logging.info(f"Subscription {subscription.id} updated")
         
@@ -562,22 +1739,20 @@ async def handle_subscription_deleted(subscription):
     """Handle subscription cancellation"""
     try:
         # Update subscription status
-        sub_record = await db.subscriptions.find_one({"stripe_subscription_id": subscription.id})
+        sub_record = await repos.subscriptions.get_by_stripe_id(subscription.id)
         if sub_record:
-            await db.subscriptions.update_one(
-                {"stripe_subscription_id": subscription.id},
-                {"$set": {"status": "canceled", "updated_at": datetime.utcnow()}}
+            now = datetime.utcnow()
+            await repos.subscriptions.update_by_stripe_id(
+                subscription.id,
+                {"status": "canceled", "updated_at": now, **churn_fields(sub_record["status"], "canceled", now)}
             )
-            
-            # Remove user from group
-            await bot.ban_chat_member(
-                chat_id=GROUP_ID,
-                user_id=sub_record["telegram_user_id"]
+            await publish_subscription_event(
+                "subscription.canceled", dict(sub_record, status="canceled"), sub_record["status"]
             )
             
-            await bot.unban_chat_member(
-                chat_id=GROUP_ID,
-                user_id=sub_record["telegram_user_id"]
+            # Remove user from group
+            await remove_from_group(
+                sub_record["telegram_user_id"], plan_registry.for_subscription(sub_record)["group_id"]
             )
             
             # Notify user
@@ -594,22 +1769,26 @@ async def handle_subscription_deleted(subscription):
 async def handle_invoice_payment_succeeded(invoice):
     """Handle successful invoice payment (renewals)"""
     try:
-        subscription = stripe.Subscription.retrieve(invoice.subscription)
+        subscription = await asyncio.to_thread(stripe.Subscription.retrieve, invoice.subscription)
+        sub_record = await repos.subscriptions.get_by_stripe_id(subscription.id)
         
-        # Update subscription in database
-        await db.subscriptions.update_one(
-            {"stripe_subscription_id": subscription.id},
-            {"$set": {
-                "status": "active",
-                "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
-                "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
-                "updated_at": datetime.utcnow()
-            }}
-        )
+        # Update subscription in database; the new period gets fresh reminders
+        now = datetime.utcnow()
+        fields = {
+            "status": "active",
+            "current_period_start": datetime.fromtimestamp(subscription.current_period_start),
+            "current_period_end": datetime.fromtimestamp(subscription.current_period_end),
+            "reminders_sent": [],
+            "updated_at": now,
+            **churn_fields(sub_record["status"] if sub_record else None, "active", now)
+        }
+        await repos.subscriptions.update_by_stripe_id(subscription.id, fields)
         
-        # Get user and send notification
-        sub_record = await db.subscriptions.find_one({"stripe_subscription_id": subscription.id})
+        # Notify dashboards and the user
         if sub_record:
+            await publish_subscription_event(
+                "subscription.renewed", dict(sub_record, **fields), sub_record["status"]
+            )
             await bot.send_message(
                 chat_id=sub_record["telegram_user_id"],
                 text=f"✅ Підписка продовжена! Діє до {datetime.fromtimestamp(subscription.current_period_end).strftime('%d.%m.%Y')}"
@@ -623,10 +1802,10 @@ async def handle_invoice_payment_succeeded(invoice):
 async def handle_invoice_payment_failed(invoice):
     """Handle failed invoice payment"""
     try:
-        subscription = stripe.Subscription.retrieve(invoice.subscription)
+        subscription = await asyncio.to_thread(stripe.Subscription.retrieve, invoice.subscription)
         
         # Get user and send notification
-        sub_record = await db.subscriptions.find_one({"stripe_subscription_id": subscription.id})
+        sub_record = await repos.subscriptions.get_by_stripe_id(subscription.id)
         if sub_record:
             await bot.send_message(
                 chat_id=sub_record["telegram_user_id"],
@@ -639,49 +1818,94 @@ async def handle_invoice_payment_failed(invoice):
         logging.error(f"Error handling invoice payment failure: {str(e)}")
 
 # Admin API Routes
-@api_router.get("/admin/subscribers")
-async def get_subscribers():
+def cache_validators(request: Request, *collections: str):
+    """ETag/Last-Modified headers for data read from collections, and whether the client copy is current"""
+    etag = repos.changes.etag(*collections)
+    last_modified = repos.changes.last_modified(*collections)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True),
+        "Cache-Control": "private, no-cache"
+    }
+    
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return headers, etag in tags or "*" in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).astimezone(timezone.utc).replace(tzinfo=None)
+            return headers, last_modified.replace(microsecond=0) <= since
+        except (TypeError, ValueError):
+            pass
+    return headers, False
+
+async def conditional_admin_response(request: Request, name: str, collections: Tuple[str, ...], build):
+    """Answer 304 or a cached body while collections are unchanged, otherwise build and render"""
+    headers, fresh = cache_validators(request, *collections)
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    
+    cached = admin_response_cache.get(name)
+    if cached and cached[0] == headers["ETag"]:
+        return Response(content=cached[1], media_type="application/json", headers=headers)
+    
+    # Built after the tag is taken, so a concurrent write can only make the body newer than its tag
+    response = ORJSONResponse(await build(), headers=headers)
+    admin_response_cache[name] = (headers["ETag"], response.body)
+    return response
+
+async def build_subscribers():
+    """Active subscribers joined with their user details"""
+    subscribers = await repos.subscriptions.find_active(SUBSCRIBER_FIELDS)
+    
+    # Enhance with user details, fetched in one query
+    users = await repos.users.find_by_ids(
+        list({sub["user_id"] for sub in subscribers}),
+        ["id", "telegram_username", "email"]
+    )
+    users_by_id = {user["id"]: user for user in users}
+    
+    for sub in subscribers:
+        sub.setdefault("plan_id", DEFAULT_PLAN_ID)
+        user = users_by_id.get(sub.pop("user_id"), {})
+        sub["telegram_username"] = user.get("telegram_username")
+        sub["email"] = user.get("email")
+    
+    # Rows already match SubscriberOut; they are rendered directly instead of re-validated
+    return {"subscribers": subscribers}
+
+@admin_router.get("/subscribers", response_model=SubscribersResponse)
+async def get_subscribers(request: Request):
     """Get all active subscribers"""
     try:
-        subscribers = await db.subscriptions.find({"status": "active"}).to_list(length=None)
-        
-        # Enhance with user details
-        enhanced_subscribers = []
-        for sub in subscribers:
-            user = await db.users.find_one({"id": sub["user_id"]})
-            subscriber_info = {
-                "id": sub["id"],
-                "telegram_user_id": sub["telegram_user_id"],
-                "telegram_username": user.get("telegram_username") if user else None,
-                "email": user.get("email") if user else None,
-                "current_period_end": sub["current_period_end"],
-                "created_at": sub["created_at"],
-                "amount": sub["amount"],
-                "currency": sub["currency"]
-            }
-            enhanced_subscribers.append(subscriber_info)
-        
-        return {"subscribers": enhanced_subscribers}
+        return await conditional_admin_response(
+            request, "subscribers", ("subscriptions", "users"), build_subscribers
+        )
         
     except Exception as e:
         logging.error(f"Error getting subscribers: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.post("/admin/add-subscriber")
+@admin_router.post("/add-subscriber")
 async def add_subscriber_manually(data: ManualSubscriptionAdd):
     """Manually add a subscriber"""
     try:
         # Try to find user by telegram username
-        user = await db.users.find_one({"telegram_username": data.telegram_username})
+        user = await repos.users.get_by_username(data.telegram_username)
         
         if not user:
             return {"error": "User not found. User must start the bot first."}
         
+        if data.plan_id not in plan_registry.by_id:
+            return {"error": "Unknown plan."}
+        plan = plan_registry.get(data.plan_id)
+        
         # Check if user already has active subscription
-        existing_sub = await db.subscriptions.find_one({
-            "telegram_user_id": user["telegram_user_id"],
-            "status": "active"
-        })
+        existing_sub = await repos.subscriptions.get_active(user["telegram_user_id"], [plan["id"]])
         
         if existing_sub:
             return {"error": "User already has an active subscription."}
@@ -693,26 +1917,27 @@ async def add_subscriber_manually(data: ManualSubscriptionAdd):
             user_id=user["id"],
             telegram_user_id=user["telegram_user_id"],
             status="active",
-            amount=SUBSCRIPTION_PRICE,
-            currency=CURRENCY,
+            plan_id=plan["id"],
+            amount=plan["amount"],
+            currency=plan["currency"],
             current_period_start=datetime.utcnow(),
             current_period_end=end_date
         )
         
-        await db.subscriptions.insert_one(subscription.dict())
+        await repos.subscriptions.insert(subscription.dict())
         
         # Update user email if provided
         if data.email:
-            await db.users.update_one(
-                {"id": user["id"]},
-                {"$set": {"email": data.email}}
-            )
+            await repos.users.set_email(user["id"], data.email)
+        
+        await publish_subscription_event("subscription.created", subscription.dict(), None)
         
         # Send notification to user
+        invite_link = await get_invite_link(user["telegram_user_id"], plan)
         await bot.send_message(
             chat_id=user["telegram_user_id"],
             text=f"✅ Вам була надана підписка до {end_date.strftime('%d.%m.%Y')}\n\n"
-                 f"Приєднуйтесь до групи: {GROUP_INVITE_LINK}"
+                 f"Приєднуйтесь до групи: {invite_link}"
         )
         
         return {"success": True, "message": "Subscriber added successfully"}
@@ -721,46 +1946,403 @@ async def add_subscriber_manually(data: ManualSubscriptionAdd):
         logging.error(f"Error adding subscriber: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/admin/stats")
-async def get_admin_stats():
-    """Get admin statistics"""
+class PendingLines:
+    """Line source for a csv.reader that is refilled as the request body streams in"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def iter_import_rows(request: Request, fmt: str):
+    """Yield (row_number, raw_dict) pairs from a streamed CSV or NDJSON body"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    row_number = 0
+
+    # One reader for the whole body; it only reads once a record's quotes are balanced,
+    # so quoted fields may span lines and chunks
+    pending = PendingLines()
+    reader = csv.reader(pending)
+    header = None
+    quotes = 0
+
+    def parse(line):
+        nonlocal header, quotes
+        if fmt == "ndjson":
+            return json.loads(line) if line.strip() else None
+        pending.lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            return None
+        quotes = 0
+        values = next(reader, [])
+        if not any(value.strip() for value in values):
+            return None
+        if header is None:
+            header = [name.strip() for name in values]
+            return None
+        return dict(zip(header, values))
+
+    def parse_lines(lines):
+        nonlocal row_number, quotes
+        for line in lines:
+            try:
+                raw = parse(line)
+            except Exception as e:
+                pending.lines.clear()
+                quotes = 0
+                raw = e
+            if raw is not None:
+                row_number += 1
+                yield row_number, raw
+
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for item in parse_lines(line + "\n" for line in lines):
+            yield item
+
+    buffer += decoder.decode(b"", final=True)
+    for item in parse_lines([buffer] if buffer else []):
+        yield item
+    if quotes % 2:
+        yield row_number + 1, ValueError("unterminated quoted field")
+
+async def import_subscriber_batch(batch, dry_run: bool, notify: bool, report: Dict, seen: Dict):
+    """Validate, resolve and upsert one batch of import rows"""
+    rows = []
+    for row_number, raw in batch:
+        if isinstance(raw, Exception):
+            report["errors"].append({"row": row_number, "error": f"Unparseable row: {raw}"})
+            continue
+        if isinstance(raw, dict):
+            raw = {key: value for key, value in raw.items() if value not in ("", None)}
+        try:
+            rows.append((row_number, SubscriberImportRow.model_validate(raw)))
+        except ValidationError as e:
+            report["errors"].append({"row": row_number, "error": e.errors(include_url=False)})
+
+    if not rows:
+        return
+
+    # Resolve all users of the batch with a single query
+    user_ids = [row.telegram_user_id for _, row in rows if row.telegram_user_id is not None]
+    usernames = [row.telegram_username for _, row in rows if row.telegram_username]
+    users = await repos.users.find_by_telegram_ids_or_usernames(user_ids, usernames)
+    users_by_id = {user["telegram_user_id"]: user for user in users}
+    users_by_username = {user["telegram_username"]: user for user in users if user.get("telegram_username")}
+
+    now = datetime.utcnow()
+    new_users = []
+    emails = []
+    grants = []
+    notifications = []
+
+    for row_number, row in rows:
+        if row.plan_id not in plan_registry.by_id:
+            report["errors"].append({"row": row_number, "error": f"Unknown plan: {row.plan_id}"})
+            continue
+        plan = plan_registry.get(row.plan_id)
+
+        user = None
+        if row.telegram_user_id is not None:
+            user = users_by_id.get(row.telegram_user_id)
+        if user is None and row.telegram_username:
+            user = users_by_username.get(row.telegram_username)
+
+        if user is None:
+            if row.telegram_user_id is None:
+                report["errors"].append({
+                    "row": row_number,
+                    "error": "User not found. Provide telegram_user_id or ask the user to start the bot first."
+                })
+                continue
+            # Migrated members who never started the bot get a user record
+            user = User(
+                telegram_user_id=row.telegram_user_id,
+                telegram_username=row.telegram_username,
+                email=row.email,
+                is_admin=row.telegram_user_id in ADMIN_USER_IDS
+            ).dict()
+            new_users.append(user)
+            users_by_id[row.telegram_user_id] = user
+        elif row.email:
+            emails.append((user["id"], row.email))
+
+        telegram_user_id = user["telegram_user_id"]
+        if (telegram_user_id, row.plan_id) in seen:
+            report["errors"].append({
+                "row": row_number,
+                "error": f"Duplicate of row {seen[(telegram_user_id, row.plan_id)]}"
+            })
+            continue
+        seen[(telegram_user_id, row.plan_id)] = row_number
+
+        end_date = row.current_period_end or now + timedelta(days=row.duration_days)
+        new_subscription = Subscription(
+            user_id=user["id"],
+            telegram_user_id=telegram_user_id,
+            status="active",
+            plan_id=plan["id"],
+            amount=plan["amount"],
+            currency=plan["currency"],
+            current_period_start=now,
+            current_period_end=end_date
+        ).dict()
+        grants.append((new_subscription, end_date))
+        notifications.append((
+            telegram_user_id,
+            f"✅ Вам була надана підписка до {end_date.strftime('%d.%m.%Y')}\n\n"
+            f"Приєднуйтесь до групи: {plan.get('invite_link') or GROUP_INVITE_LINK}"
+        ))
+
+    report["valid"] += len(grants)
+    if dry_run or not grants:
+        return
+
+    await repos.users.insert_missing(new_users)
+    await repos.users.set_emails(emails)
+    # Extending an existing active subscription never shortens it
+    created, extended = await repos.subscriptions.grant_active(grants, now)
+    report["created"] += created
+    report["updated"] += extended
+    for subscription, _ in grants:
+        active_members.setdefault(plan_registry.for_subscription(subscription)["group_id"], set()).add(
+            subscription["telegram_user_id"]
+        )
+    publish_dashboard_event("resync")
+
+    if notify:
+        for chat_id, text in notifications:
+            await enqueue_notification(chat_id, text)
+
+@admin_router.post("/import-subscribers")
+async def import_subscribers(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    dry_run: bool = False,
+    notify: bool = True
+):
+    """Bulk import subscribers from a streamed CSV or NDJSON body"""
+    fmt = format
+    if fmt is None:
+        content_type = request.headers.get("content-type", "")
+        fmt = "csv" if "csv" in content_type else "ndjson"
+
+    report = {"dry_run": dry_run, "rows": 0, "valid": 0, "created": 0, "updated": 0, "errors": []}
+    # First row per (Telegram user, plan) across all batches, for duplicate reports
+    seen = {}
+    try:
+        batch = []
+        async for row_number, raw in iter_import_rows(request, fmt):
+            report["rows"] = row_number
+            batch.append((row_number, raw))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await import_subscriber_batch(batch, dry_run, notify, report, seen)
+                batch = []
+        if batch:
+            await import_subscriber_batch(batch, dry_run, notify, report, seen)
+
+        logging.info(
+            f"Subscriber import finished: {report['rows']} rows, {report['valid']} valid, "
+            f"{len(report['errors'])} errors (dry_run={dry_run})"
+        )
+        return report
+
+    except Exception as e:
+        logging.error(f"Error importing subscribers: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.post("/reconcile")
+async def run_reconciliation(full: bool = False):
+    """Reconcile subscriptions with Stripe now"""
     try:
-        total_users = await db.users.count_documents({})
-        total_active_subs = await db.subscriptions.count_documents({"status": "active"})
-        total_expired_subs = await db.subscriptions.count_documents({"status": "expired"})
-        total_canceled_subs = await db.subscriptions.count_documents({"status": "canceled"})
+        report = await reconcile_subscriptions(full=full)
+        if report is None:
+            raise HTTPException(status_code=409, detail="Reconciliation already running")
+        return report
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error running reconciliation: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.post("/drain")
+async def drain(request: Request, x_drain_token: Optional[str] = Header(None)):
+    """Pre-stop hook: drain running work before the server stops accepting connections"""
+    # Draining can't be undone, so only the pod itself or a holder of the token may start it
+    host = request.client.host if request.client else ""
+    trusted = host in ("127.0.0.1", "::1", "localhost")
+    if not trusted and not (DRAIN_TOKEN and x_drain_token and hmac.compare_digest(x_drain_token, DRAIN_TOKEN)):
+        raise HTTPException(status_code=403, detail="Drain is only allowed from loopback or with X-Drain-Token")
+    
+    await start_draining()
+    return {"status": "drained", "running": sorted(in_flight_work.values())}
+
+@admin_router.get("/events")
+async def dashboard_events():
+    """Server-sent events with incremental dashboard updates"""
+    queue = asyncio.Queue(maxsize=DASHBOARD_QUEUE_SIZE)
+    dashboard_clients.add(queue)
+    
+    async def stream():
+        # Draining closes the stream so the client reconnects to another replica
+        draining = asyncio.ensure_future(drain_started.wait())
+        try:
+            # Ask the client to resync whenever it (re)connects
+            yield "retry: 5000\nevent: resync\ndata: {}\n\n"
+            while True:
+                message = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    {message, draining}, timeout=DASHBOARD_HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED
+                )
+                if message in done:
+                    yield message.result()
+                    continue
+                message.cancel()
+                if draining in done:
+                    return
+                yield ": heartbeat\n\n"
+        finally:
+            draining.cancel()
+            dashboard_clients.discard(queue)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # identity encoding keeps the compression middleware from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"}
+    )
+
+async def build_admin_stats():
+    """Subscription counts, revenue and recent transactions"""
+    (
+        total_users,
+        total_active_subs,
+        total_expired_subs,
+        total_canceled_subs,
+        recent_transactions,
+        revenue,
+        archive
+    ) = await asyncio.gather(
+        repos.users.count(),
+        repos.subscriptions.count_by_status("active"),
+        repos.subscriptions.count_by_status("expired"),
+        repos.subscriptions.count_by_status("canceled"),
         # Get recent transactions
-        recent_transactions = await db.payment_transactions.find(
-            {"status": "completed"}
-        ).sort("created_at", -1).limit(10).to_list(length=10)
+        repos.transactions.recent_completed(10, TRANSACTION_FIELDS),
+        # Calculate revenue; archived transactions are kept as a running total
+        repos.transactions.total_completed_revenue(),
+        repos.sync_state.get("transaction_archive")
+    )
+    
+    return {
+        "total_users": total_users,
+        "active_subscriptions": total_active_subs,
+        "expired_subscriptions": total_expired_subs,
+        "canceled_subscriptions": total_canceled_subs,
+        "total_revenue": revenue + (archive or {}).get("revenue", 0),
+        "recent_transactions": recent_transactions
+    }
+
+@admin_router.get("/stats", response_model=AdminStatsResponse)
+async def get_admin_stats(request: Request):
+    """Get admin statistics"""
+    try:
+        return await conditional_admin_response(
+            request, "stats", ("users", "subscriptions", "payment_transactions"), build_admin_stats
+        )
         
-        # Calculate revenue
-        total_revenue = await db.payment_transactions.aggregate([
-            {"$match": {"status": "completed"}},
-            {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]).to_list(length=1)
+    except Exception as e:
+        logging.error(f"Error getting admin stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.get("/analytics", response_model=AnalyticsResponse)
+async def get_analytics(
+    period: str = Query("day", pattern="^(day|week|month)$"),
+    days: int = Query(90, ge=1, le=3660)
+):
+    """Revenue, new and churned subscribers and MRR bucketed by day, week or month"""
+    try:
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=days - 1)
+        daily = {
+            doc["_id"]: doc
+            for doc in await repos.analytics.daily(start.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
+        }
         
-        revenue = total_revenue[0]["total"] if total_revenue else 0
+        # Every bucket is present, empty ones included, so charts have a continuous axis
+        buckets: Dict[str, Dict] = {}
+        latest: Dict = {}
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            bucket = buckets.setdefault(bucket_start(day, period), {"start": bucket_start(day, period)})
+            doc = daily.get(day.strftime("%Y-%m-%d"))
+            if doc is None:
+                continue
+            for metric in ("revenue", "payments", "new_subscribers", "churned_subscribers"):
+                bucket[metric] = bucket.get(metric, 0) + doc.get(metric, 0)
+            if "mrr" in doc:
+                bucket["mrr"] = doc["mrr"]
+                bucket["active_subscribers"] = doc.get("active_subscribers")
+                latest = doc
         
+        state = await repos.sync_state.get("analytics") or {}
         return {
-            "total_users": total_users,
-            "active_subscriptions": total_active_subs,
-            "expired_subscriptions": total_expired_subs,
-            "canceled_subscriptions": total_canceled_subs,
-            "total_revenue": revenue,
-            "recent_transactions": recent_transactions
+            "period": period,
+            "mrr": latest.get("mrr"),
+            "active_subscribers": latest.get("active_subscribers"),
+            "refreshed_at": state.get("refreshed_at"),
+            "buckets": list(buckets.values())
         }
         
     except Exception as e:
-        logging.error(f"Error getting admin stats: {str(e)}")
+        logging.error(f"Error getting analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.get("/plans", response_model=List[Plan])
+async def get_plans():
+    """Plans currently loaded in the registry, including the default plan"""
+    return list(plan_registry.by_id.values())
+
+@admin_router.post("/plans", response_model=Plan)
+async def upsert_plan(plan: Plan):
+    """Create or replace a plan; other processes pick it up through the change watcher"""
+    # Webhooks map prices back to plans, so every other plan needs a price of its own
+    if plan.id != DEFAULT_PLAN_ID and not plan.stripe_price_id:
+        raise HTTPException(status_code=400, detail="stripe_price_id is required")
+    owner = plan_registry.by_price_id.get(plan.stripe_price_id)
+    if owner and owner["id"] != plan.id:
+        raise HTTPException(status_code=400, detail=f"Price already used by plan {owner['id']}")
+
+    try:
+        await repos.plans.upsert(plan.dict())
+        await reload_plans_and_members()
+        return plan
+        
+    except Exception as e:
+        logging.error(f"Error saving plan: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Initialize bot
 async def init_bot():
     """Initialize the Telegram bot"""
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Each user's updates stay in order; a slow Stripe call only delays that user
+        application = Application.builder().bot(telegram_bot).concurrent_updates(
+            PerUserUpdateProcessor(TELEGRAM_CONCURRENT_UPDATES, TELEGRAM_PENDING_UPDATES_PER_USER)
+        ).build()
+        
+        # Rate limiting runs before every other handler group
+        application.add_handler(TypeHandler(Update, rate_limit_update), group=-1)
         
         # Add handlers
         application.add_handler(CommandHandler("start", start_command))
@@ -770,12 +2352,17 @@ async def init_bot():
         from telegram.ext import CallbackQueryHandler
         application.add_handler(CallbackQueryHandler(button_callback))
         
+        # Group access control
+        application.add_handler(ChatJoinRequestHandler(chat_join_request))
+        application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+        
         # Initialize bot
         await application.initialize()
         await application.start()
         
         # Start polling in background
-        await application.updater.start_polling()
+        # chat_member updates are only delivered when requested explicitly
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
         
         logging.info("Telegram bot initialized successfully")
         return application
@@ -784,17 +2371,6 @@ async def init_bot():
         logging.error(f"Error initializing bot: {str(e)}")
         raise
 
-# Include the router in the main app
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -804,45 +2380,281 @@ logger = logging.getLogger(__name__)
 
 # Global variables for bot and scheduler
 telegram_app = None
+startup_task = None
+change_watch_task = None
+notification_task = None
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize services on startup"""
+async def save_resume_token(resume_token):
+    """Persist the change stream position so a restart resumes where it left off"""
+    await repos.sync_state.set("change_stream", {"resume_token": resume_token, "updated_at": datetime.utcnow()})
+
+async def poll_collection_changes(collections: List[str]):
+    """Fallback for standalone mongod: invalidate when a collection's fingerprint changes"""
+    signatures = await repos.change_signatures(collections)
+    while True:
+        await asyncio.sleep(CHANGE_POLL_SECONDS)
+        try:
+            current = await repos.change_signatures(collections)
+        except Exception as e:
+            logging.error(f"Error polling for changes: {str(e)}")
+            continue
+        for collection, signature in current.items():
+            if signature != signatures.get(collection):
+                repos.changes.bump(collection, remote=True)
+        signatures = current
+
+async def watch_collection_changes():
+    """Invalidate local caches when any process writes to the tracked collections"""
+    collections = repos.tracked_collections()
+    state = await repos.sync_state.get("change_stream") or {}
+    resume_token = state.get("resume_token")
+    saved_token = resume_token
+    
+    while True:
+        last_checkpoint = time.monotonic()
+        try:
+            async for collection, resume_token in repos.watch_changes(collections, resume_token):
+                repos.changes.bump(collection, remote=True)
+                if time.monotonic() - last_checkpoint >= CHANGE_CHECKPOINT_SECONDS:
+                    await save_resume_token(resume_token)
+                    saved_token = resume_token
+                    last_checkpoint = time.monotonic()
+        except ChangeStreamUnsupported:
+            break
+        except ChangeStreamHistoryLost:
+            # Missed changes can't be replayed, so drop everything cached
+            logging.warning("Change stream resume token expired, invalidating all caches")
+            resume_token = None
+            for collection in collections:
+                repos.changes.bump(collection, remote=True)
+        except Exception as e:
+            logging.error(f"Change stream error: {str(e)}")
+            await asyncio.sleep(CHANGE_POLL_SECONDS)
+        finally:
+            if resume_token != saved_token:
+                await save_resume_token(resume_token)
+                saved_token = resume_token
+    
+    logging.info(f"Change streams unavailable, polling for changes every {CHANGE_POLL_SECONDS}s")
+    await poll_collection_changes(collections)
+
+async def timed_startup(name: str, init):
+    """Run one startup step and record its outcome and duration"""
+    started = time.perf_counter()
+    startup_report[name] = {"status": "starting"}
+    try:
+        await init()
+        startup_report[name] = {"status": "ready", "seconds": round(time.perf_counter() - started, 3)}
+    except Exception as e:
+        startup_report[name] = {
+            "status": "failed",
+            "error": str(e),
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+        logging.error(f"Error initializing {name}: {str(e)}")
+
+async def start_telegram():
+    """Connect the bot, retrying with backoff so a Telegram hiccup doesn't need a restart"""
     global telegram_app
     
+    for attempt in range(1, TELEGRAM_INIT_ATTEMPTS + 1):
+        try:
+            telegram_app = await init_bot()
+            return
+        except Exception:
+            if attempt == TELEGRAM_INIT_ATTEMPTS:
+                raise
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+async def init_storage():
+    """Create indexes, load the plans and member sets used for group access checks, requeue saved notifications"""
+    await repos.ensure_indexes()
+    await reload_plans_and_members()
+    await restore_pending_notifications()
+
+async def initialize_services():
+    """Initialize storage, the Stripe catalog and Telegram concurrently"""
+    global change_watch_task
+    
+    started = time.perf_counter()
+    await asyncio.gather(
+        timed_startup("storage", init_storage),
+        timed_startup("stripe", load_stripe_catalog),
+        timed_startup("telegram", start_telegram)
+    )
+    
+    # Other replicas write to the same database; keep local caches in step with them
+    if repos.shared and startup_report["storage"]["status"] == "ready":
+        change_watch_task = asyncio.create_task(watch_collection_changes())
+    
+    startup_report["total"] = {"seconds": round(time.perf_counter() - started, 3)}
+    logging.info(f"Background startup finished: {startup_report}")
+
+async def startup_event():
+    """Start background services without waiting for external connections"""
+    global startup_task, notification_task
+    
     try:
-        # Initialize bot
-        telegram_app = await init_bot()
+        startup_report["app"] = {"seconds": round(time.perf_counter() - IMPORT_STARTED, 3)}
+        startup_task = asyncio.create_task(initialize_services())
+        repos.changes.subscribe(on_storage_change)
+        
+        # Start delivering queued notifications
+        notification_task = asyncio.create_task(notification_worker())
         
         # Start scheduler
         scheduler.add_job(
-            check_expired_subscriptions,
+            drained_job(check_expired_subscriptions),
             IntervalTrigger(minutes=5),  # Check every 5 minutes
             id='check_expired_subscriptions'
         )
+        scheduler.add_job(
+            drained_job(reconcile_subscriptions),
+            IntervalTrigger(minutes=RECONCILE_INTERVAL_MINUTES),
+            id='reconcile_subscriptions'
+        )
+        scheduler.add_job(
+            drained_job(send_renewal_reminders),
+            IntervalTrigger(minutes=REMINDER_INTERVAL_MINUTES),
+            id='send_renewal_reminders'
+        )
+        scheduler.add_job(
+            drained_job(refresh_analytics),
+            IntervalTrigger(minutes=ANALYTICS_REFRESH_MINUTES),
+            id='refresh_analytics'
+        )
+        scheduler.add_job(
+            drained_job(apply_transaction_retention),
+            IntervalTrigger(minutes=RETENTION_INTERVAL_MINUTES),
+            id='apply_transaction_retention'
+        )
+        scheduler.add_job(
+            drained_job(refresh_analytics),
+            CronTrigger(hour=ANALYTICS_REBUILD_HOUR, timezone=timezone.utc),
+            kwargs={"full": True},
+            id='rebuild_analytics'
+        )
         scheduler.start()
         
-        logging.info("All services initialized successfully")
+        logging.info(f"API serving after {startup_report['app']['seconds']}s, services connecting in background")
         
     except Exception as e:
         logging.error(f"Error during startup: {str(e)}")
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup on shutdown"""
-    global telegram_app
+async def drain_work():
+    """Stop taking new work and let running work finish within SHUTDOWN_DRAIN_SECONDS while still serving"""
+    global shutting_down
     
     try:
-        if telegram_app:
-            await telegram_app.stop()
-            await telegram_app.shutdown()
+        shutting_down = True
+        drain_started.set()
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+        logging.info("Draining: refusing new work")
+        
+        def remaining() -> float:
+            return max(0.0, deadline - time.monotonic())
         
+        if startup_task and not startup_task.done():
+            startup_task.cancel()
+        
+        # No new job runs; running ones are awaited below
         if scheduler.running:
-            scheduler.shutdown()
+            scheduler.shutdown(wait=False)
+        
+        # Stop fetching updates and finish handling the fetched ones
+        if telegram_app:
+            if telegram_app.updater.running:
+                await telegram_app.updater.stop()
+            try:
+                await asyncio.wait_for(telegram_app.stop(), remaining())
+            except asyncio.TimeoutError:
+                logging.warning("Shutdown deadline passed while handling Telegram updates")
         
-        client.close()
+        work = dict(in_flight_work)
+        if work:
+            logging.info(f"Waiting for {len(work)} running jobs and webhooks")
+            _, pending = await asyncio.wait(list(work), timeout=remaining())
+            if pending:
+                logging.warning(f"Shutdown deadline passed with work still running: {[work[task] for task in pending]}")
+        
+        # Deliver what fits in the remaining time and keep the rest for the next process
+        if notification_task:
+            try:
+                await asyncio.wait_for(notification_queue.join(), remaining())
+            except asyncio.TimeoutError:
+                pass
+            notification_task.cancel()
+            try:
+                await notification_task
+            except asyncio.CancelledError:
+                pass
+            await save_pending_notifications()
+        
+        logging.info("Drained running work")
+        
+    except Exception as e:
+        logging.error(f"Error while draining: {str(e)}")
+
+def start_draining() -> asyncio.Task:
+    """Start draining; later calls share the drain already running"""
+    global drain_task
+    if drain_task is None:
+        drain_task = asyncio.create_task(drain_work())
+    return drain_task
+
+async def shutdown_event():
+    """Drain if the pre-stop hook has not already, then close connections"""
+    try:
+        await start_draining()
+        # Notifications queued after the drain, e.g. by admin requests, go to the next process
+        await save_pending_notifications()
+        
+        # Its finally saves the resume token, which needs storage still open
+        if change_watch_task:
+            change_watch_task.cancel()
+            try:
+                await change_watch_task
+            except asyncio.CancelledError:
+                pass
+        
+        if telegram_app:
+            await telegram_app.shutdown()
+        
+        repos.close()
         
         logging.info("All services shut down successfully")
         
     except Exception as e:
-        logging.error(f"Error during shutdown: {str(e)}")
\ No newline at end of file
+        logging.error(f"Error during shutdown: {str(e)}")
+
+def create_app() -> FastAPI:
+    """Build the FastAPI application; services start in the background on startup"""
+    application = FastAPI()
+    
+    # Include the router in the main app
+    application.include_router(api_router)
+    application.include_router(admin_router, prefix="/api")
+    
+    # Compress large payloads (admin lists); brotli when available, gzip otherwise
+    if BrotliMiddleware is not None:
+        application.add_middleware(
+            BrotliMiddleware,
+            minimum_size=COMPRESSION_MINIMUM_SIZE,
+            excluded_handlers=[r"^/api/admin/events"]
+        )
+    else:
+        application.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+    
+    application.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    
+    application.add_event_handler("startup", startup_event)
+    application.add_event_handler("shutdown", shutdown_event)
+    return application
+
+app = create_app()
@@ -0,0 +1,177 @@
+from telegram import Bot, Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import BaseUpdateProcessor
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+from collections import deque
+import asyncio
+import logging
+import random
+import time
+
+
+class CircuitOpenError(Exception):
+    """Telegram has been failing; the call was not attempted"""
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets a probe through once reset_seconds have passed"""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and self.retry_in() > 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if self.is_open else "half-open"
+
+    def retry_in(self) -> float:
+        """Seconds until the next probe is allowed"""
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # A failed probe in half-open state reopens immediately
+            self.opened_at = time.monotonic()
+
+
+class ResilientBot:
+    """Bot wrapper with per-method timeouts, retries with jitter and a circuit breaker
+
+    Bot API methods not defined here are proxied through call(). While the circuit
+    is open they fail fast with CircuitOpenError, except plain send_message calls,
+    which are handed to defer (e.g. the notification queue) instead.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        breaker: CircuitBreaker,
+        method_timeouts: Optional[Dict[str, float]] = None,
+        default_timeout: float = 5,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 5,
+        defer: Optional[Callable[[int, str], Awaitable[None]]] = None
+    ):
+        self.bot = bot
+        self.breaker = breaker
+        self.method_timeouts = method_timeouts or {}
+        self.default_timeout = default_timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.defer = defer
+
+    async def call(self, method: str, *args, **kwargs):
+        """Call a Bot API method, retrying transient errors with full jitter backoff"""
+        kwargs.setdefault("read_timeout", self.method_timeouts.get(method, self.default_timeout))
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker.is_open:
+                raise CircuitOpenError(f"Telegram circuit open, retry in {self.breaker.retry_in():.0f}s")
+            try:
+                result = await getattr(self.bot, method)(*args, **kwargs)
+                self.breaker.record_success()
+                return result
+            except RetryAfter as e:
+                # Flood control is Telegram working as intended, not an outage
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                if attempt == self.max_attempts or delay > self.max_delay:
+                    raise
+                await asyncio.sleep(delay)
+            except BadRequest:
+                raise
+            except NetworkError:
+                self.breaker.record_failure()
+                if attempt == self.max_attempts:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        """Send a message, deferring plain texts to the queue while Telegram is failing"""
+        if self.defer is not None and not kwargs and self.breaker.is_open:
+            await self.defer(chat_id, text)
+            return None
+        try:
+            return await self.call("send_message", chat_id=chat_id, text=text, **kwargs)
+        except CircuitOpenError:
+            if self.defer is None or kwargs:
+                raise
+            await self.defer(chat_id, text)
+            return None
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.bot, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+        return method
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently and each user's updates in order
+
+    An update from a user who is already being served is queued behind that user's
+    running update and its slot is released, so max_concurrent_updates bounds the
+    number of users served at once. Updates beyond max_pending_per_user are dropped.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_per_user: int = 20):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_user = max_pending_per_user
+        self.pending: Dict[int, Deque[Awaitable[Any]]] = {}
+        self.dropped = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+
+        queue = self.pending.get(user.id)
+        if queue is not None:
+            if len(queue) >= self.max_pending_per_user:
+                coroutine.close()
+                self.dropped += 1
+                logging.warning(f"Dropped update {update.update_id} from {user.id}: too many pending")
+                return
+            queue.append(coroutine)
+            return
+
+        queue = self.pending[user.id] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as e:
+                    # Application.process_update handles handler errors; this only guards the queue
+                    logging.error(f"Error processing update from {user.id}: {str(e)}")
+                if not queue:
+                    break
+                coroutine = queue.popleft()
+        finally:
+            del self.pending[user.id]
+            for leftover in queue:
+                leftover.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
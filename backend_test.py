@@ -34,6 +34,18 @@ class TestTelegramBotBackend(unittest.TestCase):
         self.assertIn("message", data)
         print(f"✅ Root endpoint test passed: {data}")
 
+    def test_health_endpoints(self):
+        """Test the liveness and readiness endpoints"""
+        response = requests.get(f"{API_URL}/health/live", timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "alive")
+        
+        response = requests.get(f"{API_URL}/health/ready", timeout=10)
+        self.assertIn(response.status_code, (200, 503))
+        data = response.json()
+        self.assertIn("services", data)
+        print(f"✅ Health endpoints test passed: {data['status']}")
+
     def test_status_endpoint_get(self):
         """Test the GET status endpoint to verify database connectivity"""
         response = requests.get(f"{API_URL}/status", timeout=10)
@@ -81,6 +93,23 @@ class TestTelegramBotBackend(unittest.TestCase):
         
         print(f"✅ Admin subscribers endpoint test passed: {len(data['subscribers'])} subscribers found")
 
+    def test_admin_analytics_endpoint(self):
+        """Test the admin analytics endpoint returns continuous buckets"""
+        response = requests.get(f"{API_URL}/admin/analytics", params={"period": "week", "days": 28}, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        
+        self.assertEqual(data["period"], "week")
+        self.assertIn(len(data["buckets"]), (4, 5))
+        for bucket in data["buckets"]:
+            self.assertIn("revenue", bucket)
+            self.assertIn("churned_subscribers", bucket)
+        
+        response = requests.get(f"{API_URL}/admin/analytics", params={"period": "year"}, timeout=10)
+        self.assertEqual(response.status_code, 422)
+        
+        print(f"✅ Admin analytics endpoint test passed: MRR {data['mrr']}")
+
     def test_admin_add_subscriber(self):
         """Test the admin add subscriber endpoint"""
         # Test data for adding a subscriber
@@ -102,6 +131,31 @@ class TestTelegramBotBackend(unittest.TestCase):
             self.assertIn("success", data)
             print(f"✅ Admin add subscriber test passed: {data}")
 
+    def test_admin_import_subscribers_dry_run(self):
+        """Test the bulk import endpoint in dry-run mode"""
+        csv_body = (
+            "telegram_user_id,telegram_username,email,duration_days\n"
+            "123456789,test_user,test@example.com,30\n"
+            ",,,30\n"
+        )
+        response = requests.post(
+            f"{API_URL}/admin/import-subscribers",
+            params={"format": "csv", "dry_run": "true"},
+            data=csv_body.encode("utf-8"),
+            headers={"Content-Type": "text/csv"},
+            timeout=10
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        
+        self.assertTrue(data["dry_run"])
+        self.assertEqual(data["rows"], 2)
+        self.assertEqual(data["valid"], 1)
+        self.assertEqual(data["created"], 0)
+        self.assertEqual(len(data["errors"]), 1)
+        self.assertEqual(data["errors"][0]["row"], 2)
+        print(f"✅ Admin import subscribers dry-run test passed: {data}")
+
     def test_stripe_webhook_endpoint_structure(self):
         """Test the Stripe webhook endpoint structure"""
         # Create a minimal mock Stripe event
@@ -129,6 +183,12 @@ class TestTelegramBotBackend(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         print(f"✅ Stripe webhook endpoint structure test passed (expected 400 for invalid signature)")
 
+    def test_check_payment_long_poll_bounds(self):
+        """Test that long-polling payment checks reject waits beyond the server limit"""
+        response = requests.get(f"{API_URL}/check-payment/cs_test_123456", params={"wait": 3600}, timeout=10)
+        self.assertEqual(response.status_code, 422)
+        print(f"✅ Check payment long-poll bounds test passed")
+
     def test_error_handling(self):
         """Test error responses for invalid requests"""
         # Test with invalid JSON data
@@ -169,12 +229,16 @@ if __name__ == "__main__":
     test_suite = unittest.TestSuite()
     test_cases = [
         TestTelegramBotBackend('test_root_endpoint'),
+        TestTelegramBotBackend('test_health_endpoints'),
         TestTelegramBotBackend('test_status_endpoint_get'),
         TestTelegramBotBackend('test_status_endpoint_post'),
         TestTelegramBotBackend('test_admin_stats_endpoint'),
         TestTelegramBotBackend('test_admin_subscribers_endpoint'),
+        TestTelegramBotBackend('test_admin_analytics_endpoint'),
         TestTelegramBotBackend('test_admin_add_subscriber'),
+        TestTelegramBotBackend('test_admin_import_subscribers_dry_run'),
         TestTelegramBotBackend('test_stripe_webhook_endpoint_structure'),
+        TestTelegramBotBackend('test_check_payment_long_poll_bounds'),
         TestTelegramBotBackend('test_error_handling'),
         TestTelegramBotBackend('test_environment_variables')
     ]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Serialization cost of GET /api/admin/subscribers for 10k subscribers.
+
+before: plain dicts through FastAPI's default path (jsonable_encoder + JSONResponse)
+after:  the same rows rendered directly with ORJSONResponse
+
+Usage: python benchmarks/bench_admin_serialization.py [subscribers]
+"""
+
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+
+def make_subscribers(count):
+    now = datetime.utcnow()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "telegram_user_id": 100000000 + index,
+            "telegram_username": f"user_{index}",
+            "email": f"user_{index}@example.com",
+            "current_period_end": now + timedelta(days=index % 30),
+            "created_at": now - timedelta(days=index % 365),
+            "amount": 30.0,
+            "currency": "UAH"
+        }
+        for index in range(count)
+    ]
+
+
+def before(subscribers):
+    return JSONResponse(content=jsonable_encoder({"subscribers": subscribers})).body
+
+
+def after(subscribers):
+    return ORJSONResponse({"subscribers": subscribers}).body
+
+
+def measure(func, subscribers, repeat=20):
+    func(subscribers)  # warm up
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(subscribers)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    subscribers = make_subscribers(count)
+
+    print(f"Serializing {count} subscribers")
+    results = {}
+    for name, func in (("before", before), ("after", after)):
+        median, worst = measure(func, subscribers)
+        results[name] = median
+        print(f"  {name:<7} median {median:8.2f} ms   max {worst:8.2f} ms   {len(func(subscribers))} bytes")
+    print(f"  speedup {results['before'] / results['after']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Handler-level hot paths with fakes for Stripe, Telegram and MongoDB, gated on stored baselines.
+
+Covers start_command, button_callback, stripe_webhook per event type, check_expired_subscriptions
+at 1k/10k/100k expired rows, and the admin subscribers/stats routes over 10k subscribers.
+Reports ops/sec, p50/p95/p99 latency and allocations per operation. The run fails when p50
+latency or peak allocations exceed benchmarks/baselines.json by more than --threshold.
+Baselines are machine specific: regenerate them with --update-baseline where the gate runs.
+A regression only fails the run if it reproduces when that benchmark is measured again.
+
+Usage: python benchmarks/bench_hot_paths.py [--filter NAME] [--threshold 0.25] [--update-baseline]
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import warnings
+from datetime import datetime, timedelta
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+sys.path.insert(0, str(BENCHMARKS_DIR.parent / 'backend'))
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+# Fake configuration; explicit environment values still win over backend/.env
+os.environ["STORAGE_BACKEND"] = "memory"
+for key, value in {
+    "STRIPE_SECRET_KEY": "sk_test_bench",
+    "STRIPE_WEBHOOK_SECRET": "whsec_bench",
+    "BOT_TOKEN": "123456:bench",
+    "GROUP_ID": "-1001000000000",
+    "GROUP_INVITE_LINK": "https://t.me/+bench",
+    "SUBSCRIPTION_PRICE": "30",
+    "SUBSCRIPTION_DAYS": "30",
+    "CURRENCY": "UAH",
+    "ADMIN_USER_IDS": "1",
+    "DOMAIN": "localhost"
+}.items():
+    os.environ.setdefault(key, value)
+
+import server  # noqa: E402
+from fakes import FakeBot, FakeRequest, FakeStripe, callback_update, command_update, stripe_subscription  # noqa: E402
+from harness import load_baselines, measure, regressions, save_baselines  # noqa: E402
+from repositories import InMemoryRepositories  # noqa: E402
+
+ADMIN_SCALE = 10000
+MICRO_ITERATIONS = 1000
+# A regression must reproduce in this many runs in total before it fails the gate
+CONFIRM_RUNS = 3
+WEBHOOK_SUBSCRIBERS = 1000
+EXPIRY_SIZES = {"1k": (1000, 10), "10k": (10000, 5), "100k": (100000, 2)}
+
+telegram_ids = itertools.count(1000000)
+fake_stripe = FakeStripe()
+
+
+def user_doc(telegram_user_id):
+    return server.User(telegram_user_id=telegram_user_id, telegram_username=f"user_{telegram_user_id}").dict()
+
+
+def subscription_doc(user, status="active", days=30, stripe_subscription_id=None):
+    now = datetime.utcnow()
+    return server.Subscription(
+        user_id=user["id"],
+        telegram_user_id=user["telegram_user_id"],
+        stripe_subscription_id=stripe_subscription_id,
+        status=status,
+        amount=30.0,
+        currency="UAH",
+        current_period_start=now - timedelta(days=30 - days),
+        current_period_end=now + timedelta(days=days)
+    ).dict()
+
+
+async def reset_storage(subscribers=0, status="active", days=30, transactions=False):
+    """Fresh in-memory storage with subscribers users and subscriptions"""
+    server.repos = InMemoryRepositories()
+    server.admin_response_cache.clear()
+    server.invite_links.clear()
+    users = [user_doc(next(telegram_ids)) for _ in range(subscribers)]
+    await server.repos.users.insert_missing(users)
+    subscriptions = []
+    for index, user in enumerate(users):
+        subscription = subscription_doc(user, status, days, f"sub_bench_{index}")
+        await server.repos.subscriptions.insert(subscription)
+        subscriptions.append(subscription)
+        if transactions:
+            await server.repos.transactions.insert(server.PaymentTransaction(
+                user_id=user["id"],
+                telegram_user_id=user["telegram_user_id"],
+                stripe_session_id=f"cs_seed_{index}",
+                stripe_subscription_id=subscription["stripe_subscription_id"],
+                amount=30.0,
+                currency="UAH",
+                status="completed"
+            ).dict())
+    await server.reload_plans_and_members()
+    return users, subscriptions
+
+
+def bot_benchmarks():
+    state = {}
+
+    async def prepare():
+        users, subscriptions = await reset_storage(WEBHOOK_SUBSCRIBERS)
+        state["subscriber"] = users[0]["telegram_user_id"]
+        lapsed = user_doc(next(telegram_ids))
+        await server.repos.users.insert(lapsed)
+        state["lapsed"] = lapsed["telegram_user_id"]
+
+    def start_new_user():
+        return command_update(next(telegram_ids))
+
+    return prepare, {
+        "start_command.new_user": (
+            lambda update: server.start_command(update, server_context()), start_new_user, MICRO_ITERATIONS
+        ),
+        "start_command.active_subscriber": (
+            lambda update: server.start_command(update, server_context()),
+            lambda: command_update(state["subscriber"]), MICRO_ITERATIONS
+        ),
+        "start_command.no_subscription": (
+            lambda update: server.start_command(update, server_context()),
+            lambda: command_update(state["lapsed"]), MICRO_ITERATIONS
+        ),
+        "button_callback.subscribe": (
+            lambda update: server.button_callback(update, server_context()),
+            lambda: callback_update(state["lapsed"], "subscribe:default"), MICRO_ITERATIONS
+        ),
+        "button_callback.status": (
+            lambda update: server.button_callback(update, server_context()),
+            lambda: callback_update(state["subscriber"], "status"), MICRO_ITERATIONS
+        )
+    }
+
+
+def server_context():
+    return type("Context", (), {"args": []})()
+
+
+def webhook_benchmarks():
+    state = {"subscriptions": [], "next": itertools.count()}
+
+    async def prepare():
+        users, subscriptions = await reset_storage(WEBHOOK_SUBSCRIBERS)
+        state["users"] = users
+        state["subscriptions"] = subscriptions
+
+    def next_subscription():
+        return state["subscriptions"][next(state["next"]) % len(state["subscriptions"])]
+
+    async def checkout_completed():
+        # The transaction recorded when the checkout session was created
+        user = state["users"][next(state["next"]) % len(state["users"])]
+        session_id = f"cs_hook_{next(telegram_ids)}"
+        await server.repos.transactions.insert(server.PaymentTransaction(
+            user_id=user["id"],
+            telegram_user_id=user["telegram_user_id"],
+            stripe_session_id=session_id,
+            amount=30.0,
+            currency="UAH",
+            metadata={"checkout_session_id": session_id, "plan_id": "default"}
+        ).dict())
+        fake_stripe.event("checkout.session.completed", {
+            "id": session_id,
+            "object": "checkout.session",
+            "subscription": f"sub_hook_{session_id}",
+            "metadata": {"telegram_user_id": str(user["telegram_user_id"]), "user_id": user["id"], "plan_id": "default"}
+        })
+
+    def subscription_event(event_type):
+        def setup():
+            fake_stripe.event(event_type, stripe_subscription(next_subscription()["stripe_subscription_id"]))
+        return setup
+
+    async def subscription_deleted():
+        # Each cancellation needs an active subscription to cancel
+        user = user_doc(next(telegram_ids))
+        subscription = subscription_doc(user, stripe_subscription_id=f"sub_del_{user['telegram_user_id']}")
+        await server.repos.users.insert(user)
+        await server.repos.subscriptions.insert(subscription)
+        fake_stripe.event("customer.subscription.deleted", stripe_subscription(subscription["stripe_subscription_id"]))
+
+    def invoice_event(event_type):
+        def setup():
+            fake_stripe.event(event_type, {
+                "id": "in_bench", "object": "invoice", "subscription": next_subscription()["stripe_subscription_id"]
+            })
+        return setup
+
+    def webhook(_):
+        return server.stripe_webhook(FakeRequest(), "t=0,v1=bench")
+
+    return prepare, {
+        "stripe_webhook.checkout.session.completed": (webhook, checkout_completed, MICRO_ITERATIONS),
+        "stripe_webhook.customer.subscription.updated": (webhook, subscription_event("customer.subscription.updated"), MICRO_ITERATIONS),
+        "stripe_webhook.customer.subscription.deleted": (webhook, subscription_deleted, MICRO_ITERATIONS),
+        "stripe_webhook.invoice.payment_succeeded": (webhook, invoice_event("invoice.payment_succeeded"), MICRO_ITERATIONS),
+        "stripe_webhook.invoice.payment_failed": (webhook, invoice_event("invoice.payment_failed"), MICRO_ITERATIONS)
+    }
+
+
+def expiry_benchmarks():
+    benchmarks = {}
+    for label, (rows, iterations) in EXPIRY_SIZES.items():
+        async def setup(rows=rows):
+            await reset_storage(rows, days=-1)
+        benchmarks[f"check_expired_subscriptions.{label}"] = (
+            lambda _: server.check_expired_subscriptions(), setup, iterations
+        )
+
+    async def prepare():
+        pass
+
+    return prepare, benchmarks
+
+
+def admin_benchmarks():
+    async def prepare():
+        await reset_storage(ADMIN_SCALE, transactions=True)
+
+    def cold():
+        # Measure the build, not the per-ETag response cache
+        server.admin_response_cache.clear()
+        return FakeRequest()
+
+    label = f"{ADMIN_SCALE // 1000}k"
+    return prepare, {
+        f"get_subscribers.{label}": (server.get_subscribers, cold, 30),
+        f"get_admin_stats.{label}": (server.get_admin_stats, cold, 30)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed regression as a fraction")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baselines")
+    args = parser.parse_args()
+
+    # Per-operation info logs would dominate the timings; the models' .dict() warns on every call
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore", DeprecationWarning)
+    fake_stripe.install()
+    server.bot.bot = FakeBot()
+    server.stripe_catalog["price"] = type("Price", (), {"id": "price_bench"})()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    baselines = load_baselines()
+    results = {}
+    failures = []
+
+    print(f"{'benchmark':<46} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KiB':>9}  vs baseline")
+    for group in (bot_benchmarks, webhook_benchmarks, expiry_benchmarks, admin_benchmarks):
+        prepare, benchmarks = group()
+        selected = {name: spec for name, spec in benchmarks.items() if args.filter in name}
+        if not selected:
+            continue
+        loop.run_until_complete(prepare())
+        for name, (operation, setup, iterations) in selected.items():
+            metrics = measure(loop, operation, setup, iterations=iterations, warmup=1)
+            found = regressions(name, metrics, baselines, args.threshold)
+            # Baselines keep the best of several runs; the gate re-measures before failing
+            for _ in range(CONFIRM_RUNS - 1 if args.update_baseline or found else 0):
+                retry = measure(loop, operation, setup, iterations=iterations, warmup=1)
+                if retry["p50_ms"] < metrics["p50_ms"]:
+                    metrics = retry
+                found = regressions(name, metrics, baselines, args.threshold)
+                if not found and not args.update_baseline:
+                    break
+            results[name] = metrics
+            baseline = baselines.get(name)
+            if found:
+                verdict = "REGRESSION: " + ", ".join(found)
+                failures.append(name)
+            elif baseline:
+                verdict = f"ok ({(metrics['p50_ms'] / baseline['p50_ms'] - 1) * 100:+.0f}% p50)" if baseline["p50_ms"] else "ok"
+            else:
+                verdict = "new"
+            print(
+                f"{name:<46} {metrics['ops_per_sec']:>10.1f} {metrics['p50_ms']:>9.3f} {metrics['p95_ms']:>9.3f} "
+                f"{metrics['p99_ms']:>9.3f} {metrics['peak_kib']:>9.1f}  {verdict}"
+            )
+
+    if args.update_baseline:
+        save_baselines(results)
+        print(f"Stored baselines for {len(results)} benchmarks")
+    elif failures:
+        print(f"{len(failures)} benchmarks regressed beyond {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
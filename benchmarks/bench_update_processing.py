@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Telegram update throughput against a fake Bot API.
+
+Every update is answered with sendMessage (the fake API answers after a fixed latency)
+and every seventh update also makes a slow "Stripe" call first. Like the real client the
+fake one blocks its thread, so handlers run it with asyncio.to_thread as the server does.
+
+before: the Application default, one update at a time
+after:  PerUserUpdateProcessor, users in parallel and each user's updates in order
+
+Usage: python benchmarks/bench_update_processing.py [updates] [users] [concurrency]
+"""
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+from telegram import Bot, Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+from telegram_client import PerUserUpdateProcessor
+
+API_LATENCY = 0.02
+STRIPE_LATENCY = 0.2
+
+
+def stripe_call():
+    """Stand-in for a synchronous Stripe client request"""
+    time.sleep(STRIPE_LATENCY)
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers getMe and sendMessage after API_LATENCY without any network"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            await asyncio.sleep(API_LATENCY)
+            params = request_data.parameters if request_data else {}
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")
+            }
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user_{user_id}"},
+            "text": f"/start {update_id}"
+        }
+    }
+
+
+async def run(updates, users, concurrent_updates):
+    bot = Bot("123:bench", request=FakeBotAPI())
+    application = Application.builder().bot(bot).updater(None).concurrent_updates(concurrent_updates).build()
+    handled = {}
+    done = asyncio.Event()
+
+    async def handle(update, context):
+        if update.update_id % 7 == 0:
+            await asyncio.to_thread(stripe_call)
+        await context.bot.send_message(chat_id=update.effective_user.id, text="ok")
+        handled.setdefault(update.effective_user.id, []).append(update.update_id)
+        if sum(len(ids) for ids in handled.values()) == updates:
+            done.set()
+
+    application.add_handler(TypeHandler(Update, handle))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        for update_id in range(1, updates + 1):
+            await application.update_queue.put(Update.de_json(make_update(update_id, update_id % users), bot))
+        await done.wait()
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    in_order = all(ids == sorted(ids) for ids in handled.values())
+    return updates / elapsed, in_order
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    print(f"Processing {updates} updates from {users} users (API {API_LATENCY * 1000:.0f} ms, Stripe {STRIPE_LATENCY * 1000:.0f} ms)")
+    results = {}
+    for name, processor in (("before", False), ("after", PerUserUpdateProcessor(concurrency))):
+        rate, in_order = asyncio.run(run(updates, users, processor))
+        results[name] = rate
+        print(f"  {name:<7} {rate:8.1f} updates/s   per-user order kept: {in_order}")
+    print(f"  speedup {results['after'] / results['before']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+In-process stand-ins for Stripe, the Telegram Bot API and incoming updates/requests.
+
+MongoDB is replaced by the in-memory storage backend (STORAGE_BACKEND=memory).
+"""
+
+import time
+from types import SimpleNamespace
+
+import stripe
+
+STRIPE_PRICE_ID = "price_bench"
+STRIPE_PRODUCT_ID = "prod_bench"
+
+
+def stripe_subscription(stripe_subscription_id, status="active"):
+    now = int(time.time())
+    return stripe.StripeObject.construct_from({
+        "id": stripe_subscription_id,
+        "object": "subscription",
+        "customer": "cus_bench",
+        "status": status,
+        "current_period_start": now,
+        "current_period_end": now + 30 * 86400,
+        "items": {"data": [{"price": {"id": STRIPE_PRICE_ID, "product": STRIPE_PRODUCT_ID}}]}
+    }, "sk_bench")
+
+
+class FakeStripe:
+    """Patches the Stripe calls made by the server; construct_event returns next_event"""
+
+    def __init__(self):
+        self.next_event = None
+        self.sessions = 0
+
+    def install(self):
+        stripe.Customer.create = lambda **params: SimpleNamespace(id="cus_bench")
+        stripe.checkout.Session.create = self.create_session
+        stripe.checkout.Session.retrieve = lambda session_id: stripe.StripeObject.construct_from({
+            "id": session_id, "payment_status": "unpaid", "subscription": None, "metadata": {}
+        }, "sk_bench")
+        stripe.Subscription.retrieve = lambda stripe_subscription_id: stripe_subscription(stripe_subscription_id)
+        stripe.Webhook.construct_event = lambda payload, signature, secret: self.next_event
+
+    def create_session(self, **params):
+        self.sessions += 1
+        session_id = f"cs_bench_{self.sessions}"
+        return SimpleNamespace(id=session_id, url=f"https://checkout.stripe.com/c/pay/{session_id}")
+
+    def event(self, event_type, data_object):
+        self.next_event = stripe.StripeObject.construct_from(
+            {"id": f"evt_{event_type}", "type": event_type, "data": {"object": data_object}}, "sk_bench"
+        )
+
+
+class FakeBot:
+    """Bot API methods used by the server, answering immediately"""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(message_id=1, chat_id=chat_id, text=text)
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        return True
+
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
+        return True
+
+    async def create_chat_invite_link(self, chat_id, name=None, **kwargs):
+        return SimpleNamespace(invite_link=f"https://t.me/+{abs(chat_id)}_{name}")
+
+    async def get_chat(self, chat_id, **kwargs):
+        return SimpleNamespace(id=chat_id, username=f"user_{chat_id}")
+
+
+class FakeMessage:
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        return text
+
+
+class FakeCallbackQuery:
+    def __init__(self, user, data):
+        self.from_user = user
+        self.data = data
+
+    async def answer(self, text=None, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        return text
+
+
+def telegram_user(telegram_user_id):
+    return SimpleNamespace(
+        id=telegram_user_id, username=f"user_{telegram_user_id}", first_name="Bench", last_name=None
+    )
+
+
+def command_update(telegram_user_id):
+    return SimpleNamespace(effective_user=telegram_user(telegram_user_id), message=FakeMessage(), callback_query=None)
+
+
+def callback_update(telegram_user_id, data):
+    user = telegram_user(telegram_user_id)
+    return SimpleNamespace(effective_user=user, message=None, callback_query=FakeCallbackQuery(user, data))
+
+
+class FakeRequest:
+    """The parts of a Starlette request read by the webhook and admin routes"""
+
+    def __init__(self, body=b"{}", headers=None):
+        self._body = body
+        self.headers = headers or {}
+
+    async def body(self):
+        return self._body
@@ -0,0 +1,87 @@
+"""
+Measurement and baseline helpers for benchmarks/bench_hot_paths.py.
+
+Each benchmark runs an async operation a fixed number of times and reports ops/sec,
+latency percentiles and the memory allocated by one extra, traced run.
+"""
+
+import asyncio
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+
+# Metrics compared with the stored baseline; higher is worse for both
+GATED_METRICS = ("p50_ms", "peak_kib")
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of already sorted values"""
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def _run(loop, value):
+    return loop.run_until_complete(value) if asyncio.iscoroutine(value) else value
+
+
+def measure(loop, operation, setup=None, iterations=50, warmup=2):
+    """Time operation(state) where state comes from setup(), which is never timed"""
+    for _ in range(warmup):
+        _run(loop, operation(_run(loop, setup()) if setup else None))
+
+    timings = []
+    for _ in range(iterations):
+        state = _run(loop, setup()) if setup else None
+        started = time.perf_counter()
+        _run(loop, operation(state))
+        timings.append((time.perf_counter() - started) * 1000)
+
+    # Tracing slows everything down, so allocations come from a separate run
+    state = _run(loop, setup()) if setup else None
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    _run(loop, operation(state))
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "ops_per_sec": round(len(timings) / (sum(timings) / 1000), 2),
+        "p50_ms": round(percentile(timings, 0.50), 4),
+        "p95_ms": round(percentile(timings, 0.95), 4),
+        "p99_ms": round(percentile(timings, 0.99), 4),
+        "peak_kib": round((peak - before) / 1024, 1),
+        "retained_kib": round((after - before) / 1024, 1)
+    }
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def save_baselines(results, path=BASELINES_PATH):
+    """Store the gated metrics of results, keeping baselines of benchmarks that did not run"""
+    baselines = load_baselines(path)
+    for name, metrics in results.items():
+        baselines[name] = {metric: metrics[metric] for metric in GATED_METRICS}
+    path.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+
+
+def regressions(name, metrics, baselines, threshold):
+    """Gated metrics more than threshold (a fraction) worse than the baseline"""
+    baseline = baselines.get(name)
+    if not baseline:
+        return []
+    found = []
+    for metric in GATED_METRICS:
+        expected = baseline.get(metric)
+        # Tiny values are dominated by noise; allow at least 0.05 ms / 4 KiB of slack
+        slack = 0.05 if metric.endswith("_ms") else 4
+        if expected is not None and metrics[metric] > max(expected * (1 + threshold), expected + slack):
+            found.append(f"{metric} {metrics[metric]} vs baseline {expected}")
+    return found
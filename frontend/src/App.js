@@ -5,10 +5,31 @@ import axios from "axios";
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Days of history shown for each analytics bucket size
+const ANALYTICS_DAYS = { day: 90, week: 364, month: 730 };
+
+function BarChart({ buckets, metric, color, format = (value) => value }) {
+  const max = Math.max(1, ...buckets.map((bucket) => bucket[metric] || 0));
+  return (
+    <div className="flex items-end h-40 space-x-px">
+      {buckets.map((bucket) => (
+        <div
+          key={bucket.start}
+          className={`flex-1 ${color} rounded-t`}
+          style={{ height: `${((bucket[metric] || 0) / max) * 100}%` }}
+          title={`${bucket.start}: ${format(bucket[metric] || 0)}`}
+        ></div>
+      ))}
+    </div>
+  );
+}
+
 function App() {
   const [activeTab, setActiveTab] = useState('stats');
   const [stats, setStats] = useState({});
   const [subscribers, setSubscribers] = useState([]);
+  const [analytics, setAnalytics] = useState(null);
+  const [analyticsPeriod, setAnalyticsPeriod] = useState('day');
   const [loading, setLoading] = useState(false);
   const [newSubscriber, setNewSubscriber] = useState({
     telegram_username: '',
@@ -16,8 +37,8 @@ function App() {
     duration_days: 30
   });
 
-  const fetchStats = async () => {
-    setLoading(true);
+  const fetchStats = async (silent = false) => {
+    if (!silent) setLoading(true);
     try {
       const response = await axios.get(`${API}/admin/stats`);
       setStats(response.data);
@@ -28,8 +49,8 @@ function App() {
     }
   };
 
-  const fetchSubscribers = async () => {
-    setLoading(true);
+  const fetchSubscribers = async (silent = false) => {
+    if (!silent) setLoading(true);
     try {
       const response = await axios.get(`${API}/admin/subscribers`);
       setSubscribers(response.data.subscribers);
@@ -40,6 +61,20 @@ function App() {
     }
   };
 
+  const fetchAnalytics = async () => {
+    setLoading(true);
+    try {
+      const response = await axios.get(`${API}/admin/analytics`, {
+        params: { period: analyticsPeriod, days: ANALYTICS_DAYS[analyticsPeriod] }
+      });
+      setAnalytics(response.data);
+    } catch (error) {
+      console.error('Error fetching analytics:', error);
+    } finally {
+      setLoading(false);
+    }
+  };
+
   const addSubscriber = async () => {
     if (!newSubscriber.telegram_username || !newSubscriber.email) {
       alert('Please fill in all fields');
@@ -76,8 +111,64 @@ function App() {
       fetchStats();
     } else if (activeTab === 'subscribers') {
       fetchSubscribers();
+    } else if (activeTab === 'analytics') {
+      fetchAnalytics();
     }
-  }, [activeTab]);
+  }, [activeTab, analyticsPeriod]);
+
+  // Live updates pushed by the server; deltas are applied instead of refetching
+  useEffect(() => {
+    const source = new EventSource(`${API}/admin/events`);
+
+    const applyEvent = (event) => {
+      const data = JSON.parse(event.data);
+
+      if (data.stats || data.revenue || data.transaction) {
+        setStats((current) => {
+          const next = { ...current };
+          Object.entries(data.stats || {}).forEach(([key, value]) => {
+            next[key] = (next[key] || 0) + value;
+          });
+          if (data.revenue) {
+            next.total_revenue = (next.total_revenue || 0) + data.revenue;
+          }
+          if (data.transaction) {
+            next.recent_transactions = [data.transaction, ...(next.recent_transactions || [])].slice(0, 10);
+          }
+          return next;
+        });
+      }
+
+      if (data.upsert) {
+        setSubscribers((current) => {
+          const exists = current.some((subscriber) => subscriber.id === data.upsert.id);
+          return exists
+            ? current.map((subscriber) => (subscriber.id === data.upsert.id ? data.upsert : subscriber))
+            : [data.upsert, ...current];
+        });
+      }
+      if (data.remove) {
+        setSubscribers((current) => current.filter((subscriber) => subscriber.id !== data.remove));
+      }
+    };
+
+    [
+      'user.created',
+      'subscription.created',
+      'subscription.renewed',
+      'subscription.updated',
+      'subscription.canceled',
+      'subscription.expired'
+    ].forEach((type) => source.addEventListener(type, applyEvent));
+
+    // Sent on every (re)connect and after bulk changes
+    source.addEventListener('resync', () => {
+      fetchStats(true);
+      fetchSubscribers(true);
+    });
+
+    return () => source.close();
+  }, []);
 
   const formatDate = (dateString) => {
     return new Date(dateString).toLocaleString('uk-UA', {
@@ -135,6 +226,16 @@ function App() {
             >
               👥 Subscribers
             </button>
+            <button
+              onClick={() => setActiveTab('analytics')}
+              className={`py-4 px-1 border-b-2 font-medium text-sm ${
+                activeTab === 'analytics'
+                  ? 'border-blue-500 text-blue-600'
+                  : 'border-transparent text-gray-500 hover:text-gray-700 hover:border-gray-300'
+              }`}
+            >
+              📉 Analytics
+            </button>
             <button
               onClick={() => setActiveTab('add-subscriber')}
               className={`py-4 px-1 border-b-2 font-medium text-sm ${
@@ -262,7 +363,7 @@ function App() {
                     👥 Active Subscribers
                   </h3>
                   <button
-                    onClick={fetchSubscribers}
+                    onClick={() => fetchSubscribers()}
                     disabled={loading}
                     className="bg-blue-500 hover:bg-blue-600 text-white px-4 py-2 rounded-lg text-sm font-medium disabled:opacity-50"
                   >
@@ -327,6 +428,94 @@ function App() {
             </div>
           )}
 
+          {/* Analytics Tab */}
+          {activeTab === 'analytics' && (
+            <div className="space-y-6">
+              <div className="bg-white overflow-hidden shadow rounded-lg">
+                <div className="px-4 py-5 sm:p-6">
+                  <div className="flex justify-between items-center mb-4">
+                    <h3 className="text-lg leading-6 font-medium text-gray-900">
+                      📉 Revenue & Churn
+                    </h3>
+                    <div className="flex space-x-2">
+                      {Object.keys(ANALYTICS_DAYS).map((period) => (
+                        <button
+                          key={period}
+                          onClick={() => setAnalyticsPeriod(period)}
+                          className={`px-3 py-1 rounded-md text-sm font-medium ${
+                            analyticsPeriod === period
+                              ? 'bg-blue-600 text-white'
+                              : 'bg-gray-100 text-gray-700 hover:bg-gray-200'
+                          }`}
+                        >
+                          {period}
+                        </button>
+                      ))}
+                    </div>
+                  </div>
+
+                  {loading || !analytics ? (
+                    <div className="text-center py-4">
+                      <div className="animate-spin rounded-full h-8 w-8 border-b-2 border-blue-500 mx-auto"></div>
+                      <p className="mt-2 text-sm text-gray-600">Loading analytics...</p>
+                    </div>
+                  ) : (
+                    <div className="space-y-6">
+                      <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 gap-4">
+                        <div className="bg-purple-50 p-4 rounded-lg">
+                          <div className="text-2xl font-bold text-purple-600">
+                            {analytics.mrr || 0} UAH
+                          </div>
+                          <div className="text-sm text-gray-600">MRR</div>
+                        </div>
+                        <div className="bg-green-50 p-4 rounded-lg">
+                          <div className="text-2xl font-bold text-green-600">
+                            {analytics.buckets.reduce((sum, bucket) => sum + bucket.new_subscribers, 0)}
+                          </div>
+                          <div className="text-sm text-gray-600">New Subscribers</div>
+                        </div>
+                        <div className="bg-yellow-50 p-4 rounded-lg">
+                          <div className="text-2xl font-bold text-yellow-600">
+                            {analytics.buckets.reduce((sum, bucket) => sum + bucket.churned_subscribers, 0)}
+                          </div>
+                          <div className="text-sm text-gray-600">Churned Subscribers</div>
+                        </div>
+                        <div className="bg-blue-50 p-4 rounded-lg">
+                          <div className="text-2xl font-bold text-blue-600">
+                            {analytics.buckets.reduce((sum, bucket) => sum + bucket.revenue, 0)} UAH
+                          </div>
+                          <div className="text-sm text-gray-600">Revenue</div>
+                        </div>
+                      </div>
+
+                      <div>
+                        <h4 className="text-sm font-medium text-gray-700 mb-2">Revenue</h4>
+                        <BarChart buckets={analytics.buckets} metric="revenue" color="bg-blue-500" format={(value) => `${value} UAH`} />
+                      </div>
+                      <div>
+                        <h4 className="text-sm font-medium text-gray-700 mb-2">New Subscribers</h4>
+                        <BarChart buckets={analytics.buckets} metric="new_subscribers" color="bg-green-500" />
+                      </div>
+                      <div>
+                        <h4 className="text-sm font-medium text-gray-700 mb-2">Churned Subscribers</h4>
+                        <BarChart buckets={analytics.buckets} metric="churned_subscribers" color="bg-yellow-500" />
+                      </div>
+                      <div>
+                        <h4 className="text-sm font-medium text-gray-700 mb-2">MRR</h4>
+                        <BarChart buckets={analytics.buckets} metric="mrr" color="bg-purple-500" format={(value) => `${value} UAH`} />
+                      </div>
+
+                      <p className="text-xs text-gray-500">
+                        {analytics.buckets.length ? `${analytics.buckets[0].start} — ${analytics.buckets[analytics.buckets.length - 1].start}` : ''}
+                        {analytics.refreshed_at ? ` · updated ${formatDate(analytics.refreshed_at)}` : ''}
+                      </p>
+                    </div>
+                  )}
+                </div>
+              </div>
+            </div>
+          )}
+
           {/* Add Subscriber Tab */}
           {activeTab === 'add-subscriber' && (
             <div className="bg-white overflow-hidden shadow rounded-lg">
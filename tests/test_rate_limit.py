@@ -0,0 +1,63 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+from rate_limit import RateLimiter, parse_rule
+from repositories import InMemoryRateLimitRepo, RateLimitRepo
+
+
+class FailingStore(RateLimitRepo):
+    """Shared store stand-in that is unreachable"""
+
+    async def hit(self, key, limit, window_seconds):
+        raise ConnectionError("mongo down")
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Tests for the sliding-window rate limiter"""
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_parse_rule(self):
+        self.assertEqual(parse_rule("20/60"), (20, 60.0))
+        self.assertEqual(parse_rule("5"), (5, 60.0))
+
+    def test_limits_per_key_and_counts_hits(self):
+        limiter = RateLimiter({"bot": (2, 60)}, InMemoryRateLimitRepo())
+
+        results = [self.run_async(limiter.hit("bot", 1)) for _ in range(3)]
+        self.assertEqual([allowed for allowed, _ in results], [True, True, False])
+        self.assertGreater(results[2][1], 59)
+        self.assertTrue(self.run_async(limiter.hit("bot", 2))[0])
+        self.assertEqual(limiter.stats["bot"], {"allowed": 3, "limited": 1})
+
+    def test_window_slides(self):
+        store = InMemoryRateLimitRepo()
+        self.assertTrue(self.run_async(store.hit("k", 1, 0.05))[0])
+        self.assertFalse(self.run_async(store.hit("k", 1, 0.05))[0])
+        asyncio.run(asyncio.sleep(0.06))
+        self.assertTrue(self.run_async(store.hit("k", 1, 0.05))[0])
+
+    def test_idle_keys_are_evicted(self):
+        store = InMemoryRateLimitRepo()
+        self.run_async(store.hit("old", 5, 0.01))
+        asyncio.run(asyncio.sleep(0.02))
+        self.run_async(store.hit("new", 5, 60))
+        self.assertEqual(list(store.logs), ["new"])
+
+    def test_zero_limit_disables_scope(self):
+        limiter = RateLimiter({"api": (0, 60)}, FailingStore())
+        self.assertEqual(self.run_async(limiter.hit("api", "1.2.3.4")), (True, 0.0))
+
+    def test_falls_back_to_local_store(self):
+        limiter = RateLimiter({"api": (1, 60)}, FailingStore(), fallback=InMemoryRateLimitRepo())
+        self.assertTrue(self.run_async(limiter.hit("api", "1.2.3.4"))[0])
+        self.assertFalse(self.run_async(limiter.hit("api", "1.2.3.4"))[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
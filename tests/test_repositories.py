@@ -0,0 +1,197 @@
+import asyncio
+import sys
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+from repositories import InMemoryRepositories, ChangeStreamUnsupported, RateLimitRepo, create_repositories
+
+
+def make_subscription(sub_id, telegram_user_id, status="active", days=30, stripe_id=None):
+    now = datetime.utcnow()
+    return {
+        "id": sub_id,
+        "user_id": f"user_{telegram_user_id}",
+        "telegram_user_id": telegram_user_id,
+        "stripe_subscription_id": stripe_id,
+        "status": status,
+        "amount": 30.0,
+        "currency": "UAH",
+        "current_period_start": now,
+        "current_period_end": now + timedelta(days=days),
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+class TestInMemoryRepositories(unittest.TestCase):
+    """Tests for the in-memory storage backend"""
+
+    def setUp(self):
+        self.repos = InMemoryRepositories()
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_user_lookups(self):
+        user = {"id": "u1", "telegram_user_id": 1, "telegram_username": "bob", "email": None}
+        self.run_async(self.repos.users.insert(user))
+        self.run_async(self.repos.users.insert_missing([{"id": "u2", "telegram_user_id": 1}]))
+
+        self.assertEqual(self.run_async(self.repos.users.count()), 1)
+        self.assertEqual(self.run_async(self.repos.users.get_by_username("bob"))["id"], "u1")
+        found = self.run_async(self.repos.users.find_by_telegram_ids_or_usernames([1], ["bob"]))
+        self.assertEqual([user["id"] for user in found], ["u1"])
+
+        # Returned documents are copies
+        self.run_async(self.repos.users.get_by_id("u1"))["email"] = "x@example.com"
+        self.assertIsNone(self.run_async(self.repos.users.get_by_id("u1"))["email"])
+
+    def test_set_email_touches_updated_at(self):
+        before = datetime.utcnow() - timedelta(days=1)
+        for user_id, telegram_user_id in (("u1", 1), ("u2", 2)):
+            self.run_async(self.repos.users.insert({"id": user_id, "telegram_user_id": telegram_user_id, "updated_at": before}))
+
+        self.run_async(self.repos.users.set_email("u1", "a@example.com"))
+        self.run_async(self.repos.users.set_emails([("u2", "b@example.com")]))
+        for user_id in ("u1", "u2"):
+            user = self.run_async(self.repos.users.get_by_id(user_id))
+            self.assertTrue(user["email"].endswith("@example.com"))
+            self.assertGreater(user["updated_at"], before)
+
+    def test_interfaces_are_abstract(self):
+        class Incomplete(RateLimitRepo):
+            pass
+
+        with self.assertRaises(TypeError):
+            RateLimitRepo()
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_churn_is_dated_by_churned_at(self):
+        churned_at = datetime.utcnow() - timedelta(days=3)
+        subscription = make_subscription("s1", 1, status="canceled")
+        # Written again today, e.g. by a period repair; its churn stays on the day it happened
+        subscription.update(churned_at=churned_at, updated_at=datetime.utcnow())
+        legacy = make_subscription("s2", 2, status="expired")
+        self.run_async(self.repos.subscriptions.insert(subscription))
+        self.run_async(self.repos.subscriptions.insert(legacy))
+
+        self.run_async(self.repos.analytics.rebuild_daily())
+        churned_day = churned_at.strftime("%Y-%m-%d")
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        buckets = {bucket["_id"]: bucket for bucket in self.run_async(self.repos.analytics.daily(churned_day, today))}
+        self.assertEqual(buckets[churned_day].get("churned_subscribers"), 1)
+        # Rows churned before churned_at existed fall back to updated_at
+        self.assertEqual(buckets[today].get("churned_subscribers"), 1)
+
+    def test_status_index_follows_updates(self):
+        subscriptions = self.repos.subscriptions
+        self.run_async(subscriptions.insert(make_subscription("s1", 1, stripe_id="sub_1")))
+        self.run_async(subscriptions.insert(make_subscription("s2", 2, days=-1)))
+
+        expired = self.run_async(subscriptions.find_expired(datetime.utcnow()))
+        self.assertEqual([sub["id"] for sub in expired], ["s2"])
+
+        self.run_async(subscriptions.update("s2", {"status": "expired"}))
+        self.run_async(subscriptions.update_by_stripe_id("sub_1", {"status": "canceled"}))
+        self.assertEqual(self.run_async(subscriptions.count_by_status("active")), 0)
+        self.assertEqual(self.run_async(subscriptions.count_by_status("expired")), 1)
+        self.assertIsNone(self.run_async(subscriptions.get_active(1)))
+        self.assertEqual(self.run_async(subscriptions.active_members_by_plan()), {})
+
+    def test_grant_active_never_shortens(self):
+        subscriptions = self.repos.subscriptions
+        now = datetime.utcnow()
+        self.run_async(subscriptions.insert(make_subscription("s1", 1, days=10)))
+
+        created, extended = self.run_async(subscriptions.grant_active([
+            (make_subscription("s2", 1), now + timedelta(days=5)),
+            (make_subscription("s3", 2), now + timedelta(days=5))
+        ], now))
+
+        self.assertEqual((created, extended), (1, 1))
+        self.assertEqual(self.run_async(subscriptions.get_active(1))["id"], "s1")
+        self.assertGreater(self.run_async(subscriptions.get_active(1))["current_period_end"], now + timedelta(days=9))
+
+    def test_subscriptions_per_plan(self):
+        subscriptions = self.repos.subscriptions
+        now = datetime.utcnow()
+        # Documents without plan_id belong to the default plan
+        self.run_async(subscriptions.insert(make_subscription("s1", 1)))
+
+        created, extended = self.run_async(subscriptions.grant_active([
+            (dict(make_subscription("s2", 1), plan_id="vip"), now + timedelta(days=5)),
+            (dict(make_subscription("s3", 1), plan_id="default"), now + timedelta(days=5))
+        ], now))
+
+        self.assertEqual((created, extended), (1, 1))
+        self.assertEqual(self.run_async(subscriptions.get_active(1, ["vip"]))["id"], "s2")
+        self.assertEqual(self.run_async(subscriptions.get_active(1, ["default"]))["id"], "s1")
+        self.assertEqual(self.run_async(subscriptions.active_members_by_plan()), {"default": {1}, "vip": {1}})
+
+    def test_reminder_markers(self):
+        subscriptions = self.repos.subscriptions
+        now = datetime.utcnow()
+        self.run_async(subscriptions.insert(make_subscription("s1", 1, days=2)))
+
+        due = self.run_async(subscriptions.find_due_for_reminder(now, now + timedelta(days=3), "3d", 10))
+        self.assertEqual([sub["id"] for sub in due], ["s1"])
+
+        self.run_async(subscriptions.add_reminder_markers(["s1"], ["3d"]))
+        due = self.run_async(subscriptions.find_due_for_reminder(now, now + timedelta(days=3), "3d", 10))
+        self.assertEqual(due, [])
+
+    def test_change_listeners(self):
+        changed = []
+        self.repos.changes.subscribe(lambda collection, remote: changed.append((collection, remote)))
+        self.run_async(self.repos.users.insert({"id": "u1", "telegram_user_id": 1}))
+        self.run_async(self.repos.subscriptions.insert(make_subscription("s1", 1)))
+        self.repos.changes.bump("subscriptions", remote=True)
+        self.assertEqual(changed, [("users", False), ("subscriptions", False), ("subscriptions", True)])
+
+        # A single process needs no change stream
+        self.assertFalse(self.repos.shared)
+        with self.assertRaises(ChangeStreamUnsupported):
+            self.repos.watch_changes(self.repos.tracked_collections())
+
+    def test_transaction_retention(self):
+        transactions = self.repos.transactions
+        now = datetime.utcnow()
+        for index, (status, age_days) in enumerate([
+            ("initiated", 2), ("initiated", 0), ("completed", 400), ("completed", 500), ("completed", 1)
+        ]):
+            updated_at = now - timedelta(days=age_days)
+            self.run_async(transactions.insert({
+                "id": f"t{index}", "stripe_session_id": f"cs_{index}", "status": status,
+                "amount": 30.0, "created_at": updated_at, "updated_at": updated_at
+            }))
+
+        self.assertEqual(self.run_async(transactions.delete_abandoned(now - timedelta(days=1))), 1)
+        self.assertEqual(self.run_async(transactions.archive_completed(now - timedelta(days=365), 1)), (1, 30.0))
+        self.assertEqual(self.run_async(transactions.archive_completed(now - timedelta(days=365), 10)), (1, 30.0))
+        self.assertEqual(self.run_async(transactions.archive_completed(now - timedelta(days=365), 10)), (0, 0.0))
+
+        self.assertEqual(sorted(transactions.archive), ["t2", "t3"])
+        self.assertIsNone(self.run_async(transactions.get_by_session_id("cs_0")))
+        self.assertEqual(self.run_async(transactions.total_completed_revenue()), 30.0)
+
+    def test_sync_state_push_and_take(self):
+        sync_state = self.repos.sync_state
+        self.run_async(sync_state.push("notification_queue", "messages", [[1, "a"]]))
+        self.run_async(sync_state.push("notification_queue", "messages", [[2, "b"]]))
+
+        taken = self.run_async(sync_state.take("notification_queue"))
+        self.assertEqual(taken["messages"], [[1, "a"], [2, "b"]])
+        self.assertIsNone(self.run_async(sync_state.take("notification_queue")))
+
+    def test_create_repositories(self):
+        self.assertIsInstance(create_repositories("memory"), InMemoryRepositories)
+        with self.assertRaises(ValueError):
+            create_repositories("mongo")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,579 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+import warnings
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+# Fake configuration and in-memory storage; explicit environment values still win
+os.environ["STORAGE_BACKEND"] = "memory"
+for key, value in {
+    "STRIPE_SECRET_KEY": "sk_test_unit",
+    "STRIPE_WEBHOOK_SECRET": "whsec_unit",
+    "BOT_TOKEN": "123456:unit",
+    "GROUP_ID": "-100",
+    "GROUP_INVITE_LINK": "https://t.me/+unit",
+    "SUBSCRIPTION_PRICE": "30",
+    "SUBSCRIPTION_DAYS": "30",
+    "CURRENCY": "UAH",
+    "ADMIN_USER_IDS": "1",
+    "DOMAIN": "localhost"
+}.items():
+    os.environ.setdefault(key, value)
+
+import server
+import stripe
+from repositories import InMemoryRepositories
+
+
+class FakeBot:
+    """Bot API stand-in that records calls, accepting arguments the way python-telegram-bot does"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(("send_message", chat_id))
+        return True
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        self.calls.append(("ban_chat_member", chat_id, user_id))
+        return True
+
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
+        self.calls.append(("unban_chat_member", chat_id, user_id))
+        return True
+
+    async def get_chat(self, chat_id, **kwargs):
+        self.calls.append(("get_chat", chat_id))
+        return type("Chat", (), {"id": chat_id, "username": f"user_{chat_id}"})()
+
+
+class StreamRequest:
+    """The parts of a Starlette request read by the import route, streaming the body in chunks"""
+
+    def __init__(self, body, chunk_size=7, content_type="text/csv"):
+        self.body = body.encode()
+        self.chunk_size = chunk_size
+        self.headers = {"content-type": content_type}
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+
+def stripe_object(values):
+    return stripe.StripeObject.construct_from(values, "sk_test_unit")
+
+
+def make_user(telegram_user_id):
+    return server.User(telegram_user_id=telegram_user_id, telegram_username=f"user_{telegram_user_id}").dict()
+
+
+def make_subscription(user, status="active", days=30, **fields):
+    now = datetime.utcnow()
+    return server.Subscription(
+        user_id=user["id"],
+        telegram_user_id=user["telegram_user_id"],
+        status=status,
+        amount=30.0,
+        currency="UAH",
+        current_period_start=now - timedelta(days=30 - days),
+        current_period_end=now + timedelta(days=days),
+        **fields
+    ).dict()
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs server code against in-memory storage and a fake bot"""
+
+    def setUp(self):
+        warnings.simplefilter("ignore", DeprecationWarning)
+        server.repos = InMemoryRepositories()
+        server.admin_response_cache.clear()
+        server.invite_links.clear()
+        server.bot.bot = FakeBot()
+        server.repos.changes.subscribe(server.on_storage_change)
+        server.payment_changed = asyncio.Event()
+        server.payment_status_cache.clear()
+        self.queued_notifications()
+        self.run_async(server.reload_plans_and_members())
+        self.stripe_patches = {}
+
+    def tearDown(self):
+        for (owner, name), original in self.stripe_patches.items():
+            setattr(owner, name, original)
+
+    def patch_stripe(self, owner, name, replacement):
+        self.stripe_patches.setdefault((owner, name), getattr(owner, name))
+        setattr(owner, name, replacement)
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def queued_notifications(self):
+        """Take everything queued for the notification worker"""
+        queued = []
+        while not server.notification_queue.empty():
+            queued.append(server.notification_queue.get_nowait())
+            server.notification_queue.task_done()
+        return queued
+
+    def deliver(self, event_type, data_object):
+        """Run a Stripe event through the webhook route"""
+        event = stripe_object({"id": f"evt_{event_type}", "type": event_type, "data": {"object": data_object}})
+        self.patch_stripe(stripe.Webhook, "construct_event", lambda payload, signature, secret: event)
+
+        async def body():
+            return b"{}"
+
+        return self.run_async(server.stripe_webhook(SimpleNamespace(body=body), "t=0,v1=unit"))
+
+    def add_plan(self, **fields):
+        plan = dict(id="vip", name="VIP", stripe_price_id="price_vip", group_id=-200, amount=90.0, currency="UAH")
+        plan.update(fields)
+        return self.run_async(server.upsert_plan(server.Plan(**plan)))
+
+    def add_subscriber(self, telegram_user_id, **fields):
+        user = make_user(telegram_user_id)
+        subscription = make_subscription(user, **fields)
+
+        async def insert():
+            await server.repos.users.insert(user)
+            await server.repos.subscriptions.insert(subscription)
+            await server.reload_active_members()
+
+        self.run_async(insert())
+        return user, subscription
+
+
+class TestSubscriberImport(ServerTestCase):
+    """Tests for the streamed subscriber import"""
+
+    def import_csv(self, body, **params):
+        params.setdefault("dry_run", False)
+        params.setdefault("notify", False)
+        return self.run_async(server.import_subscribers(StreamRequest(body), format="csv", **params))
+
+    def test_quoted_newlines_across_chunks(self):
+        future = (datetime.utcnow() + timedelta(days=10)).strftime("%Y-%m-%dT%H:%M:%S")
+        report = self.import_csv(
+            "telegram_user_id,telegram_username,current_period_end\n"
+            f'11,"multi\nline",{future}\n'
+            f"12,plain,{future}\n"
+        )
+        self.assertEqual(report["errors"], [])
+        self.assertEqual((report["rows"], report["created"]), (2, 2))
+        user, = self.run_async(server.repos.users.find_by_telegram_ids_or_usernames([11], []))
+        self.assertEqual(user["telegram_username"], "multi\nline")
+
+    def test_rejects_period_end_in_the_past(self):
+        past = (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+        report = self.import_csv(f"telegram_user_id,current_period_end\n21,{past}\n")
+        self.assertEqual(report["valid"], 0)
+        self.assertEqual(report["errors"][0]["row"], 1)
+        self.assertIn("future", str(report["errors"][0]["error"]))
+
+    def test_duplicates_across_batches(self):
+        rows = "".join(f"{100 + index}\n" for index in range(server.IMPORT_BATCH_SIZE))
+        report = self.import_csv(f"telegram_user_id\n{rows}100\n", dry_run=True)
+        self.assertEqual(report["valid"], server.IMPORT_BATCH_SIZE)
+        self.assertEqual(report["errors"], [{"row": server.IMPORT_BATCH_SIZE + 1, "error": "Duplicate of row 1"}])
+
+    def test_unterminated_quote_is_reported(self):
+        report = self.import_csv('telegram_user_id,telegram_username\n31,"open\n')
+        self.assertEqual(report["valid"], 0)
+        self.assertIn("Unparseable", report["errors"][0]["error"])
+
+
+class TestReconciliation(ServerTestCase):
+    """Tests for repairing drift between Stripe and local subscriptions"""
+
+    def test_incremental_run_repairs_old_subscription(self):
+        # Created well before the watermark window, canceled in Stripe without a webhook arriving
+        _, subscription = self.add_subscriber(41, stripe_subscription_id="sub_old", created_at=datetime.utcnow() - timedelta(days=400))
+        watermark = int(datetime.utcnow().timestamp()) - 600
+        self.run_async(server.repos.sync_state.set("stripe_subscriptions", {"watermark": watermark}))
+        self.assertIn(41, server.active_members[server.GROUP_ID])
+
+        listed = []
+        self.patch_stripe(stripe.Event, "list", lambda **params: listed.append(params) or SimpleNamespace(
+            data=[stripe_object({"id": "evt_1", "data": {"object": {"id": "sub_old", "status": "active"}}})],
+            has_more=False
+        ))
+        self.patch_stripe(stripe.Subscription, "list", lambda **params: self.fail("incremental run listed all subscriptions"))
+        period_start = int(subscription["current_period_start"].timestamp())
+        period_end = int(subscription["current_period_end"].timestamp())
+        self.patch_stripe(stripe.Subscription, "retrieve", lambda sub_id, **params: stripe_object({
+            "id": sub_id, "status": "canceled", "customer": {"id": "cus_1"},
+            "current_period_start": period_start, "current_period_end": period_end
+        }))
+
+        report = self.run_async(server.reconcile_subscriptions())
+        self.assertEqual((report["checked"], report["repaired"]), (1, 1))
+        self.assertEqual(listed[0]["created"], {"gte": watermark - server.RECONCILE_OVERLAP_SECONDS})
+        stored = self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_old"))
+        self.assertEqual(stored["status"], "canceled")
+        self.assertIn(("ban_chat_member", server.GROUP_ID, 41), server.bot.bot.calls)
+        self.assertNotIn(41, server.active_members.get(server.GROUP_ID, set()))
+
+    def test_churned_at_survives_later_writes(self):
+        _, subscription = self.add_subscriber(44, stripe_subscription_id="sub_churn")
+        self.deliver("customer.subscription.deleted", stripe_object({"id": "sub_churn"}))
+        churned_at = self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_churn"))["churned_at"]
+        self.assertIsNotNone(churned_at)
+
+        # A late update webhook for the canceled subscription keeps the churn date
+        self.deliver("customer.subscription.updated", stripe_subscription("sub_churn", "price_catalog", status="canceled"))
+        stored = self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_churn"))
+        self.assertEqual(stored["churned_at"], churned_at)
+
+        # Paying again clears it
+        self.deliver("customer.subscription.updated", stripe_subscription("sub_churn", "price_catalog"))
+        self.assertIsNone(self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_churn"))["churned_at"])
+
+    def test_page_uses_the_projected_rows(self):
+        _, canceled = self.add_subscriber(42, stripe_subscription_id="sub_canceled")
+        _, past_due = self.add_subscriber(43, stripe_subscription_id="sub_past_due")
+
+        # The rows the page reads carry only the projected fields, as on Mongo
+        rows = self.run_async(server.repos.subscriptions.find_by_stripe_ids(["sub_canceled"], server.RECONCILE_FIELDS))
+        self.assertEqual(set(rows[0]), set(server.RECONCILE_FIELDS))
+
+        def stripe_sub(subscription, status):
+            return stripe_object({
+                "id": subscription["stripe_subscription_id"], "status": status, "customer": {"id": "cus_1"},
+                "current_period_start": int(subscription["current_period_start"].timestamp()),
+                "current_period_end": int(subscription["current_period_end"].timestamp())
+            })
+
+        counts = self.run_async(server.reconcile_subscription_page(
+            [stripe_sub(canceled, "canceled"), stripe_sub(past_due, "past_due")]
+        ))
+        self.assertEqual(counts["repaired"], 2)
+        # Stripe is still retrying the card of a past_due subscription; only the canceled one loses access
+        banned = [call[2] for call in server.bot.bot.calls if call[0] == "ban_chat_member"]
+        self.assertEqual(banned, [42])
+
+
+def stripe_subscription(stripe_subscription_id, price_id, status="active"):
+    now = int(datetime.utcnow().timestamp())
+    return {
+        "id": stripe_subscription_id,
+        "object": "subscription",
+        "customer": "cus_1",
+        "status": status,
+        "current_period_start": now,
+        "current_period_end": now + 30 * 86400,
+        "items": {"data": [{"price": {"id": price_id, "product": "prod_1"}}]}
+    }
+
+
+class TestPlanResolution(ServerTestCase):
+    """Tests for saving plans and resolving them from Stripe webhooks"""
+
+    def test_plans_other_than_default_need_their_own_price(self):
+        with self.assertRaises(server.HTTPException) as raised:
+            self.add_plan(stripe_price_id=None)
+        self.assertEqual(raised.exception.status_code, 400)
+
+        self.add_plan()
+        with self.assertRaises(server.HTTPException) as raised:
+            self.add_plan(id="gold", group_id=-300)
+        self.assertEqual(raised.exception.status_code, 400)
+        self.assertEqual(set(server.plan_registry.by_id), {"default", "vip"})
+
+    def test_checkout_uses_the_plan_from_metadata(self):
+        self.add_plan()
+        user = make_user(51)
+        self.run_async(server.repos.users.insert(user))
+        self.patch_stripe(stripe.Subscription, "retrieve", lambda sub_id: stripe_object(stripe_subscription(sub_id, "price_vip")))
+
+        self.deliver("checkout.session.completed", {
+            "id": "cs_1",
+            "subscription": "sub_vip",
+            "metadata": {"telegram_user_id": "51", "user_id": user["id"], "plan_id": "vip"}
+        })
+        stored = self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_vip"))
+        self.assertEqual((stored["plan_id"], stored["amount"]), ("vip", 90.0))
+        self.assertIn(51, server.active_members[-200])
+
+    def test_checkout_after_recovery_updates_the_row(self):
+        user = make_user(55)
+        self.run_async(server.repos.users.insert(user))
+        # Recovered by reconciliation before Stripe's retry of the webhook arrives
+        recovered = make_subscription(user, stripe_subscription_id="sub_retry", status="past_due")
+        self.run_async(server.repos.subscriptions.insert(recovered))
+        self.patch_stripe(stripe.Subscription, "retrieve", lambda sub_id: stripe_object(stripe_subscription(sub_id, "price_catalog")))
+
+        session = {
+            "id": "cs_retry",
+            "subscription": "sub_retry",
+            "metadata": {"telegram_user_id": "55", "user_id": user["id"], "plan_id": "default"}
+        }
+        self.deliver("checkout.session.completed", session)
+        self.deliver("checkout.session.completed", session)
+        rows = [doc for doc in server.repos.subscriptions.docs.values() if doc["stripe_subscription_id"] == "sub_retry"]
+        self.assertEqual([(row["id"], row["status"]) for row in rows], [(recovered["id"], "active")])
+
+    def test_routine_update_keeps_the_plan(self):
+        self.add_plan()
+        self.add_subscriber(52, stripe_subscription_id="sub_vip", stripe_price_id="price_vip", plan_id="vip")
+        # Imported rows carry no price at all
+        self.add_subscriber(53, stripe_subscription_id="sub_imported", plan_id="vip")
+
+        self.deliver("customer.subscription.updated", stripe_subscription("sub_vip", "price_vip"))
+        self.deliver("customer.subscription.updated", stripe_subscription("sub_imported", "price_catalog"))
+        for stripe_subscription_id in ("sub_vip", "sub_imported"):
+            stored = self.run_async(server.repos.subscriptions.get_by_stripe_id(stripe_subscription_id))
+            self.assertEqual(stored["plan_id"], "vip")
+        self.assertEqual(server.active_members[-200], {52, 53})
+        self.assertNotIn("ban_chat_member", [call[0] for call in server.bot.bot.calls])
+
+    def test_price_change_moves_the_subscriber(self):
+        self.add_plan()
+        self.add_subscriber(54, stripe_subscription_id="sub_up", stripe_price_id="price_catalog")
+
+        self.deliver("customer.subscription.updated", stripe_subscription("sub_up", "price_vip"))
+        stored = self.run_async(server.repos.subscriptions.get_by_stripe_id("sub_up"))
+        self.assertEqual((stored["plan_id"], stored["stripe_price_id"]), ("vip", "price_vip"))
+        self.assertIn(("ban_chat_member", server.GROUP_ID, 54), server.bot.bot.calls)
+        self.assertIn(54, server.active_members[-200])
+
+
+class TestAdminCommand(ServerTestCase):
+    """Tests for the /admin bot command"""
+
+    def test_lists_usernames_of_recent_subscribers(self):
+        self.add_subscriber(61)
+        replies = []
+
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+
+        admin = SimpleNamespace(id=server.ADMIN_USER_IDS[0])
+        update = SimpleNamespace(effective_user=admin, message=SimpleNamespace(reply_text=reply_text))
+        self.run_async(server.admin_command(update, SimpleNamespace(args=[])))
+        self.assertIn("@user_61 - до", replies[0])
+
+
+class TestClientIp(unittest.TestCase):
+    """Tests for the client address used by rate limits"""
+
+    def request(self, forwarded):
+        return SimpleNamespace(headers={"x-forwarded-for": forwarded}, client=SimpleNamespace(host="10.0.0.1"))
+
+    def test_ignores_forwarded_for_unless_trusted(self):
+        self.assertEqual(server.client_ip(self.request("1.1.1.1")), "10.0.0.1")
+
+    def test_trusts_only_the_hop_added_by_the_ingress(self):
+        server.TRUST_FORWARDED_FOR = True
+        try:
+            self.assertEqual(server.client_ip(self.request("6.6.6.6, 203.0.113.7")), "203.0.113.7")
+        finally:
+            server.TRUST_FORWARDED_FOR = False
+
+
+class TestShutdown(ServerTestCase):
+    """Tests for draining before the server stops accepting connections"""
+
+    def tearDown(self):
+        super().tearDown()
+        server.shutting_down = False
+        server.drain_started = asyncio.Event()
+        server.drain_task = None
+        server.change_watch_task = None
+
+    def drain_from(self, host, token=None):
+        request = SimpleNamespace(client=SimpleNamespace(host=host))
+        return self.run_async(server.drain(request, token))
+
+    def test_drain_hook_is_limited_to_loopback_or_token(self):
+        token = server.DRAIN_TOKEN
+        server.DRAIN_TOKEN = "secret"
+        self.addCleanup(setattr, server, "DRAIN_TOKEN", token)
+
+        for bad_token in (None, "guess"):
+            with self.assertRaises(server.HTTPException) as raised:
+                self.drain_from("203.0.113.7", bad_token)
+            self.assertEqual(raised.exception.status_code, 403)
+        self.assertFalse(server.shutting_down)
+
+        self.assertEqual(self.drain_from("203.0.113.7", "secret")["status"], "drained")
+        self.assertTrue(server.shutting_down)
+
+    def test_drain_hook_from_loopback(self):
+        self.assertEqual(self.drain_from("127.0.0.1")["status"], "drained")
+        self.assertTrue(server.drain_started.is_set())
+
+    def test_event_stream_closes_when_draining(self):
+        async def scenario():
+            response = await server.dashboard_events()
+            stream = response.body_iterator
+            first = await stream.__anext__()
+            server.start_draining()
+            rest = [chunk async for chunk in stream]
+            return first, rest
+
+        first, rest = self.run_async(scenario())
+        self.assertIn("event: resync", first)
+        self.assertEqual(rest, [])
+        self.assertEqual(server.dashboard_clients, set())
+
+    def test_change_watcher_stops_before_storage_closes(self):
+        events = []
+        repos = server.repos
+        repos.close = lambda: events.append("close")
+
+        async def watcher():
+            try:
+                await asyncio.sleep(60)
+            finally:
+                await asyncio.sleep(0)
+                events.append("resume token saved")
+
+        async def scenario():
+            server.change_watch_task = asyncio.create_task(watcher())
+            await asyncio.sleep(0)
+            await server.shutdown_event()
+
+        self.run_async(scenario())
+        self.assertEqual(events, ["resume token saved", "close"])
+
+
+class TestRenewalReminders(ServerTestCase):
+    """Tests for reminder windows and the markers that keep reminders from repeating"""
+
+    def setUp(self):
+        super().setUp()
+        windows = server.REMINDER_WINDOWS_DAYS
+        server.REMINDER_WINDOWS_DAYS = [3, 1]
+        self.addCleanup(setattr, server, "REMINDER_WINDOWS_DAYS", windows)
+
+    def markers(self, subscription):
+        return sorted(server.repos.subscriptions.docs[subscription["id"]].get("reminders_sent") or [])
+
+    def test_windows_and_markers(self):
+        _, three_days = self.add_subscriber(71, days=2.5)
+        _, one_day = self.add_subscriber(72, days=0.5, stripe_subscription_id="sub_72")
+        _, later = self.add_subscriber(73, days=3.5)
+        _, ended = self.add_subscriber(74, days=-0.1)
+
+        self.run_async(server.send_renewal_reminders())
+        queued = dict(self.queued_notifications())
+        self.assertEqual(set(queued), {71, 72})
+        self.assertIn("/start", queued[71])
+        self.assertIn("автоматично продовжена", queued[72])
+        self.assertEqual(self.markers(three_days), ["3d"])
+        # The last-day reminder also stands in for the 3-day one
+        self.assertEqual(self.markers(one_day), ["1d", "3d"])
+        self.assertEqual(self.markers(later), [])
+        self.assertEqual(self.markers(ended), [])
+
+        # The next tick sends nothing new
+        self.run_async(server.send_renewal_reminders())
+        self.assertEqual(self.queued_notifications(), [])
+
+    def test_next_window_sends_once_more(self):
+        _, subscription = self.add_subscriber(75, days=2.5)
+        self.run_async(server.send_renewal_reminders())
+        self.queued_notifications()
+
+        self.run_async(server.repos.subscriptions.update(
+            subscription["id"], {"current_period_end": datetime.utcnow() + timedelta(hours=12)}
+        ))
+        self.run_async(server.send_renewal_reminders())
+        self.run_async(server.send_renewal_reminders())
+        self.assertEqual([chat_id for chat_id, _ in self.queued_notifications()], [75])
+        self.assertEqual(self.markers(subscription), ["1d", "3d"])
+
+
+class TestPaymentStatus(ServerTestCase):
+    """Tests for payment checks answered from local state"""
+
+    def add_transaction(self, session_id):
+        user = make_user(81)
+        self.run_async(server.repos.transactions.insert(server.PaymentTransaction(
+            user_id=user["id"],
+            telegram_user_id=81,
+            stripe_session_id=session_id,
+            amount=30.0,
+            currency="UAH",
+            metadata={"plan_id": "default"}
+        ).dict()))
+
+    def test_long_poll_wakes_when_the_webhook_completes(self):
+        self.add_transaction("cs_wait")
+        self.patch_stripe(stripe.checkout.Session, "retrieve", lambda session_id: self.fail("asked Stripe"))
+
+        async def scenario():
+            check = asyncio.create_task(server.get_payment_status("cs_wait", wait=5))
+            await asyncio.sleep(0.05)
+            self.assertFalse(check.done())
+            started = asyncio.get_running_loop().time()
+            await server.repos.transactions.update_by_session_id("cs_wait", {"status": "completed"})
+            status = await check
+            return status, asyncio.get_running_loop().time() - started
+
+        status, waited = self.run_async(scenario())
+        self.assertEqual((status["payment_status"], status["source"]), ("paid", "local"))
+        self.assertLess(waited, 1)
+
+    def test_falls_back_to_cached_stripe_status(self):
+        self.add_transaction("cs_open")
+        retrieved = []
+        self.patch_stripe(stripe.checkout.Session, "retrieve", lambda session_id: retrieved.append(session_id) or stripe_object({
+            "id": session_id, "payment_status": "unpaid", "subscription": None, "metadata": {}
+        }))
+
+        status = self.run_async(server.get_payment_status("cs_open", wait=0.05))
+        self.assertEqual((status["payment_status"], status["source"]), ("unpaid", "stripe"))
+        self.run_async(server.get_payment_status("cs_open"))
+        self.assertEqual(retrieved, ["cs_open"])
+
+
+class TestCheckout(ServerTestCase):
+    """Tests for creating checkout sessions from the bot"""
+
+    def test_stripe_calls_do_not_block_the_event_loop(self):
+        user = make_user(91)
+        self.run_async(server.repos.users.insert(user))
+
+        def slow_customer(**params):
+            time.sleep(0.2)
+            return SimpleNamespace(id="cus_slow")
+
+        self.patch_stripe(stripe.Customer, "create", slow_customer)
+        self.patch_stripe(stripe.checkout.Session, "create", lambda **params: SimpleNamespace(
+            id="cs_slow", url="https://checkout.stripe.com/c/pay/cs_slow"
+        ))
+        server.stripe_catalog["price"] = SimpleNamespace(id="price_catalog")
+        self.addCleanup(server.stripe_catalog.pop, "price", None)
+
+        async def scenario():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            running = asyncio.create_task(ticker())
+            url = await server.create_stripe_checkout_session(91)
+            running.cancel()
+            return url, ticks
+
+        url, ticks = self.run_async(scenario())
+        self.assertTrue(url.endswith("cs_slow"))
+        # Other work kept running while Stripe answered
+        self.assertGreater(ticks, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
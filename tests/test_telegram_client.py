@@ -0,0 +1,149 @@
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'backend'))
+
+from telegram import Update
+from telegram.error import BadRequest, TimedOut
+from telegram_client import CircuitBreaker, CircuitOpenError, PerUserUpdateProcessor, ResilientBot
+
+
+class FakeBot:
+    """Bot stand-in with the Bot API signatures that fails the first `failures` calls"""
+
+    def __init__(self, failures=0, error=TimedOut):
+        self.failures = failures
+        self.error = error
+        self.calls = []
+
+    def record(self, **kwargs):
+        self.calls.append(kwargs)
+        if len(self.calls) <= self.failures:
+            raise self.error("fail")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.record(chat_id=chat_id, text=text, **kwargs)
+        return "sent"
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        self.record(chat_id=chat_id, user_id=user_id, **kwargs)
+        return True
+
+    async def get_chat(self, chat_id, **kwargs):
+        self.record(chat_id=chat_id, **kwargs)
+        return {"id": chat_id}
+
+
+class TestResilientBot(unittest.TestCase):
+    """Tests for retries, timeouts and the circuit breaker"""
+
+    def make_bot(self, fake, failure_threshold=5, deferred=None):
+        async def defer(chat_id, text):
+            deferred.append((chat_id, text))
+        return ResilientBot(
+            fake,
+            CircuitBreaker(failure_threshold, reset_seconds=60),
+            method_timeouts={"send_message": 10},
+            base_delay=0,
+            defer=defer if deferred is not None else None
+        )
+
+    def test_retries_transient_errors(self):
+        fake = FakeBot(failures=2)
+        bot = self.make_bot(fake)
+        self.assertEqual(asyncio.run(bot.send_message(chat_id=1, text="hi")), "sent")
+        self.assertEqual(len(fake.calls), 3)
+        self.assertEqual(fake.calls[0]["read_timeout"], 10)
+        self.assertEqual(bot.breaker.state, "closed")
+
+    def test_proxies_positional_arguments(self):
+        fake = FakeBot(failures=1)
+        bot = self.make_bot(fake)
+        self.assertEqual(asyncio.run(bot.get_chat(42)), {"id": 42})
+        self.assertEqual(asyncio.run(bot.send_message(42, "hi")), "sent")
+        self.assertEqual([call["chat_id"] for call in fake.calls], [42, 42, 42])
+
+    def test_bad_request_is_not_retried(self):
+        fake = FakeBot(failures=1, error=BadRequest)
+        bot = self.make_bot(fake)
+        with self.assertRaises(BadRequest):
+            asyncio.run(bot.send_message(chat_id=1, text="hi"))
+        self.assertEqual(len(fake.calls), 1)
+
+    def test_open_circuit_defers_messages_and_fails_fast(self):
+        deferred = []
+        fake = FakeBot(failures=100)
+        bot = self.make_bot(fake, failure_threshold=2, deferred=deferred)
+
+        self.assertIsNone(asyncio.run(bot.send_message(chat_id=1, text="hi")))
+        self.assertEqual(bot.breaker.state, "open")
+        self.assertEqual(deferred, [(1, "hi")])
+
+        calls = len(fake.calls)
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(bot.ban_chat_member(chat_id=1, user_id=2))
+        self.assertEqual(len(fake.calls), calls)
+
+
+def make_update(update_id, user_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": "/start"
+        }
+    }, None)
+
+
+class TestPerUserUpdateProcessor(unittest.TestCase):
+    """Tests for concurrent update handling with per-user ordering"""
+
+    def test_orders_per_user_and_runs_users_concurrently(self):
+        async def scenario():
+            processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+            events = []
+
+            async def handle(update_id, delay):
+                events.append(("start", update_id))
+                await asyncio.sleep(delay)
+                events.append(("end", update_id))
+
+            # Updates 1 and 2 come from the same user, 3 from another
+            await asyncio.gather(
+                processor.process_update(make_update(1, 10), handle(1, 0.05)),
+                processor.process_update(make_update(2, 10), handle(2, 0)),
+                processor.process_update(make_update(3, 20), handle(3, 0))
+            )
+            return processor, events
+
+        processor, events = asyncio.run(scenario())
+        self.assertLess(events.index(("end", 1)), events.index(("start", 2)))
+        self.assertLess(events.index(("end", 3)), events.index(("end", 1)))
+        self.assertEqual(processor.pending, {})
+
+    def test_drops_updates_beyond_pending_limit(self):
+        async def scenario():
+            processor = PerUserUpdateProcessor(max_concurrent_updates=4, max_pending_per_user=1)
+            handled = []
+
+            async def handle(update_id):
+                await asyncio.sleep(0.01)
+                handled.append(update_id)
+
+            await asyncio.gather(*(
+                processor.process_update(make_update(update_id, 10), handle(update_id)) for update_id in range(1, 4)
+            ))
+            return processor, handled
+
+        processor, handled = asyncio.run(scenario())
+        self.assertEqual(handled, [1, 2])
+        self.assertEqual(processor.dropped, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()